@@ -0,0 +1,268 @@
+'''
+Benchmarks for the ingest and query hot paths.
+
+Seeds a database of the given size, times the API endpoints and URL
+converters through the Flask test client and writes the results as JSON
+that can be compared between commits with compare.py.
+
+    python benchmarks/bench.py --preset small --output before.json
+    python benchmarks/bench.py --sensors 50 --days 90 --output after.json
+'''
+
+import argparse
+import json
+import math
+import os
+import platform
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+# pylint: disable=wrong-import-position
+from mokkiwahti import create_app, db
+from mokkiwahti.db_models import Location, Sensor, SensorConfiguration
+from mokkiwahti.ingest import store_measurements
+from mokkiwahti.utils import name_cache
+
+PRESETS = {
+    "tiny": {"sensors": 2, "days": 7},
+    "small": {"sensors": 10, "days": 365},
+    "large": {"sensors": 500, "days": 5 * 365},
+}
+SEED_BATCH_SIZE = 50000
+# Seeded measurements end here so that results don't depend on the date
+SEED_END = datetime(2024, 1, 1)
+
+
+def sensor_name(index):
+    return f"bench-sensor-{index}"
+
+
+def location_name(index):
+    return f"bench-location-{index}"
+
+
+def seed(app, sensors, days, interval, sensors_per_location):
+    '''
+    Creates the sensors and locations and inserts a measurement every
+    `interval` seconds for `days` days for every sensor
+    '''
+
+    with app.app_context():
+        db.create_all()
+        locations = [Location(name=location_name(i))
+                     for i in range(math.ceil(sensors / sensors_per_location))]
+        db.session.add_all(locations)
+        for i in range(sensors):
+            db.session.add(Sensor(name=sensor_name(i),
+                                  location=locations[i // sensors_per_location],
+                                  sensor_configuration=SensorConfiguration(interval=interval)))
+        db.session.commit()
+
+        steps = days * 86400 // interval
+        start = SEED_END - timedelta(seconds=steps * interval)
+        rows = []
+        for sensor in Sensor.query.order_by(Sensor.id):
+            for step in range(steps):
+                phase = step * interval / 86400 * 2 * math.pi
+                rows.append({
+                    "sensor_id": sensor.id,
+                    "location_id": sensor.location_id,
+                    "temperature": round(20 + 5 * math.sin(phase), 2),
+                    "humidity": round(45 + 10 * math.cos(phase), 2),
+                    "timestamp": start + timedelta(seconds=step * interval),
+                })
+                if len(rows) >= SEED_BATCH_SIZE:
+                    store_measurements(rows)
+                    rows = []
+        if rows:
+            store_measurements(rows)
+        return steps * sensors
+
+
+def measure(func, repeat, warmup=2):
+    '''
+    Calls func warmup + repeat times and returns timing statistics of the
+    last repeat calls in milliseconds
+    '''
+
+    for _ in range(warmup):
+        func()
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    return {
+        "runs": repeat,
+        "min_ms": round(timings[0], 3),
+        "median_ms": round(statistics.median(timings), 3),
+        "mean_ms": round(statistics.fmean(timings), 3),
+        "p95_ms": round(timings[min(len(timings) - 1, int(len(timings) * 0.95))], 3),
+        "max_ms": round(timings[-1], 3),
+    }
+
+
+def _request(client, method, url, status, payload=None):
+    '''
+    Returns a function that makes the request. payload is called on every
+    request to build the JSON body
+    '''
+
+    def call():
+        kwargs = {} if payload is None else {"json": payload()}
+        resp = client.open(url, method=method, **kwargs)
+        # Streamed responses are only produced when read
+        resp.get_data()
+        if resp.status_code != status:
+            raise RuntimeError(f"{method} {url} returned {resp.status_code}")
+    return call
+
+
+def _converter(app, kind, name, cold):
+    converter = app.url_map.converters[kind](app.url_map)
+
+    def call():
+        with app.test_request_context():
+            if cold:
+                name_cache(kind).clear()
+            converter.to_python(name)
+    return call
+
+
+def benchmarks(app, repeat):
+    '''
+    Returns a dict of benchmark names and their timing statistics
+    '''
+
+    client = app.test_client()
+    sensor = sensor_name(0)
+    location = location_name(0)
+    sensor_url = f"/api/sensors/{sensor}/measurements/"
+    location_url = f"/api/locations/{location}/measurements/"
+    day = "from=2023-12-30T00:00:00&to=2023-12-31T00:00:00"
+    week = "from=2023-12-24T00:00:00&to=2023-12-31T00:00:00"
+    counter = iter(range(10 ** 9))
+
+    def single():
+        return {"temperature": 21.5, "humidity": 40.0,
+                "timestamp": (SEED_END + timedelta(seconds=next(counter))).isoformat()}
+
+    cases = {
+        "post_single": _request(client, "POST", sensor_url, 201, payload=single),
+        "post_bulk_500": _request(client, "POST", sensor_url, 201,
+                                  payload=lambda: [single() for _ in range(500)]),
+        "get_sensor_measurements_page": _request(client, "GET", sensor_url, 200),
+        "get_sensor_measurements_day": _request(client, "GET", f"{sensor_url}?{day}", 200),
+        "get_location_measurements_day": _request(client, "GET", f"{location_url}?{day}", 200),
+        "get_sensor_aggregate_week_1h": _request(
+            client, "GET", f"{sensor_url}aggregate/?bucket=1h&{week}", 200),
+        "get_sensor_aggregate_week_15m": _request(
+            client, "GET", f"{sensor_url}aggregate/?bucket=15m&{week}", 200),
+        "get_sensor_csv_week": _request(
+            client, "GET", f"/api/sensors/{sensor}/measurements.csv?{week}", 200),
+        "get_locations": _request(client, "GET", "/api/locations/", 200),
+        "get_locations_latest": _request(
+            client, "GET", "/api/locations/?expand=sensors,measurements:latest:1", 200),
+        "get_sensors": _request(client, "GET", "/api/sensors/", 200),
+        "sensor_converter_cached": _converter(app, "sensor", sensor, cold=False),
+        "sensor_converter_cold": _converter(app, "sensor", sensor, cold=True),
+        "location_converter_cached": _converter(app, "location", location, cold=False),
+        "location_converter_cold": _converter(app, "location", location, cold=True),
+    }
+    # GETs run before the POSTs so that they see the seeded data only
+    order = sorted(cases, key=lambda name: name.startswith("post_"))
+    return {name: measure(cases[name], repeat) for name in order}
+
+
+def _commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+                              capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--preset", choices=PRESETS, default="tiny",
+                        help="database size, overridden by --sensors and --days")
+    parser.add_argument("--sensors", type=int, help="number of sensors")
+    parser.add_argument("--days", type=int, help="days of measurements per sensor")
+    parser.add_argument("--interval", type=int, default=900,
+                        help="seconds between measurements (default 900)")
+    parser.add_argument("--sensors-per-location", type=int, default=5)
+    parser.add_argument("--profile", default="production", help="SQLITE_PROFILE to use")
+    parser.add_argument("--database",
+                        help="database file to use. Seeded if it doesn't exist, "
+                             "otherwise reused as is. Defaults to a temporary file")
+    parser.add_argument("--repeat", type=int, default=20, help="timed runs per benchmark")
+    parser.add_argument("--output", help="file to write the JSON results to, default stdout")
+    args = parser.parse_args(argv)
+
+    sensors = args.sensors or PRESETS[args.preset]["sensors"]
+    days = args.days or PRESETS[args.preset]["days"]
+
+    tmp_dir = None
+    database = args.database
+    if database is None:
+        tmp_dir = tempfile.TemporaryDirectory()
+        database = os.path.join(tmp_dir.name, "bench.db")
+    reuse = os.path.exists(database)
+
+    app = create_app({
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + os.path.abspath(database),
+        "SQLITE_PROFILE": args.profile,
+    })
+
+    seed_seconds = None
+    rows = None
+    if not reuse:
+        print(f"Seeding {sensors} sensors x {days} days...", file=sys.stderr)
+        start = time.perf_counter()
+        rows = seed(app, sensors, days, args.interval, args.sensors_per_location)
+        seed_seconds = round(time.perf_counter() - start, 3)
+
+    results = benchmarks(app, args.repeat)
+    with app.app_context():
+        db.engine.dispose()
+    if tmp_dir is not None:
+        tmp_dir.cleanup()
+
+    report = {
+        "meta": {
+            "commit": _commit(),
+            "date": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "profile": args.profile,
+            "database": None if reuse else {
+                "sensors": sensors,
+                "days": days,
+                "interval": args.interval,
+                "rows": rows,
+                "seed_seconds": seed_seconds,
+            },
+            "reused_database": reuse,
+        },
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+'''
+Compares two result files written by bench.py.
+
+    python benchmarks/compare.py before.json after.json --threshold 10
+
+Prints the median of every benchmark in both files and the change in
+percent. Exits with status 1 if any benchmark got slower by more than
+--threshold percent.
+'''
+
+import argparse
+import json
+import sys
+
+
+def load(path):
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def compare(before, after, threshold):
+    '''
+    Returns a list of (name, before_ms, after_ms, change_percent, regressed)
+    tuples for benchmarks found in either result set
+    '''
+
+    rows = []
+    names = list(before["results"])
+    names += [name for name in after["results"] if name not in before["results"]]
+    for name in names:
+        old = before["results"].get(name, {}).get("median_ms")
+        new = after["results"].get(name, {}).get("median_ms")
+        change = None
+        if old and new is not None:
+            change = (new - old) / old * 100
+        rows.append((name, old, new, change, change is not None and change > threshold))
+    return rows
+
+
+def _format(value, suffix=""):
+    return "-" if value is None else f"{value:.2f}{suffix}"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("before")
+    parser.add_argument("after")
+    parser.add_argument("--threshold", type=float, default=10.0,
+                        help="slowdown in percent that counts as a regression (default 10)")
+    args = parser.parse_args(argv)
+
+    before, after = load(args.before), load(args.after)
+    sizes = [{key: value for key, value in (result["meta"]["database"] or {}).items()
+              if key != "seed_seconds"}
+             for result in (before, after)]
+    if sizes[0] != sizes[1]:
+        print("Warning: results were measured on different databases", file=sys.stderr)
+
+    rows = compare(before, after, args.threshold)
+    width = max(len(row[0]) for row in rows)
+    print(f"{'benchmark':<{width}}  {'before ms':>10}  {'after ms':>10}  {'change':>9}")
+    for name, old, new, change, regressed in rows:
+        flag = "  REGRESSION" if regressed else ""
+        print(f"{name:<{width}}  {_format(old):>10}  {_format(new):>10}  "
+              f"{_format(change, '%'):>9}{flag}")
+
+    if any(row[4] for row in rows):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -22,7 +22,53 @@ def create_app(test_config=None):
     app.config.from_mapping(
         SECRET_KEY="dev",
         SQLALCHEMY_DATABASE_URI="sqlite:///" + os.path.join(app.instance_path, "development.db"),
-        SQLALCHEMY_TRACK_MODIFICATIONS=False
+        SQLALCHEMY_TRACK_MODIFICATIONS=False,
+        # Write-behind buffer for measurement inserts, see mokkiwahti/ingest.py.
+        # Interval is in milliseconds, ack is either "flush" or "enqueue"
+        MEASUREMENT_BUFFER=False,
+        MEASUREMENT_BUFFER_SIZE=500,
+        MEASUREMENT_BUFFER_INTERVAL=50,
+        MEASUREMENT_BUFFER_ACK="flush",
+        # None, "ignore" or "update", see DEDUPLICATE_MODES in ingest.py
+        MEASUREMENT_DEDUPLICATE=None,
+        # Default and maximum number of measurements per page
+        MEASUREMENT_PAGE_SIZE=1000,
+        MEASUREMENT_PAGE_SIZE_MAX=10000,
+        # Number of sensor and location names cached by the URL converters
+        NAME_CACHE_SIZE=1024,
+        # SQLite pragmas and pool settings, see SQLITE_PROFILES in constants.py
+        SQLITE_PROFILE="default",
+        # Request metrics at /api/metrics. Worker processes share them
+        # through files in METRICS_DIR, flushed every METRICS_FLUSH_INTERVAL seconds
+        METRICS=True,
+        METRICS_DIR=None,
+        METRICS_FLUSH_INTERVAL=5,
+        METRICS_LATENCY_BUCKETS=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+        # How far back inside the thresholds a measurement has to be to close an alarm
+        ALARM_HYSTERESIS=0.5,
+        # Days to keep raw measurements and rollups, see mokkiwahti/retention.py.
+        # Rows are deleted RETENTION_BATCH_SIZE at a time with a pause of
+        # RETENTION_BATCH_PAUSE milliseconds in between
+        RETENTION_POLICIES={},
+        RETENTION_BATCH_SIZE=1000,
+        RETENTION_BATCH_PAUSE=10,
+        RETENTION_VACUUM_PAGES=1000,
+        # gzip/deflate compression of API responses of at least
+        # COMPRESSION_MIN_SIZE bytes. Streamed responses are always compressed
+        COMPRESSION=True,
+        COMPRESSION_LEVEL=6,
+        COMPRESSION_MIN_SIZE=1024,
+        COMPRESSION_MIMETYPES=("application/json", "text/csv", "text/plain"),
+        # Line protocol listener started with 'flask listen'. Lines are stored
+        # in batches of LISTENER_BATCH_SIZE at least every LISTENER_BATCH_INTERVAL
+        # milliseconds, lines beyond LISTENER_MAX_PENDING are dropped
+        LISTENER_BATCH_SIZE=1000,
+        LISTENER_BATCH_INTERVAL=500,
+        LISTENER_MAX_PENDING=100000,
+        # Threads reading the series of /api/measurements/ in parallel, and
+        # the most sensors one request can ask for
+        SERIES_WORKERS=4,
+        SERIES_MAX_SENSORS=20
     )
 
     app.config["SWAGGER"] = {
@@ -43,12 +89,17 @@ def create_app(test_config=None):
     except OSError:
         pass
 
+    from mokkiwahti.storage import configure_engine_options, init_storage
+    configure_engine_options(app)
     db.init_app(app)
+    init_storage(app)
 
     # Register ConverterClasses to be used in routing
     from . import api
-    from mokkiwahti.utils import SensorConverter, MeasurementConverter, LocationConverter
+    from mokkiwahti.utils import (SensorConverter, MeasurementConverter, LocationConverter,
+                                  init_name_caches)
 
+    init_name_caches(app)
     app.url_map.converters["sensor"] = SensorConverter
     app.url_map.converters["measurement"] = MeasurementConverter
     app.url_map.converters["location"] = LocationConverter
@@ -59,4 +110,37 @@ def create_app(test_config=None):
     from . import db_models
     app.cli.add_command(db_models.init_db_command)
 
+    from mokkiwahti.rollups import rebuild_rollups_command
+    app.cli.add_command(rebuild_rollups_command)
+
+    from mokkiwahti.partitions import partitions_cli
+    app.cli.add_command(partitions_cli)
+
+    from mokkiwahti.ingest import deduplicate_measurements_command
+    app.cli.add_command(deduplicate_measurements_command)
+
+    from mokkiwahti.relink import relink_sensor_command
+    app.cli.add_command(relink_sensor_command)
+
+    from mokkiwahti.listener import listen_command
+    app.cli.add_command(listen_command)
+
+    from mokkiwahti.retention import apply_retention_command
+    app.cli.add_command(apply_retention_command)
+
+    from mokkiwahti.export import export_measurements_command
+    app.cli.add_command(export_measurements_command)
+
+    from mokkiwahti.metrics import init_metrics
+    init_metrics(app, prefix=api.api_bp.url_prefix)
+
+    from mokkiwahti.alarms import init_alarms
+    init_alarms(app)
+
+    from mokkiwahti.series import init_series
+    init_series(app)
+
+    from mokkiwahti.ingest import init_write_buffer
+    init_write_buffer(app)
+
     return app
@@ -0,0 +1,122 @@
+'''
+Time bucketed aggregation of measurements, computed in SQL
+'''
+
+from datetime import datetime
+
+from sqlalchemy import Integer, cast, func, select
+
+from mokkiwahti import db
+from mokkiwahti.constants import ROLLUP_PERIODS
+from mokkiwahti.db_models import LocationRollup, SensorRollup
+from mokkiwahti.partitions import measurement_source
+from mokkiwahti.rollups import floor_timestamp, from_epoch
+
+ROLLUP_MODELS = {
+    "sensor_id": SensorRollup,
+    "location_id": LocationRollup,
+}
+
+
+def serialize_bucket(start, count, temperature, humidity):
+    '''
+    Serializes one aggregated bucket. temperature and humidity are
+    (min, avg, max) tuples
+    '''
+
+    return {
+        "start": datetime.isoformat(start),
+        "count": count,
+        "temperature": dict(zip(("min", "avg", "max"), temperature)),
+        "humidity": dict(zip(("min", "avg", "max"), humidity)),
+    }
+
+
+def aggregate(key, value, bucket, start=None, end=None):
+    '''
+    Aggregates measurements of one sensor or location into buckets of
+    `bucket` seconds. key is either "sensor_id" or "location_id".
+
+    Served from the rollup tables when the bucket size is a multiple of a
+    rollup period and the time range is aligned to it, otherwise computed
+    from raw measurements.
+    '''
+
+    for period in reversed(ROLLUP_PERIODS):
+        aligned = all(timestamp is None or floor_timestamp(timestamp, period) == timestamp
+                      for timestamp in (start, end))
+        if bucket % period == 0 and aligned:
+            return aggregate_rollup(ROLLUP_MODELS[key], key, value, period, bucket, start, end)
+    return aggregate_raw(key, value, bucket, start, end)
+
+
+def aggregate_rollup(model, key, value, period, bucket, start=None, end=None):
+    '''
+    Aggregates rollup rows of `period` seconds where key == value into
+    buckets of `bucket` seconds with a single GROUP BY.
+
+    Returns a list of serialized buckets in time order
+    '''
+
+    epoch = cast(func.strftime("%s", model.start), Integer)
+    bucket_col = ((epoch // bucket) * bucket).label("bucket")
+    count = func.sum(model.count)
+    stmt = (
+        select(bucket_col,
+               count,
+               func.min(model.temperature_min),
+               func.sum(model.temperature_sum) / count,
+               func.max(model.temperature_max),
+               func.min(model.humidity_min),
+               func.sum(model.humidity_sum) / count,
+               func.max(model.humidity_max))
+        .where(getattr(model, key) == value)
+        .where(model.period == period)
+        .group_by(bucket_col)
+        .order_by(bucket_col)
+    )
+    if start is not None:
+        stmt = stmt.where(model.start >= start)
+    if end is not None:
+        stmt = stmt.where(model.start < end)
+
+    return [
+        serialize_bucket(from_epoch(row[0]), row[1], row[2:5], row[5:8])
+        for row in db.session.execute(stmt)
+    ]
+
+
+def aggregate_raw(key, value, bucket, start=None, end=None):
+    '''
+    Aggregates measurements where key == value into buckets of `bucket`
+    seconds with a single GROUP BY. Rows are read as plain tuples from the
+    measurement table and partitions overlapping the range.
+
+    Returns a list of serialized buckets in time order
+    '''
+
+    source = measurement_source(start, end)
+    epoch = cast(func.strftime("%s", source.timestamp), Integer)
+    bucket_col = ((epoch // bucket) * bucket).label("bucket")
+    stmt = (
+        select(bucket_col,
+               func.count(),
+               func.min(source.temperature),
+               func.avg(source.temperature),
+               func.max(source.temperature),
+               func.min(source.humidity),
+               func.avg(source.humidity),
+               func.max(source.humidity))
+        .where(getattr(source, key) == value)
+        .group_by(bucket_col)
+        .order_by(bucket_col)
+    )
+    if start is not None:
+        stmt = stmt.where(source.timestamp >= start)
+    if end is not None:
+        stmt = stmt.where(source.timestamp < end)
+
+    return [
+        serialize_bucket(from_epoch(row[0]), row[1], row[2:5], row[5:8])
+        for row in db.session.execute(stmt)
+    ]
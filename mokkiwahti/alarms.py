@@ -0,0 +1,225 @@
+'''
+Threshold alarm engine. New measurements are checked against the
+thresholds of their sensor's configuration as they are stored.
+
+Thresholds and open alarms of every sensor are cached in memory together
+with the sensor's version and alarm_version. One query per stored batch
+reads those counters, and only sensors whose counters changed (new
+configuration, or an alarm opened or closed by another process) are
+loaded again, so checking a measurement is O(1).
+'''
+
+import threading
+from collections import defaultdict
+
+from flask import current_app
+from sqlalchemy import bindparam, insert, select, update
+
+from mokkiwahti import db
+from mokkiwahti.db_models import Alarm, Sensor, SensorConfiguration
+
+ALARM_KINDS = ("high", "low")
+
+
+class AlarmState:
+    '''
+    Thresholds and open alarms of one sensor. open maps alarm kind to a
+    tuple (alarm id, opened timestamp)
+    '''
+
+    __slots__ = ("key", "threshold_min", "threshold_max", "open")
+
+    def __init__(self, key, threshold_min, threshold_max, open_alarms):
+        self.key = key
+        self.threshold_min = threshold_min
+        self.threshold_max = threshold_max
+        self.open = open_alarms
+
+    def copy(self):
+        '''
+        Returns a copy whose open alarms can be changed without touching
+        this state
+        '''
+
+        return AlarmState(self.key, self.threshold_min, self.threshold_max, dict(self.open))
+
+
+class AlarmEngine:
+    '''
+    Evaluates measurements against sensor thresholds with hysteresis. A high
+    alarm opens when temperature goes above threshold_max and closes when it
+    is back at or below threshold_max - hysteresis, a low alarm likewise
+    below threshold_min.
+    '''
+
+    def __init__(self, hysteresis=0.5):
+        self.hysteresis = hysteresis
+        self._states = {}
+        self._lock = threading.Lock()
+
+    def _load(self, keys):
+        '''
+        Loads thresholds and open alarms of sensors. keys maps sensor ids to
+        their (version, alarm_version)
+        '''
+
+        ids = list(keys)
+        thresholds = db.session.execute(
+            select(Sensor.id, SensorConfiguration.threshold_min,
+                   SensorConfiguration.threshold_max)
+            .outerjoin(SensorConfiguration,
+                       SensorConfiguration.id == Sensor.sensor_configuration_id)
+            .where(Sensor.id.in_(ids))
+        )
+        states = {
+            sensor_id: AlarmState(keys[sensor_id], threshold_min, threshold_max, {})
+            for sensor_id, threshold_min, threshold_max in thresholds
+        }
+        open_alarms = db.session.execute(
+            select(Alarm.sensor_id, Alarm.kind, Alarm.id, Alarm.opened)
+            .where(Alarm.sensor_id.in_(ids))
+            .where(Alarm.closed.is_(None))
+        )
+        for sensor_id, kind, alarm_id, opened in open_alarms:
+            states[sensor_id].open[kind] = (alarm_id, opened)
+        return states
+
+    def _states_for(self, sensor_ids):
+        keys = {
+            sensor_id: (version, alarm_version)
+            for sensor_id, version, alarm_version in db.session.execute(
+                select(Sensor.id, Sensor.version, Sensor.alarm_version)
+                .where(Sensor.id.in_(sensor_ids))
+            )
+        }
+        with self._lock:
+            states = {sensor_id: self._states.get(sensor_id) for sensor_id in keys}
+        stale = {sensor_id: key for sensor_id, key in keys.items()
+                 if states[sensor_id] is None or states[sensor_id].key != key}
+        if stale:
+            states.update(self._load(stale))
+        return states
+
+    def _check(self, state, row, opened, closed):
+        temperature = row["temperature"]
+        timestamp = row["timestamp"]
+        for kind in ALARM_KINDS:
+            if kind == "high":
+                limit = state.threshold_max
+                crossed = limit is not None and temperature > limit
+                recovered = limit is None or temperature <= limit - self.hysteresis
+            else:
+                limit = state.threshold_min
+                crossed = limit is not None and temperature < limit
+                recovered = limit is None or temperature >= limit + self.hysteresis
+
+            current = state.open.get(kind)
+            if current is None:
+                if crossed:
+                    alarm = {"sensor_id": row["sensor_id"], "kind": kind, "threshold": limit,
+                             "opened": timestamp, "opened_value": temperature,
+                             "closed": None, "closed_value": None}
+                    opened.append(alarm)
+                    state.open[kind] = (alarm, timestamp)
+            elif recovered and timestamp >= current[1]:
+                alarm = current[0]
+                if isinstance(alarm, dict):
+                    # Opened in this same batch
+                    alarm["closed"] = timestamp
+                    alarm["closed_value"] = temperature
+                else:
+                    closed.append({"alarm_id": alarm, "closed_at": timestamp,
+                                   "closed_at_value": temperature})
+                del state.open[kind]
+
+    def evaluate(self, rows):
+        '''
+        Checks measurement rows in time order per sensor, opening and
+        closing alarms. Row timestamps have to be naive UTC like the ones
+        from measurement_row. Does not commit. Call this after the rows have
+        been inserted so that the write lock of the database is already held.
+
+        Returns the new states that have to be passed to apply() once the
+        transaction is committed.
+        '''
+
+        by_sensor = defaultdict(list)
+        for row in rows:
+            if row["sensor_id"] is not None:
+                by_sensor[row["sensor_id"]].append(row)
+        if not by_sensor:
+            return {}
+
+        states = self._states_for(list(by_sensor))
+        opened = []
+        closed = []
+        changed = set()
+        new_states = {}
+        for sensor_id, state in states.items():
+            if (state.threshold_min is None and state.threshold_max is None
+                    and not state.open):
+                new_states[sensor_id] = state
+                continue
+            state = state.copy()
+            before = (len(opened), len(closed), dict(state.open))
+            for row in sorted(by_sensor[sensor_id], key=lambda row: row["timestamp"]):
+                self._check(state, row, opened, closed)
+            if before != (len(opened), len(closed), state.open):
+                changed.add(sensor_id)
+            new_states[sensor_id] = state
+
+        if closed:
+            table = Alarm.__table__
+            db.session.execute(
+                update(table)
+                .where(table.c.id == bindparam("alarm_id"))
+                .values(closed=bindparam("closed_at"),
+                        closed_value=bindparam("closed_at_value")),
+                closed
+            )
+        if opened:
+            ids = db.session.execute(
+                insert(Alarm).returning(Alarm.id, sort_by_parameter_order=True),
+                opened
+            ).scalars().all()
+            # Swap the pending dicts in the states for the new ids
+            alarm_ids = {id(alarm): alarm_id for alarm, alarm_id in zip(opened, ids)}
+            for state in new_states.values():
+                for kind, (alarm, timestamp) in list(state.open.items()):
+                    if isinstance(alarm, dict):
+                        state.open[kind] = (alarm_ids[id(alarm)], timestamp)
+        if changed:
+            db.session.execute(
+                update(Sensor)
+                .where(Sensor.id.in_(changed))
+                .values(alarm_version=Sensor.alarm_version + 1)
+                .execution_options(synchronize_session=False)
+            )
+            for sensor_id in changed:
+                version, alarm_version = new_states[sensor_id].key
+                new_states[sensor_id].key = (version, alarm_version + 1)
+        return new_states
+
+    def apply(self, states):
+        '''
+        Caches states returned by evaluate() after they have been committed
+        '''
+
+        with self._lock:
+            self._states.update(states)
+
+
+def init_alarms(app):
+    '''
+    Creates the alarm engine used when measurements are stored
+    '''
+
+    app.extensions["alarms"] = AlarmEngine(app.config["ALARM_HYSTERESIS"])
+
+
+def alarm_engine():
+    '''
+    Returns the alarm engine of the current app
+    '''
+
+    return current_app.extensions["alarms"]
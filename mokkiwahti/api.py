@@ -5,10 +5,18 @@ File where all routing related stuff lives
 from flask import Blueprint
 from flask_restful import Api
 
+from mokkiwahti.resources.aggregate import MeasurementAggregate
+from mokkiwahti.resources.alarm import AlarmCollection
+from mokkiwahti.resources.export import MeasurementExport
+from mokkiwahti.resources.latest import LocationLatest, SensorLatest
 from mokkiwahti.resources.location import LocationCollection, LocationItem
 from mokkiwahti.resources.measurement import MeasurementCollection, MeasurementItem
 from mokkiwahti.resources.sensor import SensorCollection, SensorItem
+from mokkiwahti.resources.series import MeasurementSeries
 from mokkiwahti.resources.linker import LocationSensorLinker
+from mokkiwahti.compression import compress_response
+from mokkiwahti.metrics import record_response
+from mokkiwahti.resources.stats import MetricsExport, NameCacheStats
 
 
 # Register blueprint for API. This ensures that all routes starts with "/api" and we don't need
@@ -16,6 +24,9 @@ from mokkiwahti.resources.linker import LocationSensorLinker
 # in future
 api_bp = Blueprint("api", __name__, url_prefix="/api")
 api = Api(api_bp)
+api_bp.after_app_request(record_response)
+# Blueprint hooks run before app hooks, so metrics count the compressed bytes
+api_bp.after_request(compress_response)
 
 # As we are using blueprint, the actual URI will be /api/locations/ etc.
 api.add_resource(LocationCollection, "/locations/")
@@ -25,6 +36,20 @@ api.add_resource(SensorItem, "/sensors/<sensor:sensor>/")
 api.add_resource(MeasurementCollection,
                  "/sensors/<sensor:sensor>/measurements/",
                  "/locations/<location:location>/measurements/")
+api.add_resource(MeasurementAggregate,
+                 "/sensors/<sensor:sensor>/measurements/aggregate/",
+                 "/locations/<location:location>/measurements/aggregate/")
+api.add_resource(MeasurementExport,
+                 "/sensors/<sensor:sensor>/measurements.csv",
+                 "/locations/<location:location>/measurements.csv")
+api.add_resource(SensorLatest, "/sensors/<sensor:sensor>/measurements/latest/")
+api.add_resource(LocationLatest, "/locations/<location:location>/latest/")
 api.add_resource(MeasurementItem, "/measurement/<measurement:measurement>/")
+api.add_resource(MeasurementSeries, "/measurements/")
+api.add_resource(AlarmCollection,
+                 "/sensors/<sensor:sensor>/alarms/",
+                 "/alarms/")
 api.add_resource(LocationSensorLinker,
                  "/locations/<location:location>/link/sensors/<sensor:sensor>/")
+api.add_resource(NameCacheStats, "/stats/name-cache/")
+api.add_resource(MetricsExport, "/metrics")
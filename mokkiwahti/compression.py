@@ -0,0 +1,68 @@
+'''
+Content negotiated gzip and deflate compression of API responses.
+
+Responses are compressed when the client accepts it, the mimetype is
+compressible and the body is at least COMPRESSION_MIN_SIZE bytes. Streamed
+responses have no known size and are always compressed, chunk by chunk
+as they are generated.
+'''
+
+import zlib
+
+from flask import current_app, request
+
+# encoding: wbits for zlib.compressobj
+ENCODINGS = {
+    "gzip": 16 + zlib.MAX_WBITS,
+    "deflate": zlib.MAX_WBITS,
+}
+
+
+def _compress_chunks(chunks, compressor):
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode()
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+    finally:
+        close = getattr(chunks, "close", None)
+        if close is not None:
+            close()
+
+
+def compress_response(response):
+    '''
+    after_request hook of the API blueprint. Compresses the response body
+    with the best encoding the client accepts.
+    '''
+
+    config = current_app.config
+    if not config["COMPRESSION"] or response.mimetype not in config["COMPRESSION_MIMETYPES"]:
+        return response
+    response.vary.add("Accept-Encoding")
+    if (response.status_code < 200 or response.status_code in (204, 304)
+            or "Content-Encoding" in response.headers
+            or response.direct_passthrough):
+        return response
+
+    encoding = request.accept_encodings.best_match(ENCODINGS)
+    if encoding is None:
+        return response
+    if not response.is_streamed and (response.content_length or 0) < config["COMPRESSION_MIN_SIZE"]:
+        return response
+
+    compressor = zlib.compressobj(config["COMPRESSION_LEVEL"], zlib.DEFLATED, ENCODINGS[encoding])
+    if response.is_streamed:
+        response.response = _compress_chunks(response.response, compressor)
+    else:
+        response.set_data(compressor.compress(response.get_data()) + compressor.flush())
+    response.content_encoding = encoding
+
+    # The compressed body is a different representation with the same meaning
+    etag, weak = response.get_etag()
+    if etag is not None and not weak:
+        response.set_etag(etag, weak=True)
+    return response
@@ -1 +1,36 @@
 # File for defining constants
+
+# Bucket sizes in seconds of the measurement rollup tables, smallest first
+ROLLUP_PERIODS = (3600, 86400)
+
+# SQLite pragmas applied to every new database connection, by storage profile.
+# See https://www.sqlite.org/pragma.html
+SQLITE_PROFILES = {
+    "default": {
+        "foreign_keys": "ON",
+    },
+    "production": {
+        # Readers don't block the writer and the other way around
+        "journal_mode": "WAL",
+        # With WAL, NORMAL only syncs at checkpoints and is still safe from corruption
+        "synchronous": "NORMAL",
+        "foreign_keys": "ON",
+        # Wait for the write lock instead of failing with "database is locked"
+        "busy_timeout": 5000,
+        # Negative value is in KiB, so 64 MiB of page cache per connection
+        "cache_size": -65536,
+        "mmap_size": 268435456,
+        "temp_store": "MEMORY",
+    },
+}
+
+# SQLAlchemy engine options by storage profile
+SQLITE_ENGINE_OPTIONS = {
+    "default": {},
+    "production": {
+        "pool_size": 8,
+        "max_overflow": 8,
+        "pool_timeout": 10,
+        "pool_recycle": 3600,
+    },
+}
@@ -2,14 +2,99 @@
 This file contains ORM classes and methods
 '''
 
-from datetime import datetime
+import math
+from datetime import datetime, timezone
 
 import click
 
+from flask import current_app
 from flask.cli import with_appcontext
+from jsonschema import Draft7Validator
 from mokkiwahti import db
 
-class Location(db.Model):
+class ValidatorMixin:
+    '''
+    Gives ORM classes a JSON schema validator that is compiled once and
+    shared by all requests
+    '''
+
+    FORMAT_CHECKER = None
+
+    @classmethod
+    def get_validator(cls):
+        '''
+        Returns the compiled validator for the schema of the class
+        '''
+
+        validator = cls.__dict__.get("_validator")
+        if validator is None:
+            validator = Draft7Validator(cls.get_schema(), format_checker=cls.FORMAT_CHECKER)
+            cls._validator = validator
+        return validator
+
+def utcnow():
+    '''
+    Returns the current UTC time as a naive datetime
+    '''
+
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+def parse_timestamp(value):
+    '''
+    Parses an ISO 8601 timestamp into a naive UTC datetime. Timestamps with
+    an offset are converted to UTC, naive ones are taken to be UTC already.
+    '''
+
+    timestamp = datetime.fromisoformat(value)
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return timestamp
+
+class VersionMixin:
+    '''
+    Version counters used for ETag and Last-Modified headers. version and
+    modified change whenever the representation of the row changes,
+    measurements_version and measurements_modified whenever measurements
+    of the row are added, changed or deleted.
+    '''
+
+    version = db.Column(db.Integer, nullable=False, default=1)
+    modified = db.Column(db.DateTime, nullable=False, default=utcnow)
+    measurements_version = db.Column(db.Integer, nullable=False, default=0)
+    measurements_modified = db.Column(db.DateTime, nullable=False, default=utcnow)
+
+    def touch(self):
+        '''
+        Marks the representation of the row changed. The version of a stored
+        row is increased in the UPDATE of the flush, so that concurrent
+        changes by other workers all get a version of their own.
+        '''
+
+        if self.id is None:
+            self.version = (self.version or 0) + 1
+        else:
+            self.version = type(self).version + 1
+        self.modified = utcnow()
+
+    @classmethod
+    def touch_measurements(cls, ids):
+        '''
+        Marks measurements of the rows with given ids changed with one UPDATE.
+        Does not commit.
+        '''
+
+        ids = [row_id for row_id in set(ids) if row_id is not None]
+        if not ids:
+            return
+        db.session.execute(
+            db.update(cls)
+            .where(cls.id.in_(ids))
+            .values(measurements_version=cls.measurements_version + 1,
+                    measurements_modified=utcnow())
+            .execution_options(synchronize_session=False)
+        )
+
+class Location(ValidatorMixin, VersionMixin, db.Model):
     '''
     ORM class to represent location data
     '''
@@ -42,21 +127,29 @@ class Location(db.Model):
             }
         }
 
-    def serialize(self, short_form=False):
+    def serialize(self, short_form=False, expand=("sensors",), measurements=None):
         '''
         Serializes the Location object
+
+        expand names the relations embedded in the full form. Measurements
+        are only embedded when asked for, a preloaded list (e.g. the latest
+        ones) can be given in measurements instead of the whole relation.
         '''
 
         serial = {
             "name": self.name,
         }
         if not short_form:
-            serial["sensors"] = (self.sensors and
-                                 [sensor.serialize(short_form=True)
-                                  for sensor in self.sensors])
-            serial["measurements"] = (self.measurements and
-                                      [measurement.serialize(short_form=True)
-                                       for measurement in self.measurements])
+            if "sensors" in expand:
+                serial["sensors"] = (self.sensors and
+                                     [sensor.serialize(short_form=True)
+                                      for sensor in self.sensors])
+            if "measurements" in expand:
+                if measurements is None:
+                    measurements = self.measurements
+                serial["measurements"] = (measurements and
+                                          [measurement.serialize(short_form=True)
+                                           for measurement in measurements])
         return serial
 
     def deserialize(self, json):
@@ -67,7 +160,7 @@ class Location(db.Model):
         self.name = json["name"]
 
 
-class Sensor(db.Model):
+class Sensor(ValidatorMixin, VersionMixin, db.Model):
     '''
     ORM class to represent sensor data
     '''
@@ -79,9 +172,13 @@ class Sensor(db.Model):
                                         db.ForeignKey("sensor_configuration.id",
                                                       ondelete="SET NULL"))
 
+    # Changes whenever an alarm of the sensor is opened or closed
+    alarm_version = db.Column(db.Integer, nullable=False, default=0)
+
     location = db.relationship("Location", back_populates="sensors")
     measurements = db.relationship("Measurement", back_populates="sensor")
     sensor_configuration = db.relationship("SensorConfiguration", back_populates="sensor")
+    alarms = db.relationship("Alarm", back_populates="sensor", passive_deletes=True)
 
     @staticmethod
     def get_schema():
@@ -105,18 +202,22 @@ class Sensor(db.Model):
             }
         }
 
-    def serialize(self, short_form=False):
+    def serialize(self, short_form=False, expand=("location", "sensor_configuration")):
         '''
         Serializes the sensor class
+
+        expand names the relations embedded in the full form
         '''
 
         serial = {
             "name": self.name,
         }
         if not short_form:
-            serial["location"] = self.location and self.location.serialize(short_form=True)
-            serial["sensor_configuration"] = (self.sensor_configuration
-                                        and self.sensor_configuration.serialize())
+            if "location" in expand:
+                serial["location"] = self.location and self.location.serialize(short_form=True)
+            if "sensor_configuration" in expand:
+                serial["sensor_configuration"] = (self.sensor_configuration
+                                            and self.sensor_configuration.serialize())
 
         return serial
 
@@ -128,7 +229,7 @@ class Sensor(db.Model):
         self.name = json["name"]
 
 
-class Measurement(db.Model):
+class Measurement(ValidatorMixin, db.Model):
     '''
     ORM class to represent measurement data
     '''
@@ -143,6 +244,16 @@ class Measurement(db.Model):
     location = db.relationship("Location", back_populates="measurements")
     sensor = db.relationship("Sensor", back_populates="measurements")
 
+    FORMAT_CHECKER = Draft7Validator.FORMAT_CHECKER
+
+    # Measurements are always read per sensor or location in time order
+    __table_args__ = (
+        db.Index("ix_measurement_sensor_timestamp", "sensor_id", "timestamp"),
+        db.Index("ix_measurement_location_timestamp", "location_id", "timestamp"),
+        # Ids must not be reused once old rows are moved to partitions
+        {"sqlite_autoincrement": True},
+    )
+
     def serialize(self, short_form=False):
         '''
         Serializes the Measurement class
@@ -165,7 +276,7 @@ class Measurement(db.Model):
         '''
         self.temperature = json["temperature"]
         self.humidity = json["humidity"]
-        self.timestamp = datetime.fromisoformat(json["timestamp"])
+        self.timestamp = parse_timestamp(json["timestamp"])
 
     @staticmethod
     def get_schema():
@@ -194,7 +305,176 @@ class Measurement(db.Model):
         }
         return schema
 
-class SensorConfiguration(db.Model):
+    @classmethod
+    def check(cls, json):
+        '''
+        Fast path validation for the fixed shape of a measurement object.
+        Returns True if json is a valid measurement that can be stored: the
+        numbers are finite and the timestamp passes the date-time format of
+        the schema and parses. When it returns False the full validator
+        should be used to find out what is wrong.
+        '''
+
+        if not isinstance(json, dict):
+            return False
+        for key in ("temperature", "humidity"):
+            value = json.get(key)
+            # bool is a subclass of int but not a JSON number
+            if not isinstance(value, (int, float)) or isinstance(value, bool):
+                return False
+            # NaN and Infinity are accepted by the JSON parser but not stored
+            if not math.isfinite(value):
+                return False
+        timestamp = json.get("timestamp")
+        if not isinstance(timestamp, str):
+            return False
+        if not cls.FORMAT_CHECKER.conforms(timestamp, "date-time"):
+            return False
+        try:
+            parse_timestamp(timestamp)
+        except ValueError:
+            return False
+        return True
+
+class RollupMixin:
+    '''
+    Columns shared by the measurement rollup tables. A rollup row holds
+    statistics of all measurements in one bucket of `period` seconds
+    starting at `start`.
+    '''
+
+    period = db.Column(db.Integer, primary_key=True)
+    start = db.Column(db.DateTime, primary_key=True)
+    count = db.Column(db.Integer, nullable=False)
+    temperature_sum = db.Column(db.Float, nullable=False)
+    temperature_min = db.Column(db.Float, nullable=False)
+    temperature_max = db.Column(db.Float, nullable=False)
+    humidity_sum = db.Column(db.Float, nullable=False)
+    humidity_min = db.Column(db.Float, nullable=False)
+    humidity_max = db.Column(db.Float, nullable=False)
+
+
+class SensorRollup(RollupMixin, db.Model):
+    '''
+    ORM class to represent hourly and daily measurement statistics of a sensor
+    '''
+
+    sensor_id = db.Column(db.Integer,
+                          db.ForeignKey("sensor.id", ondelete="CASCADE"),
+                          primary_key=True)
+
+
+class LocationRollup(RollupMixin, db.Model):
+    '''
+    ORM class to represent hourly and daily measurement statistics of a location
+    '''
+
+    location_id = db.Column(db.Integer,
+                            db.ForeignKey("location.id", ondelete="CASCADE"),
+                            primary_key=True)
+
+
+class LatestMeasurement(db.Model):
+    '''
+    ORM class to represent the latest measurement of every sensor. Kept up
+    to date on insert so that the current reading is a primary key lookup.
+    '''
+
+    sensor_id = db.Column(db.Integer,
+                          db.ForeignKey("sensor.id", ondelete="CASCADE"),
+                          primary_key=True)
+    location_id = db.Column(db.Integer, db.ForeignKey("location.id", ondelete="SET NULL"))
+    temperature = db.Column(db.Float, nullable=False)
+    humidity = db.Column(db.Float, nullable=False)
+    timestamp = db.Column(db.DateTime, nullable=False)
+
+    sensor = db.relationship("Sensor")
+    location = db.relationship("Location")
+
+    def serialize(self):
+        '''
+        Serializes the LatestMeasurement class the same way as a Measurement
+        '''
+
+        return {
+            "temperature": self.temperature,
+            "humidity": self.humidity,
+            "timestamp": datetime.isoformat(self.timestamp),
+            "sensor": self.sensor.serialize(short_form=True),
+            "location": self.location and self.location.serialize(short_form=True),
+        }
+
+
+class Alarm(db.Model):
+    '''
+    ORM class to represent a threshold alarm of a sensor. An alarm is open
+    from the measurement that crossed the threshold until a measurement is
+    back inside the limits by the hysteresis margin.
+    '''
+
+    id = db.Column(db.Integer, primary_key=True)
+    sensor_id = db.Column(db.Integer, db.ForeignKey("sensor.id", ondelete="CASCADE"),
+                          nullable=False)
+    kind = db.Column(db.String(8), nullable=False)
+    threshold = db.Column(db.Float, nullable=False)
+    opened = db.Column(db.DateTime, nullable=False)
+    opened_value = db.Column(db.Float, nullable=False)
+    closed = db.Column(db.DateTime)
+    closed_value = db.Column(db.Float)
+
+    sensor = db.relationship("Sensor", back_populates="alarms")
+
+    __table_args__ = (
+        db.Index("ix_alarm_sensor_opened", "sensor_id", "opened"),
+        # Only open alarms are in this index, so finding them stays cheap
+        # however many closed ones pile up
+        db.Index("ix_alarm_open", "sensor_id", sqlite_where=db.text("closed IS NULL")),
+    )
+
+    def serialize(self, short_form=False):
+        '''
+        Serializes the Alarm class
+        '''
+
+        serial = {
+            "kind": self.kind,
+            "threshold": self.threshold,
+            "opened": datetime.isoformat(self.opened),
+            "opened_value": self.opened_value,
+            "closed": self.closed and datetime.isoformat(self.closed),
+            "closed_value": self.closed_value,
+        }
+        if not short_form:
+            serial["sensor"] = self.sensor.serialize(short_form=True)
+        return serial
+
+
+class MeasurementPartition(db.Model):
+    '''
+    ORM class to represent one month of archived measurements. The rows are
+    kept in their own table named after the partition. Detached partitions
+    are left out of queries.
+    '''
+
+    name = db.Column(db.String(32), primary_key=True)
+    start = db.Column(db.DateTime, nullable=False, unique=True)
+    end = db.Column(db.DateTime, nullable=False)
+    count = db.Column(db.Integer, nullable=False, default=0)
+    attached = db.Column(db.Boolean, nullable=False, default=True)
+
+
+class CacheGeneration(db.Model):
+    '''
+    ORM class to represent a counter that is increased whenever the rows
+    behind an in-memory cache change, so that every worker process can
+    tell when its copy is out of date
+    '''
+
+    name = db.Column(db.String(32), primary_key=True)
+    value = db.Column(db.Integer, nullable=False, default=0)
+
+
+class SensorConfiguration(ValidatorMixin, db.Model):
     '''
     ORM class to represent sensor configuration data
     '''
@@ -252,6 +532,20 @@ class SensorConfiguration(db.Model):
         self.threshold_max = json.get("threshold_max")
 
 
+def create_measurement_unique_index():
+    '''
+    Creates the unique index on measurement (sensor_id, timestamp) that
+    MEASUREMENT_DEDUPLICATE needs. It is not part of the models because
+    duplicates are allowed without it. Fails with IntegrityError if there
+    are duplicates already. Does not commit.
+    '''
+
+    db.session.execute(db.text(
+        "CREATE UNIQUE INDEX IF NOT EXISTS ux_measurement_sensor_timestamp "
+        "ON measurement (sensor_id, timestamp)"
+    ))
+
+
 @click.command("init-db")
 @with_appcontext
 def init_db_command():
@@ -259,3 +553,11 @@ def init_db_command():
     Callback function for 'init-db' CLI command
     '''
     db.create_all()
+    if current_app.config["MEASUREMENT_DEDUPLICATE"] is not None:
+        create_measurement_unique_index()
+        db.session.commit()
+
+
+# Compile the JSON schema validators at startup instead of on first request
+for _model in (Location, Sensor, Measurement, SensorConfiguration):
+    _model.get_validator()
@@ -0,0 +1,113 @@
+'''
+CSV export of full measurement histories. Rows are read as plain tuples
+from a streaming cursor and written out in chunks, so memory use doesn't
+depend on the number of rows.
+'''
+
+import csv
+import io
+from datetime import datetime
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import select, union_all
+
+from mokkiwahti import db
+from mokkiwahti.db_models import Location, Sensor
+from mokkiwahti.metrics import record_rows
+from mokkiwahti.partitions import measurement_tables
+
+CSV_COLUMNS = ("timestamp", "sensor", "location", "temperature", "humidity")
+EXPORT_BATCH_SIZE = 5000
+
+
+def export_query(key, value, start=None, end=None):
+    '''
+    Returns a Core select of (timestamp, sensor_id, location_id, temperature,
+    humidity, id) of measurements where key == value in time order. key is
+    either "sensor_id" or "location_id".
+
+    Every table is filtered on its own and the compound is ordered as a
+    whole, so SQLite merges the ordered index scans of the measurement table
+    and the partitions instead of sorting the whole history first.
+    '''
+
+    tables = measurement_tables(start, end)
+    selects = []
+    for table in tables:
+        query = (
+            select(table.c.timestamp,
+                   table.c.sensor_id,
+                   table.c.location_id,
+                   table.c.temperature,
+                   table.c.humidity,
+                   table.c.id)
+            .where(table.c[key] == value)
+        )
+        if start is not None:
+            query = query.where(table.c.timestamp >= start)
+        if end is not None:
+            query = query.where(table.c.timestamp < end)
+        selects.append(query)
+    if len(selects) == 1:
+        return selects[0].order_by(tables[0].c.timestamp, tables[0].c.id)
+    return union_all(*selects).order_by("timestamp", "id")
+
+
+def stream_csv(stmt, chunk_size=65536):
+    '''
+    Generator that runs an export_query stmt and yields the rows as CSV with
+    a header line, in chunks of roughly chunk_size characters
+    '''
+
+    # Few enough to keep in memory, unlike the measurements
+    sensors = dict(db.session.execute(select(Sensor.id, Sensor.name)).all())
+    locations = dict(db.session.execute(select(Location.id, Location.name)).all())
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    writer.writerow(CSV_COLUMNS)
+    result = db.session.execute(stmt.execution_options(yield_per=EXPORT_BATCH_SIZE))
+    for rows in result.partitions():
+        record_rows(len(rows))
+        writer.writerows(
+            (datetime.isoformat(timestamp), sensors.get(sensor_id),
+             locations.get(location_id), temperature, humidity)
+            for timestamp, sensor_id, location_id, temperature, humidity, _ in rows
+        )
+        if buffer.tell() >= chunk_size:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+@click.command("export-measurements")
+@click.option("--sensor", default=None, help="Name of the sensor to export")
+@click.option("--location", default=None, help="Name of the location to export")
+@click.option("--start", type=click.DateTime(), default=None,
+              help="Only measurements at or after this time")
+@click.option("--end", type=click.DateTime(), default=None,
+              help="Only measurements before this time")
+@click.option("--output", type=click.File("w"), default="-",
+              help="File to write to, defaults to standard output")
+@with_appcontext
+def export_measurements_command(sensor, location, start, end, output):
+    '''
+    Callback function for 'export-measurements' CLI command. Writes the
+    measurements of a sensor or a location as CSV.
+    '''
+
+    if (sensor is None) == (location is None):
+        raise click.UsageError("Give either --sensor or --location")
+    if sensor is not None:
+        owner = db.session.scalars(select(Sensor).where(Sensor.name == sensor)).first()
+        key = "sensor_id"
+    else:
+        owner = db.session.scalars(select(Location).where(Location.name == location)).first()
+        key = "location_id"
+    if owner is None:
+        raise click.ClickException(f"Not found: {sensor or location}")
+
+    for chunk in stream_csv(export_query(key, owner.id, start, end)):
+        output.write(chunk)
@@ -0,0 +1,525 @@
+'''
+Helpers for validating and storing measurements, one or many at a time
+'''
+
+import atexit
+import json
+import math
+import threading
+import time
+from concurrent.futures import Future
+from datetime import timedelta
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import bindparam, delete, func, insert, select, tuple_, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from mokkiwahti import db
+from mokkiwahti.alarms import alarm_engine
+from mokkiwahti.constants import ROLLUP_PERIODS
+from mokkiwahti.db_models import (Location, Measurement, Sensor,
+                                  create_measurement_unique_index, parse_timestamp)
+from mokkiwahti.latest import refresh_latest, update_latest
+from mokkiwahti.partitions import overlapping_partitions, partition_table
+from mokkiwahti.rollups import floor_timestamp, rebuild_measurement_rollups, update_rollups
+
+# What to do with a measurement whose sensor already has one at the same
+# timestamp: None stores both, "ignore" keeps the stored one and "update"
+# overwrites it
+DEDUPLICATE_MODES = (None, "ignore", "update")
+
+# Rows per SELECT when looking up existing measurements by key
+KEY_LOOKUP_BATCH = 400
+
+
+def parse_ndjson(data):
+    '''
+    Parses newline delimited JSON into a list of items.
+
+    Lines that are not valid JSON are returned as None so that they can be
+    reported with the correct index. Empty lines are skipped.
+    '''
+
+    items = []
+    for line in data.splitlines():
+        if not line.strip():
+            continue
+        try:
+            items.append(json.loads(line))
+        except ValueError:
+            items.append(None)
+    return items
+
+
+def validate_measurements(items):
+    '''
+    Validates a list of measurement objects in one pass. Items are first
+    checked with the fast path of Measurement and only the failing ones go
+    through the full JSON schema validator to get an error message.
+
+    Returns a tuple (valid, errors) where valid is a list of (index, item)
+    tuples and errors is a list of {"index", "error"} dicts
+    '''
+
+    validator = Measurement.get_validator()
+    valid = []
+    errors = []
+    for index, item in enumerate(items):
+        if Measurement.check(item):
+            valid.append((index, item))
+            continue
+        if item is None:
+            errors.append({"index": index, "error": "Item is not valid JSON"})
+            continue
+        error = next(validator.iter_errors(item), None)
+        if error is not None:
+            errors.append({"index": index, "error": error.message})
+            continue
+        # Passes the schema but a number is NaN or infinite, or the
+        # timestamp can't be parsed
+        for key in ("temperature", "humidity"):
+            if not math.isfinite(item[key]):
+                errors.append({"index": index, "error": f"{item[key]} is not a finite number"})
+                break
+        else:
+            errors.append({"index": index, "error": "Invalid timestamp"})
+    return valid, errors
+
+
+def measurement_row(item, sensor):
+    '''
+    Builds a row dict for insert from a validated measurement object
+    '''
+
+    return {
+        "sensor_id": sensor.id,
+        "location_id": sensor.location_id,
+        "temperature": item["temperature"],
+        "humidity": item["humidity"],
+        "timestamp": parse_timestamp(item["timestamp"]),
+    }
+
+
+def _key(row):
+    return row["sensor_id"], row["timestamp"]
+
+
+def _stored_measurements(keys):
+    '''
+    Returns {(sensor_id, timestamp): (id, location_id)} of the stored
+    measurements with the given keys
+    '''
+
+    keys = list(keys)
+    found = {}
+    for i in range(0, len(keys), KEY_LOOKUP_BATCH):
+        found.update(
+            ((sensor_id, timestamp), (row_id, location_id))
+            for row_id, sensor_id, timestamp, location_id in db.session.execute(
+                select(Measurement.id, Measurement.sensor_id, Measurement.timestamp,
+                       Measurement.location_id)
+                .where(tuple_(Measurement.sensor_id, Measurement.timestamp)
+                       .in_(keys[i:i + KEY_LOOKUP_BATCH]))
+            )
+        )
+    return found
+
+
+def archived_measurements(keys):
+    '''
+    Returns {(sensor_id, timestamp): id} of the measurements with the given
+    keys that have been archived into partitions, detached ones included.
+    The unique index only covers the measurement table, so
+    MEASUREMENT_DEDUPLICATE checks these separately.
+    '''
+
+    keys = list(keys)
+    if not keys:
+        return {}
+    timestamps = [timestamp for _, timestamp in keys]
+    partitions = overlapping_partitions(min(timestamps),
+                                        max(timestamps) + timedelta(microseconds=1),
+                                        include_detached=True)
+    found = {}
+    for partition in partitions:
+        table = partition_table(partition.name)
+        for i in range(0, len(keys), KEY_LOOKUP_BATCH):
+            found.update(
+                ((sensor_id, timestamp), row_id)
+                for row_id, sensor_id, timestamp in db.session.execute(
+                    select(table.c.id, table.c.sensor_id, table.c.timestamp)
+                    .where(tuple_(table.c.sensor_id, table.c.timestamp)
+                           .in_(keys[i:i + KEY_LOOKUP_BATCH]))
+                )
+            )
+    return found
+
+
+def _insert(rows, return_ids):
+    if not return_ids:
+        db.session.execute(insert(Measurement), rows)
+        return None
+    return db.session.execute(
+        insert(Measurement).returning(Measurement.id, sort_by_parameter_order=True),
+        rows
+    ).scalars().all()
+
+
+def _insert_new(rows):
+    '''
+    Inserts rows with ON CONFLICT DO NOTHING on (sensor_id, timestamp).
+    Returns {(sensor_id, timestamp): id} of the rows that got in.
+    '''
+
+    table = Measurement.__table__
+    stmt = (sqlite_insert(table)
+            .on_conflict_do_nothing(index_elements=["sensor_id", "timestamp"])
+            .returning(table.c.id, table.c.sensor_id, table.c.timestamp))
+    return {(sensor_id, timestamp): row_id
+            for row_id, sensor_id, timestamp in db.session.execute(stmt, rows)}
+
+
+def _insert_deduplicated(rows, return_ids):
+    '''
+    Inserts rows that are not stored yet, leaving out rows that match an
+    archived measurement. Returns a tuple (ids, duplicates) like
+    store_measurements.
+    '''
+
+    # Measurements without a sensor never conflict
+    unkeyed = [index for index, row in enumerate(rows) if row["sensor_id"] is None]
+    unkeyed_ids = []
+    if unkeyed:
+        unkeyed_ids = _insert([rows[index] for index in unkeyed], return_ids)
+    keyed = [row for row in rows if row["sensor_id"] is not None]
+    archived = archived_measurements({_key(row) for row in keyed})
+    keyed = [row for row in keyed if _key(row) not in archived]
+    inserted = _insert_new(keyed) if keyed else {}
+
+    # The first row of every inserted key is the one that got in
+    duplicates = []
+    seen = set()
+    for index, row in enumerate(rows):
+        if row["sensor_id"] is None:
+            continue
+        key = _key(row)
+        if key in inserted and key not in seen:
+            seen.add(key)
+        else:
+            duplicates.append(index)
+
+    ids = None
+    if return_ids:
+        stored = _stored_measurements({_key(rows[index]) for index in duplicates}
+                                      - inserted.keys() - archived.keys())
+        ids = [None if row["sensor_id"] is None
+               else inserted.get(_key(row)) or archived.get(_key(row)) or stored[_key(row)][0]
+               for row in rows]
+        for index, row_id in zip(unkeyed, unkeyed_ids):
+            ids[index] = row_id
+    return ids, duplicates
+
+
+def _overwrite_duplicates(rows, duplicates):
+    '''
+    Overwrites stored measurements with the duplicate rows and rebuilds the
+    rollup buckets they fall into. Archived measurements are kept as they
+    are. Call after the new rows have been added to the rollups. Returns a
+    tuple (overwritten, location ids) of the indexes of the rows that were
+    written and the ids of the locations the overwritten measurements were
+    in.
+    '''
+
+    stored = _stored_measurements({_key(rows[index]) for index in duplicates})
+    duplicates = [index for index in duplicates if _key(rows[index]) in stored]
+    if not duplicates:
+        return [], set()
+    table = Measurement.__table__
+    db.session.execute(
+        update(table)
+        .where(table.c.id == bindparam("measurement_id"))
+        .values(temperature=bindparam("new_temperature"),
+                humidity=bindparam("new_humidity"),
+                location_id=bindparam("new_location_id")),
+        [{"measurement_id": stored[_key(rows[index])][0],
+          "new_temperature": rows[index]["temperature"],
+          "new_humidity": rows[index]["humidity"],
+          "new_location_id": rows[index]["location_id"]} for index in duplicates]
+    )
+
+    # Minimum and maximum can't be updated incrementally, so the buckets of
+    # both the old and the new location are rebuilt, once per day
+    buckets = set()
+    for index in duplicates:
+        sensor_id, timestamp = _key(rows[index])
+        day = floor_timestamp(timestamp, ROLLUP_PERIODS[-1])
+        buckets.add((sensor_id, rows[index]["location_id"], day))
+        buckets.add((sensor_id, stored[sensor_id, timestamp][1], day))
+    rebuild_measurement_rollups(*(
+        {"sensor_id": sensor_id, "location_id": location_id, "timestamp": day}
+        for sensor_id, location_id, day in buckets
+    ))
+    return duplicates, {location_id for _, location_id in stored.values()}
+
+
+def store_measurements(rows, return_ids=False):
+    '''
+    Inserts measurement rows with a single executemany, updates the rollup
+    and latest measurement tables and measurement versions of sensors and
+    locations, checks the new rows for threshold alarms and commits once.
+
+    With MEASUREMENT_DEDUPLICATE set, a row whose sensor already has a
+    measurement at the same timestamp is not inserted, see
+    DEDUPLICATE_MODES. Archived measurements count too but are never
+    overwritten. This needs the unique index made by
+    create_measurement_unique_index.
+
+    Returns a tuple (ids, duplicates). If return_ids is True, ids are the
+    ids of the rows in the same order as the given rows, for duplicates the
+    id of the stored measurement. Otherwise ids is None. duplicates lists
+    the indexes of the rows that were deduplicated.
+    '''
+
+    mode = current_app.config["MEASUREMENT_DEDUPLICATE"]
+    if mode is None:
+        ids, duplicates = _insert(rows, return_ids), []
+    else:
+        ids, duplicates = _insert_deduplicated(rows, return_ids)
+    new_rows = rows
+    if duplicates:
+        skip = set(duplicates)
+        new_rows = [row for index, row in enumerate(rows) if index not in skip]
+
+    update_rollups(new_rows)
+    changed_rows = new_rows
+    old_locations = ()
+    if mode == "update" and duplicates:
+        overwritten, old_locations = _overwrite_duplicates(rows, duplicates)
+        changed_rows = new_rows + [rows[index] for index in overwritten]
+    update_latest(changed_rows)
+    Sensor.touch_measurements(row["sensor_id"] for row in changed_rows)
+    Location.touch_measurements([row["location_id"] for row in changed_rows]
+                                + list(old_locations))
+    alarms = alarm_engine()
+    alarm_states = alarms.evaluate(new_rows)
+    db.session.commit()
+    alarms.apply(alarm_states)
+    return ids, duplicates
+
+
+def ingest_measurements(rows, return_ids=False):
+    '''
+    Stores measurement rows, going through the write buffer if it is enabled.
+
+    Returns a tuple (ids, duplicates, durable), see store_measurements for
+    ids and duplicates. durable is False when the buffer acknowledges on
+    enqueue and the rows have not been written yet, in which case ids and
+    duplicates are None.
+    '''
+
+    buffer = current_app.extensions.get("measurement_buffer")
+    if buffer is None:
+        return *store_measurements(rows, return_ids=return_ids), True
+
+    future = buffer.submit(rows)
+    if buffer.ack == "enqueue":
+        return None, None, False
+    return *future.result(), True
+
+
+class WriteBuffer:
+    '''
+    Write-behind buffer for measurement inserts.
+
+    Collects rows from concurrent requests and flushes them from a background
+    thread as one transaction once `size` rows are pending or `interval`
+    milliseconds have passed since the oldest pending row was added.
+
+    ack decides when a request is acknowledged: "flush" waits until the rows
+    are committed, "enqueue" returns right away and rows that are still
+    pending are lost if the process dies.
+    '''
+
+    ACK_MODES = ("flush", "enqueue")
+
+    def __init__(self, app, size=500, interval=50, ack="flush"):
+        if ack not in self.ACK_MODES:
+            raise ValueError(f"Unknown acknowledgement mode: {ack}")
+        self.app = app
+        self.size = size
+        self.interval = interval / 1000
+        self.ack = ack
+        self._cond = threading.Condition()
+        self._pending = []
+        self._count = 0
+        self._oldest = None
+        self._closed = False
+        self._thread = threading.Thread(target=self._run,
+                                        name="measurement-write-buffer",
+                                        daemon=True)
+        self._thread.start()
+
+    def submit(self, rows):
+        '''
+        Adds rows to the buffer. Returns a Future that resolves to a tuple
+        (ids, duplicates) of the rows like store_measurements once they have
+        been flushed.
+        '''
+
+        future = Future()
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("Write buffer is closed")
+            if not self._pending:
+                self._oldest = time.monotonic()
+            self._pending.append((rows, future))
+            self._count += len(rows)
+            self._cond.notify()
+        return future
+
+    def close(self):
+        '''
+        Flushes everything that is still pending and stops the flush thread
+        '''
+
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+
+    def _take_batch(self):
+        with self._cond:
+            while not self._pending and not self._closed:
+                self._cond.wait()
+            while not self._closed and self._count < self.size:
+                remaining = self._oldest + self.interval - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            batch = self._pending
+            self._pending = []
+            self._count = 0
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._take_batch()
+            if batch:
+                self._flush(batch)
+            elif self._closed:
+                return
+
+    def _flush_one(self, rows, future):
+        try:
+            result = store_measurements(rows, return_ids=True)
+        except Exception as e: # pylint: disable=broad-exception-caught
+            db.session.rollback()
+            self.app.logger.exception("Flushing %d buffered measurements failed", len(rows))
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+
+    def _flush(self, batch):
+        rows = [row for batch_rows, _ in batch for row in batch_rows]
+        with self.app.app_context():
+            if len(batch) == 1:
+                self._flush_one(*batch[0])
+                return
+            try:
+                ids, duplicates = store_measurements(rows, return_ids=True)
+            except Exception: # pylint: disable=broad-exception-caught
+                db.session.rollback()
+                # Find the bad request instead of failing everyone with it
+                self.app.logger.warning("Flushing %d buffered measurements failed, "
+                                        "retrying one request at a time", len(rows))
+                for batch_rows, future in batch:
+                    self._flush_one(batch_rows, future)
+                return
+
+        start = 0
+        for batch_rows, future in batch:
+            end = start + len(batch_rows)
+            future.set_result((ids[start:end],
+                               [index - start for index in duplicates if start <= index < end]))
+            start = end
+
+
+def init_write_buffer(app):
+    '''
+    Starts the write buffer if MEASUREMENT_BUFFER is enabled in app config.
+    Raises ValueError for an unknown MEASUREMENT_DEDUPLICATE mode.
+    '''
+
+    if app.config["MEASUREMENT_DEDUPLICATE"] not in DEDUPLICATE_MODES:
+        raise ValueError(
+            f"Unknown deduplication mode: {app.config['MEASUREMENT_DEDUPLICATE']}"
+        )
+
+    if not app.config["MEASUREMENT_BUFFER"]:
+        return
+    buffer = WriteBuffer(app,
+                         size=app.config["MEASUREMENT_BUFFER_SIZE"],
+                         interval=app.config["MEASUREMENT_BUFFER_INTERVAL"],
+                         ack=app.config["MEASUREMENT_BUFFER_ACK"])
+    app.extensions["measurement_buffer"] = buffer
+    atexit.register(buffer.close)
+
+
+def delete_duplicates(keep="first"):
+    '''
+    Deletes all but one measurement of every (sensor_id, timestamp), keeping
+    the "first" or the "last" stored one, and rebuilds the rollup buckets
+    and latest measurements of the deleted ones. Does not commit. Returns
+    the number of deleted measurements.
+    '''
+
+    table = Measurement.__table__
+    pick = func.min if keep == "first" else func.max
+    kept = (select(pick(table.c.id))
+            .where(table.c.sensor_id.is_not(None))
+            .group_by(table.c.sensor_id, table.c.timestamp))
+    deleted = db.session.execute(
+        delete(table)
+        .where(table.c.sensor_id.is_not(None))
+        .where(table.c.id.not_in(kept))
+        .returning(table.c.sensor_id, table.c.location_id, table.c.timestamp)
+    ).all()
+    if not deleted:
+        return 0
+
+    # Only the days of the deleted rows, older rollups may have no raw rows
+    # left to be rebuilt from
+    buckets = {(sensor_id, location_id, floor_timestamp(timestamp, ROLLUP_PERIODS[-1]))
+               for sensor_id, location_id, timestamp in deleted}
+    rebuild_measurement_rollups(*(
+        {"sensor_id": sensor_id, "location_id": location_id, "timestamp": day}
+        for sensor_id, location_id, day in buckets
+    ))
+    sensor_ids = {sensor_id for sensor_id, _, _ in buckets}
+    location_ids = {location_id for _, location_id, _ in buckets}
+    refresh_latest(sensor_ids)
+    Sensor.touch_measurements(sensor_ids)
+    Location.touch_measurements(location_ids)
+    return len(deleted)
+
+
+@click.command("deduplicate-measurements")
+@click.option("--keep", type=click.Choice(["first", "last"]), default=None,
+              help="Which of the duplicates to keep. Defaults to the last one with "
+                   "MEASUREMENT_DEDUPLICATE 'update', otherwise the first one.")
+@with_appcontext
+def deduplicate_measurements_command(keep):
+    '''
+    Callback function for 'deduplicate-measurements' CLI command. Deletes
+    duplicate measurements and creates the unique index that
+    MEASUREMENT_DEDUPLICATE needs.
+    '''
+
+    if keep is None:
+        keep = "last" if current_app.config["MEASUREMENT_DEDUPLICATE"] == "update" else "first"
+    deleted = delete_duplicates(keep)
+    create_measurement_unique_index()
+    db.session.commit()
+    click.echo(f"Deleted {deleted} duplicate measurements")
@@ -0,0 +1,75 @@
+'''
+Maintenance of the latest measurement table
+'''
+
+from sqlalchemy import delete, insert, select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from mokkiwahti import db
+from mokkiwahti.db_models import LatestMeasurement
+from mokkiwahti.partitions import measurement_source
+
+LATEST_COLUMNS = ("sensor_id", "location_id", "temperature", "humidity", "timestamp")
+
+
+def update_latest(rows):
+    '''
+    Replaces the latest measurement of every sensor in rows if one of the
+    rows is newer. Late measurements don't replace newer ones.
+    Does not commit, call this in the same transaction as the insert.
+    '''
+
+    latest = {}
+    for row in rows:
+        sensor_id = row["sensor_id"]
+        if sensor_id is None:
+            continue
+        current = latest.get(sensor_id)
+        if current is None or row["timestamp"] >= current["timestamp"]:
+            latest[sensor_id] = row
+    if not latest:
+        return
+
+    table = LatestMeasurement.__table__
+    stmt = sqlite_insert(table).values(
+        [{column: row[column] for column in LATEST_COLUMNS} for row in latest.values()]
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["sensor_id"],
+        set_={column: stmt.excluded[column] for column in LATEST_COLUMNS[1:]},
+        where=stmt.excluded.timestamp >= table.c.timestamp,
+    )
+    db.session.execute(stmt)
+
+
+def refresh_latest(sensor_ids=None):
+    '''
+    Finds the latest measurement of sensors again from all measurements.
+    Used when measurements are modified or deleted. sensor_ids None means
+    all sensors. Does not commit.
+    '''
+
+    stmt = delete(LatestMeasurement)
+    if sensor_ids is not None:
+        sensor_ids = [sensor_id for sensor_id in set(sensor_ids) if sensor_id is not None]
+        if not sensor_ids:
+            return
+        stmt = stmt.where(LatestMeasurement.sensor_id.in_(sensor_ids))
+    db.session.execute(stmt)
+
+    source = measurement_source()
+    rank = (db.func.row_number()
+            .over(partition_by=source.sensor_id,
+                  order_by=(source.timestamp.desc(), source.id.desc()))
+            .label("rank"))
+    ranked = select(*(getattr(source, column) for column in LATEST_COLUMNS), rank)
+    ranked = ranked.where(source.sensor_id.is_not(None))
+    if sensor_ids is not None:
+        ranked = ranked.where(source.sensor_id.in_(sensor_ids))
+    ranked = ranked.subquery()
+    db.session.execute(
+        insert(LatestMeasurement).from_select(
+            LATEST_COLUMNS,
+            select(*(ranked.c[column] for column in LATEST_COLUMNS)).where(ranked.c.rank == 1)
+        )
+    )
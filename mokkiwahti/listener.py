@@ -0,0 +1,268 @@
+'''
+Line protocol listener for sensors that can't afford HTTP and JSON.
+
+Every line is one measurement:
+
+    sensor,temperature,humidity,timestamp
+
+The timestamp is ISO 8601 and may be left empty to use the time the line
+was received. Lines can be sent as UDP datagrams, one or more per datagram,
+or over a TCP connection. Nothing is sent back.
+
+Lines are parsed in the event loop and collected into batches that are
+stored from a worker thread with store_measurements, one batch at a time.
+Malformed lines, lines of unknown sensors and lines that arrive while too
+many are already pending are counted and dropped. So are duplicates when
+MEASUREMENT_DEDUPLICATE is set.
+'''
+
+import asyncio
+import signal
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from werkzeug.exceptions import NotFound
+
+from mokkiwahti import db
+from mokkiwahti.db_models import Measurement, Sensor, utcnow
+from mokkiwahti.ingest import measurement_row, store_measurements
+from mokkiwahti.utils import resolve_name
+
+# Longest accepted line in bytes
+MAX_LINE_LENGTH = 1024
+
+STAT_KEYS = ("received", "stored", "duplicate", "malformed", "unknown_sensor", "dropped",
+             "failed")
+
+
+def parse_line(line):
+    '''
+    Parses one line of the line protocol into a tuple (sensor name, item)
+    where item is a measurement object like the ones posted to the API.
+    Raises ValueError if the line is malformed.
+    '''
+
+    # Sensor names may contain commas, the other fields can't
+    name, temperature, humidity, timestamp = line.rsplit(",", 3)
+    item = {
+        "temperature": float(temperature),
+        "humidity": float(humidity),
+        "timestamp": timestamp.strip() or utcnow().isoformat(),
+    }
+    name = name.strip()
+    if not name or not Measurement.check(item):
+        raise ValueError(f"Invalid measurement: {line}")
+    return name, item
+
+
+class LineIngest:
+    '''
+    Collects parsed lines and stores them in batches of at most batch_size
+    rows, at the latest interval milliseconds after the previous batch.
+    '''
+
+    def __init__(self, app, batch_size=1000, interval=500, max_pending=100000):
+        self.app = app
+        self.batch_size = batch_size
+        self.interval = interval / 1000
+        self.max_pending = max_pending
+        self.stats = dict.fromkeys(STAT_KEYS, 0)
+        self._pending = []
+        self._full = asyncio.Event()
+
+    def feed(self, data):
+        '''
+        Parses the lines in data, bytes or str, and queues the valid ones
+        '''
+
+        if isinstance(data, bytes):
+            try:
+                data = data.decode()
+            except UnicodeDecodeError:
+                self.stats["received"] += 1
+                self.stats["malformed"] += 1
+                return
+        for line in data.splitlines():
+            if not line.strip():
+                continue
+            self.stats["received"] += 1
+            try:
+                parsed = parse_line(line)
+            except ValueError:
+                self.stats["malformed"] += 1
+                continue
+            if len(self._pending) >= self.max_pending:
+                self.stats["dropped"] += 1
+                continue
+            self._pending.append(parsed)
+            if len(self._pending) >= self.batch_size:
+                self._full.set()
+
+    def store(self, lines):
+        '''
+        Stores parsed lines in one transaction. Runs in a worker thread.
+        '''
+
+        with self.app.app_context():
+            sensors = {}
+            rows = []
+            for name, item in lines:
+                if name not in sensors:
+                    try:
+                        sensors[name] = resolve_name(Sensor, "sensor", name)
+                    except NotFound:
+                        sensors[name] = None
+                sensor = sensors[name]
+                if sensor is None:
+                    self.stats["unknown_sensor"] += 1
+                    continue
+                rows.append(measurement_row(item, sensor))
+            if not rows:
+                return
+            try:
+                _, duplicates = store_measurements(rows)
+            except Exception: # pylint: disable=broad-exception-caught
+                db.session.rollback()
+                self.app.logger.exception("Storing %d measurements failed", len(rows))
+                self.stats["failed"] += len(rows)
+                return
+        self.stats["stored"] += len(rows) - len(duplicates)
+        self.stats["duplicate"] += len(duplicates)
+
+    async def flush(self):
+        '''
+        Stores everything that is pending
+        '''
+
+        while self._pending:
+            batch = self._pending[:self.batch_size]
+            del self._pending[:self.batch_size]
+            await asyncio.get_running_loop().run_in_executor(None, self.store, batch)
+
+    async def run(self, stop):
+        '''
+        Stores batches until stop is set, then stores what is left
+        '''
+
+        while not stop.is_set():
+            try:
+                await asyncio.wait_for(self._full.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._full.clear()
+            await self.flush()
+        await self.flush()
+
+
+class _DatagramProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self, ingest):
+        self.ingest = ingest
+
+    def datagram_received(self, data, addr):
+        self.ingest.feed(data)
+
+
+def _stream_handler(ingest):
+    async def handle(reader, writer):
+        # True while reading the rest of a line that was too long
+        skipping = False
+        try:
+            while True:
+                try:
+                    line = await reader.readuntil(b"\n")
+                except asyncio.IncompleteReadError as e:
+                    # Connection closed, the last line may lack a newline
+                    if not skipping:
+                        ingest.feed(e.partial)
+                    break
+                except asyncio.LimitOverrunError as e:
+                    if not skipping:
+                        ingest.stats["received"] += 1
+                        ingest.stats["malformed"] += 1
+                        skipping = True
+                    await reader.readexactly(max(e.consumed, 1))
+                    continue
+                if skipping:
+                    skipping = False
+                    continue
+                ingest.feed(line)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+    return handle
+
+
+async def start_listeners(ingest, host, udp_port=None, tcp_port=None):
+    '''
+    Starts the UDP and TCP listeners that were given a port. Returns a list
+    of the started transports and servers, which all have close().
+    '''
+
+    loop = asyncio.get_running_loop()
+    listeners = []
+    if udp_port is not None:
+        transport, _ = await loop.create_datagram_endpoint(
+            lambda: _DatagramProtocol(ingest), local_addr=(host, udp_port)
+        )
+        listeners.append(transport)
+    if tcp_port is not None:
+        server = await asyncio.start_server(_stream_handler(ingest), host, tcp_port,
+                                            limit=MAX_LINE_LENGTH)
+        listeners.append(server)
+    return listeners
+
+
+async def serve(app, host, udp_port=None, tcp_port=None):
+    '''
+    Runs the listeners until SIGINT or SIGTERM, then stores pending lines.
+    Returns the stats of the LineIngest.
+    '''
+
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(signum, stop.set)
+        except NotImplementedError:
+            # Not available on Windows, KeyboardInterrupt still works
+            pass
+
+    ingest = LineIngest(app,
+                        batch_size=app.config["LISTENER_BATCH_SIZE"],
+                        interval=app.config["LISTENER_BATCH_INTERVAL"],
+                        max_pending=app.config["LISTENER_MAX_PENDING"])
+    listeners = await start_listeners(ingest, host, udp_port, tcp_port)
+    for listener in listeners:
+        sockets = getattr(listener, "sockets", None) or [listener.get_extra_info("socket")]
+        for sock in sockets:
+            app.logger.info("Listening on %s", sock.getsockname())
+    try:
+        await ingest.run(stop)
+    finally:
+        for listener in listeners:
+            listener.close()
+    return ingest.stats
+
+
+@click.command("listen")
+@click.option("--host", default="0.0.0.0", help="Address to listen on")
+@click.option("--udp-port", type=int, default=None, help="UDP port to listen on")
+@click.option("--tcp-port", type=int, default=None, help="TCP port to listen on")
+@with_appcontext
+def listen_command(host, udp_port, tcp_port):
+    '''
+    Callback function for 'listen' CLI command. Receives measurements in the
+    line protocol "sensor,temperature,humidity,timestamp" until stopped.
+    '''
+
+    if udp_port is None and tcp_port is None:
+        raise click.UsageError("Give --udp-port, --tcp-port or both")
+    app = current_app._get_current_object() # pylint: disable=protected-access
+    try:
+        stats = asyncio.run(serve(app, host, udp_port, tcp_port))
+    except OSError as e:
+        raise click.ClickException(str(e))
+    click.echo(", ".join(f"{key} {stats[key]}" for key in STAT_KEYS))
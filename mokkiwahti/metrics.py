@@ -0,0 +1,372 @@
+'''
+Request metrics of the API in Prometheus text format.
+
+Every request under /api gets a RequestStats object in its WSGI environ.
+SQL queries and serialized rows are counted into it while the request
+runs and it is recorded into the process wide Metrics registry when the
+response is closed, so streamed responses are measured to the end.
+
+With METRICS_DIR set, every worker process writes its registry into a file
+of its own in that directory at most every METRICS_FLUSH_INTERVAL seconds,
+and /api/metrics sums up all the files.
+'''
+
+import atexit
+import json
+import os
+import threading
+import time
+import uuid
+from collections import defaultdict
+
+from flask import current_app, has_request_context, request
+from sqlalchemy import event
+
+from mokkiwahti import db
+
+STATS_KEY = "mokkiwahti.metrics"
+QUERY_BUCKETS = (1, 2, 3, 5, 10, 20, 50, 100)
+
+# name: (type, help)
+METRICS = {
+    "mokkiwahti_http_request_duration_seconds":
+        ("histogram", "Time from receiving a request to sending the last byte"),
+    "mokkiwahti_http_responses_total":
+        ("counter", "Responses by status code"),
+    "mokkiwahti_sql_queries_per_request":
+        ("histogram", "SQL queries executed per request"),
+    "mokkiwahti_rows_serialized_total":
+        ("counter", "Rows serialized into response bodies"),
+    "mokkiwahti_response_bytes_total":
+        ("counter", "Bytes of response bodies as sent, after compression"),
+}
+
+
+class RequestStats:
+    '''
+    Counters of a single request
+    '''
+
+    __slots__ = ("start", "queries", "rows", "bytes")
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.queries = 0
+        self.rows = 0
+        self.bytes = 0
+
+
+class Metrics:
+    '''
+    Process wide registry of counters and histograms keyed by metric name
+    and a tuple of (label, value) pairs.
+    '''
+
+    def __init__(self, latency_buckets, directory=None, flush_interval=5):
+        self.buckets = {
+            "mokkiwahti_http_request_duration_seconds": tuple(latency_buckets),
+            "mokkiwahti_sql_queries_per_request": QUERY_BUCKETS,
+        }
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._pid = None
+        self._path = None
+        self._flushed = time.monotonic()
+        self._counters = None
+        self._histograms = None
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._path = None
+        if self.directory is not None:
+            self._path = os.path.join(self.directory,
+                                      f"metrics-{self._pid}-{uuid.uuid4().hex[:8]}.json")
+        self._flushed = time.monotonic()
+        self._counters = defaultdict(lambda: defaultdict(float))
+        # Per bucket counts, not cumulative, followed by sum and count
+        self._histograms = defaultdict(dict)
+
+    def _check_fork(self):
+        # A forked worker must not write into the file of its parent
+        if os.getpid() != self._pid:
+            self._reset()
+
+    def inc(self, name, labels, amount=1):
+        '''
+        Adds amount to a counter
+        '''
+
+        with self._lock:
+            self._check_fork()
+            self._counters[name][labels] += amount
+
+    def observe(self, name, labels, value):
+        '''
+        Adds an observation to a histogram
+        '''
+
+        buckets = self.buckets[name]
+        with self._lock:
+            self._check_fork()
+            series = self._histograms[name].get(labels)
+            if series is None:
+                series = self._histograms[name][labels] = [0] * (len(buckets) + 3)
+            index = len(buckets)
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    index = i
+                    break
+            series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def record(self, endpoint, method, status, stats):
+        '''
+        Records a finished request
+        '''
+
+        labels = (("endpoint", endpoint), ("method", method))
+        self.observe("mokkiwahti_http_request_duration_seconds", labels,
+                     time.perf_counter() - stats.start)
+        self.observe("mokkiwahti_sql_queries_per_request", labels, stats.queries)
+        self.inc("mokkiwahti_http_responses_total", labels + (("status", str(status)),))
+        self.inc("mokkiwahti_rows_serialized_total", labels, stats.rows)
+        self.inc("mokkiwahti_response_bytes_total", labels, stats.bytes)
+        if self._path is not None and time.monotonic() - self._flushed >= self.flush_interval:
+            self.flush()
+
+    def snapshot(self):
+        '''
+        Returns the registry of this process as JSON serializable dict
+        '''
+
+        with self._lock:
+            self._check_fork()
+            return {
+                "counters": {name: [[list(labels), value] for labels, value in series.items()]
+                             for name, series in self._counters.items()},
+                "histograms": {name: [[list(labels), list(values)]
+                                      for labels, values in series.items()]
+                               for name, series in self._histograms.items()},
+            }
+
+    def flush(self):
+        '''
+        Writes the registry of this process into its file in METRICS_DIR
+        '''
+
+        snapshot = self.snapshot()
+        tmp_path = f"{self._path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(snapshot, f)
+        os.replace(tmp_path, self._path)
+        self._flushed = time.monotonic()
+
+    def _read_snapshots(self):
+        '''
+        Reads the registries of all processes from METRICS_DIR. Files of
+        processes that have exited are removed, their counts drop out of the
+        sums.
+        '''
+
+        snapshots = []
+        for file_name in os.listdir(self.directory):
+            if not (file_name.startswith("metrics-") and file_name.endswith(".json")):
+                continue
+            path = os.path.join(self.directory, file_name)
+            if not _process_exists(file_name.split("-")[1]):
+                try:
+                    os.remove(path)
+                except OSError:
+                    # Removed by another worker
+                    pass
+                continue
+            try:
+                with open(path, encoding="utf-8") as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                # Removed or being replaced right now
+                continue
+        return snapshots
+
+    def collect(self):
+        '''
+        Returns the sum of the registries of all processes as a tuple
+        (counters, histograms) of {name: {labels: value}} dicts
+        '''
+
+        if self._path is None:
+            snapshots = [self.snapshot()]
+        else:
+            self.flush()
+            snapshots = self._read_snapshots()
+
+        counters = defaultdict(lambda: defaultdict(float))
+        histograms = defaultdict(dict)
+        for snapshot in snapshots:
+            for name, series in snapshot["counters"].items():
+                for labels, value in series:
+                    counters[name][tuple(map(tuple, labels))] += value
+            for name, series in snapshot["histograms"].items():
+                for labels, values in series:
+                    key = tuple(map(tuple, labels))
+                    total = histograms[name].get(key)
+                    if total is None:
+                        histograms[name][key] = list(values)
+                    else:
+                        histograms[name][key] = [a + b for a, b in zip(total, values)]
+        return counters, histograms
+
+    def render(self):
+        '''
+        Returns all metrics in Prometheus text exposition format
+        '''
+
+        counters, histograms = self.collect()
+        lines = []
+        for name, (kind, description) in METRICS.items():
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == "counter":
+                for labels, value in sorted(counters.get(name, {}).items()):
+                    lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+                continue
+            buckets = self.buckets[name]
+            for labels, values in sorted(histograms.get(name, {}).items()):
+                cumulative = 0
+                for bound, count in zip(buckets + ("+Inf",), values):
+                    cumulative += count
+                    le = bound if bound == "+Inf" else _format_value(bound)
+                    lines.append(f"{name}_bucket{_format_labels(labels + (('le', le),))} "
+                                 f"{cumulative}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(values[-2])}")
+                lines.append(f"{name}_count{_format_labels(labels)} {values[-1]}")
+        return "\n".join(lines) + "\n"
+
+
+def _process_exists(pid):
+    '''
+    Returns False if there is no process with the given pid, a string from
+    a metrics file name. Unknown pids count as existing.
+    '''
+
+    # Signal 0 only checks for the process on POSIX
+    if os.name != "posix" or not pid.isdigit():
+        return True
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # Exists but belongs to another user
+        return True
+    return True
+
+
+def _format_labels(labels):
+    pairs = ",".join(
+        '{}="{}"'.format(name, str(value).replace("\\", "\\\\")
+                                        .replace('"', '\\"')
+                                        .replace("\n", "\\n"))
+        for name, value in labels
+    )
+    return "{" + pairs + "}"
+
+
+def _format_value(value):
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def request_stats():
+    '''
+    Returns the RequestStats of the current request, or None outside of
+    requests and when metrics are disabled
+    '''
+
+    if not has_request_context():
+        return None
+    return request.environ.get(STATS_KEY)
+
+
+def record_rows(count):
+    '''
+    Counts rows serialized into the response of the current request
+    '''
+
+    stats = request_stats()
+    if stats is not None:
+        stats.rows += count
+
+
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+    # pylint: disable=unused-argument
+    stats = request_stats()
+    if stats is not None:
+        stats.queries += 1
+
+
+def _count_bytes(chunks, stats):
+    try:
+        for chunk in chunks:
+            stats.bytes += len(chunk) if isinstance(chunk, bytes) else len(chunk.encode())
+            yield chunk
+    finally:
+        close = getattr(chunks, "close", None)
+        if close is not None:
+            close()
+
+
+def record_response(response):
+    '''
+    after_app_request hook of the API blueprint. Records the request once
+    the response has been sent
+    '''
+
+    stats = request_stats()
+    if stats is None:
+        return response
+
+    metrics = current_app.extensions["metrics"]
+    endpoint = request.endpoint or "unmatched"
+    method = request.method
+    status = response.status_code
+    if response.is_streamed:
+        response.response = _count_bytes(response.response, stats)
+    else:
+        stats.bytes = response.content_length or 0
+    response.call_on_close(lambda: metrics.record(endpoint, method, status, stats))
+    return response
+
+
+def _middleware(wsgi_app, prefix):
+    def middleware(environ, start_response):
+        if environ.get("PATH_INFO", "").startswith(prefix):
+            environ[STATS_KEY] = RequestStats()
+        return wsgi_app(environ, start_response)
+    return middleware
+
+
+def init_metrics(app, prefix="/api"):
+    '''
+    Creates the metrics registry and starts counting requests under prefix
+    if METRICS is enabled in app config
+    '''
+
+    if not app.config["METRICS"]:
+        return
+    directory = app.config["METRICS_DIR"]
+    if directory is not None:
+        os.makedirs(directory, exist_ok=True)
+    metrics = Metrics(app.config["METRICS_LATENCY_BUCKETS"],
+                      directory=directory,
+                      flush_interval=app.config["METRICS_FLUSH_INTERVAL"])
+    app.extensions["metrics"] = metrics
+    app.wsgi_app = _middleware(app.wsgi_app, prefix)
+    with app.app_context():
+        event.listen(db.engine, "before_cursor_execute", _count_query)
+    if directory is not None:
+        atexit.register(metrics.flush)
@@ -0,0 +1,305 @@
+'''
+Monthly partitions of old measurements and the query router that reads
+from them.
+
+New measurements always go to the measurement table. Whole months can be
+archived into tables of their own, one per month, listed in the
+measurement_partition catalog. Readers get the tables overlapping the
+requested time range from measurement_source(). A partition can be
+detached to leave it out of queries or dropped with a single DROP TABLE.
+'''
+
+import threading
+from datetime import datetime
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import (Column, ForeignKey, Index, Table, and_, delete, func, insert,
+                        select, union_all)
+from sqlalchemy.orm import aliased
+
+from mokkiwahti import db
+from mokkiwahti.db_models import (LatestMeasurement, Location, Measurement,
+                                  MeasurementPartition, Sensor)
+
+_table_lock = threading.Lock()
+
+
+def month_start(timestamp):
+    '''
+    Returns the start of the month the timestamp is in
+    '''
+
+    return timestamp.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def next_month(start):
+    '''
+    Returns the start of the month after the one starting at `start`
+    '''
+
+    if start.month == 12:
+        return start.replace(year=start.year + 1, month=1)
+    return start.replace(month=start.month + 1)
+
+
+def partition_name(start):
+    '''
+    Returns the table name of the partition of the month starting at `start`
+    '''
+
+    return f"measurement_{start:%Y%m}"
+
+
+def partition_table(name):
+    '''
+    Returns the Table of a partition. Partition tables have the same columns
+    and indexes as the measurement table.
+    '''
+
+    with _table_lock:
+        table = db.metadata.tables.get(name)
+        if table is not None:
+            return table
+        columns = [
+            Column(column.name,
+                   column.type,
+                   *[ForeignKey(fk.target_fullname, ondelete=fk.ondelete)
+                     for fk in column.foreign_keys],
+                   primary_key=column.primary_key,
+                   nullable=column.nullable)
+            for column in Measurement.__table__.columns
+        ]
+        return Table(name, db.metadata, *columns,
+                     Index(f"ix_{name}_sensor_timestamp", "sensor_id", "timestamp"),
+                     Index(f"ix_{name}_location_timestamp", "location_id", "timestamp"))
+
+
+def overlapping_partitions(start=None, end=None, include_detached=False):
+    '''
+    Returns the partitions that have rows in the range [start, end) in
+    time order. None leaves that end of the range open.
+    '''
+
+    query = select(MeasurementPartition).order_by(MeasurementPartition.start)
+    if not include_detached:
+        query = query.where(MeasurementPartition.attached.is_(True))
+    if start is not None:
+        query = query.where(MeasurementPartition.end > start)
+    if end is not None:
+        query = query.where(MeasurementPartition.start < end)
+    return db.session.scalars(query).all()
+
+
+def measurement_tables(start=None, end=None, include_detached=False):
+    '''
+    Returns the measurement table and the tables of the partitions that have
+    rows in the range [start, end), for queries that read every table on
+    its own
+    '''
+
+    return [Measurement.__table__] + [
+        partition_table(partition.name)
+        for partition in overlapping_partitions(start, end, include_detached)
+    ]
+
+
+def measurement_source(start=None, end=None, include_detached=False):
+    '''
+    Returns the entity to read measurements in the range [start, end) from.
+
+    This is Measurement itself when no partition overlaps the range,
+    otherwise an alias of Measurement over the measurement table and the
+    overlapping partitions. Either way it is used like Measurement in ORM
+    and Core queries and yields Measurement objects.
+    '''
+
+    partitions = overlapping_partitions(start, end, include_detached)
+    if not partitions:
+        return Measurement
+    union = union_all(
+        select(Measurement.__table__),
+        *[select(partition_table(partition.name)) for partition in partitions]
+    )
+    return aliased(Measurement, union.subquery("measurement_partitions"))
+
+
+def _touch_all():
+    Sensor.touch_measurements(db.session.scalars(select(Sensor.id)))
+    Location.touch_measurements(db.session.scalars(select(Location.id)))
+
+
+def _get_partition(name):
+    partition = db.session.get(MeasurementPartition, name)
+    if partition is None:
+        raise ValueError(f"Unknown partition: {name}")
+    return partition
+
+
+def archive_month(start):
+    '''
+    Moves the measurements of the month starting at `start` from the
+    measurement table to its partition and commits. Can be run again for the
+    same month to move measurements that arrived late.
+    '''
+
+    name = partition_name(start)
+    partition = db.session.get(MeasurementPartition, name)
+    if partition is None:
+        partition = MeasurementPartition(name=name, start=start, end=next_month(start),
+                                         count=0, attached=True)
+        db.session.add(partition)
+    elif not partition.attached:
+        raise ValueError(f"Partition {name} is detached")
+
+    table = partition_table(name)
+    table.create(db.session.connection(), checkfirst=True)
+    source = Measurement.__table__
+    in_month = and_(source.c.timestamp >= partition.start, source.c.timestamp < partition.end)
+    db.session.execute(
+        insert(table).from_select(source.c.keys(), select(source).where(in_month))
+    )
+    partition.count += db.session.execute(delete(source).where(in_month)).rowcount
+    db.session.commit()
+    return partition
+
+
+def archive_measurements(before):
+    '''
+    Archives every whole month before `before` into monthly partitions.
+    Returns the partitions that got rows.
+    '''
+
+    before = month_start(before)
+    months = db.session.scalars(
+        select(func.strftime("%Y-%m", Measurement.timestamp))
+        .where(Measurement.timestamp < before)
+        .distinct()
+    ).all()
+    return [archive_month(datetime.strptime(month, "%Y-%m")) for month in sorted(months)]
+
+
+def detach_partition(name):
+    '''
+    Leaves a partition out of queries without touching its rows
+    '''
+
+    _get_partition(name).attached = False
+    _touch_all()
+    db.session.commit()
+
+
+def attach_partition(name):
+    '''
+    Includes a detached partition in queries again
+    '''
+
+    _get_partition(name).attached = True
+    _touch_all()
+    db.session.commit()
+
+
+def drop_partition(name):
+    '''
+    Deletes a partition and all of its measurements with one DROP TABLE.
+    Rollups of the month are kept.
+    '''
+
+    # latest.py reads through this module
+    from mokkiwahti.latest import refresh_latest
+
+    partition = _get_partition(name)
+    table = partition_table(name)
+    table.drop(db.session.connection(), checkfirst=True)
+    with _table_lock:
+        db.metadata.remove(table)
+    db.session.delete(partition)
+    db.session.flush()
+    refresh_latest(db.session.scalars(
+        select(LatestMeasurement.sensor_id)
+        .where(LatestMeasurement.timestamp >= partition.start)
+        .where(LatestMeasurement.timestamp < partition.end)
+    ).all())
+    _touch_all()
+    db.session.commit()
+
+
+@click.group("partitions")
+def partitions_cli():
+    '''
+    Manage monthly partitions of archived measurements
+    '''
+
+
+@partitions_cli.command("list")
+@with_appcontext
+def list_command():
+    '''
+    Lists partitions with their row counts
+    '''
+
+    for partition in overlapping_partitions(include_detached=True):
+        state = "attached" if partition.attached else "detached"
+        click.echo(f"{partition.name}\t{partition.start:%Y-%m}\t{partition.count}\t{state}")
+
+
+@partitions_cli.command("archive")
+@click.option("--before", type=click.DateTime(), required=True,
+              help="Archive whole months before this date")
+@with_appcontext
+def archive_command(before):
+    '''
+    Moves old measurements to monthly partitions
+    '''
+
+    try:
+        partitions = archive_measurements(before)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    for partition in partitions:
+        click.echo(f"{partition.name}\t{partition.count}")
+
+
+@partitions_cli.command("detach")
+@click.argument("name")
+@with_appcontext
+def detach_command(name):
+    '''
+    Leaves a partition out of queries
+    '''
+
+    try:
+        detach_partition(name)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    click.echo(f"Detached {name}")
+
+
+@partitions_cli.command("attach")
+@click.argument("name")
+@with_appcontext
+def attach_command(name):
+    '''
+    Includes a detached partition in queries again
+    '''
+
+    try:
+        attach_partition(name)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    click.echo(f"Attached {name}")
+
+
+@partitions_cli.command("drop")
+@click.argument("name")
+@with_appcontext
+def drop_command(name):
+    '''
+    Deletes a partition and its measurements
+    '''
+
+    try:
+        drop_partition(name)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    click.echo(f"Dropped {name}")
@@ -0,0 +1,134 @@
+'''
+Moving the measurement history of a sensor to another location.
+
+Measurements get the location of their sensor when they are stored, so
+linking a sensor somewhere else only affects new measurements. Relinking
+rewrites location_id of the measurements in a time range in batches of
+set-based UPDATEs, one transaction each, and then rebuilds the location
+rollups of the range.
+'''
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import and_, func, literal_column, select, update
+
+from mokkiwahti import db
+from mokkiwahti.db_models import Location, Measurement, Sensor
+from mokkiwahti.latest import refresh_latest
+from mokkiwahti.partitions import overlapping_partitions, partition_table
+from mokkiwahti.rollups import rebuild_rollups
+
+RELINK_BATCH_SIZE = 10000
+
+
+def relink_measurements(sensor, location, start=None, end=None,
+                        batch_size=RELINK_BATCH_SIZE, progress=None):
+    '''
+    Sets the location of the measurements of sensor in the range
+    [start, end) to location, None leaving them without one. Archived
+    measurements are included. Commits after every batch.
+
+    progress is called with the number of rows updated so far and the
+    total number of rows to update. Returns the number of updated rows.
+    '''
+
+    location_id = location.id if location is not None else None
+    tables = [Measurement.__table__] + [
+        partition_table(partition.name)
+        for partition in overlapping_partitions(start, end, include_detached=True)
+    ]
+
+    def condition(table):
+        where = and_(table.c.sensor_id == sensor.id,
+                     table.c.location_id.is_not(location_id))
+        if start is not None:
+            where &= table.c.timestamp >= start
+        if end is not None:
+            where &= table.c.timestamp < end
+        return where
+
+    old_locations = set()
+    total = 0
+    for table in tables:
+        for old_location, count in db.session.execute(
+            select(table.c.location_id, func.count())
+            .where(condition(table))
+            .group_by(table.c.location_id)
+        ):
+            old_locations.add(old_location)
+            total += count
+    if not total:
+        return 0
+
+    done = 0
+    if progress is not None:
+        progress(done, total)
+    rowid = literal_column("rowid")
+    for table in tables:
+        while True:
+            batch = select(rowid).select_from(table).where(condition(table)).limit(batch_size)
+            updated = db.session.execute(
+                update(table).where(rowid.in_(batch)).values(location_id=location_id)
+            ).rowcount
+            db.session.commit()
+            done += updated
+            if progress is not None and updated:
+                progress(done, total)
+            if updated < batch_size:
+                break
+
+    # Sensor rollups don't change, the sensor is the same
+    locations = {location_id} | old_locations
+    rebuild_rollups(start, end, sensor_ids=[],
+                    location_ids=[location for location in locations if location is not None])
+    refresh_latest([sensor.id])
+    Sensor.touch_measurements([sensor.id])
+    Location.touch_measurements(locations)
+    db.session.commit()
+    return done
+
+
+@click.command("relink-sensor")
+@click.argument("sensor")
+@click.argument("location", required=False)
+@click.option("--from", "start", type=click.DateTime(), required=True,
+              help="Move measurements at or after this time")
+@click.option("--to", "end", type=click.DateTime(), default=None,
+              help="Only move measurements before this time. Without it the sensor "
+                   "is also linked to the location.")
+@click.option("--batch-size", type=int, default=RELINK_BATCH_SIZE,
+              help="Rows updated per transaction")
+@with_appcontext
+def relink_sensor_command(sensor, location, start, end, batch_size):
+    '''
+    Callback function for 'relink-sensor' CLI command. Moves measurements of
+    a sensor to a location, or to no location if none is given.
+    '''
+
+    sensor_obj = db.session.scalars(select(Sensor).where(Sensor.name == sensor)).first()
+    if sensor_obj is None:
+        raise click.ClickException(f"Not found: {sensor}")
+    location_obj = None
+    if location is not None:
+        location_obj = db.session.scalars(
+            select(Location).where(Location.name == location)
+        ).first()
+        if location_obj is None:
+            raise click.ClickException(f"Not found: {location}")
+
+    if end is None and sensor_obj.location is not location_obj:
+        if sensor_obj.location is not None:
+            sensor_obj.location.touch()
+        sensor_obj.location = location_obj
+        if location_obj is not None:
+            location_obj.touch()
+        sensor_obj.touch()
+        db.session.commit()
+
+    with click.progressbar(length=0, label="Relinking measurements") as progressbar:
+        def progress(done, total):
+            progressbar.length = total
+            progressbar.update(done - progressbar.pos)
+        updated = relink_measurements(sensor_obj, location_obj, start, end,
+                                      batch_size=batch_size, progress=progress)
+    click.echo(f"Relinked {updated} measurements")
@@ -0,0 +1,46 @@
+'''
+API resources related to aggregated measurements
+'''
+
+import json
+
+from flask import request, Response
+from flask_restful import Resource
+
+from mokkiwahti.aggregation import aggregate
+from mokkiwahti.metrics import record_rows
+from mokkiwahti.utils import parse_bucket_arg, parse_timestamp_arg
+
+
+class MeasurementAggregate(Resource):
+    '''
+    MeasurementAggregate resource. Supports GET method
+    '''
+
+    def get(self, location=None, sensor=None):
+        '''
+        Returns min/avg/max of temperature and humidity by location or sensor
+        in time buckets. Hourly and daily multiples with aligned from/to are
+        served from the rollup tables.
+
+        Query parameters:
+        bucket - bucket size, e.g. 5m, 1h or 1d. Defaults to 1h
+        from - only measurements at or after this ISO 8601 timestamp
+        to - only measurements before this ISO 8601 timestamp
+
+        Responses:
+        200 - OK
+        400 - Bad request
+        '''
+
+        bucket = parse_bucket_arg(request.args)
+        start = parse_timestamp_arg(request.args, "from")
+        end = parse_timestamp_arg(request.args, "to")
+
+        if location is not None:
+            buckets = aggregate("location_id", location.id, bucket, start, end)
+        else:
+            buckets = aggregate("sensor_id", sensor.id, bucket, start, end)
+
+        record_rows(len(buckets))
+        return Response(json.dumps(buckets), 200, mimetype='application/json')
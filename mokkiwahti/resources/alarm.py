@@ -0,0 +1,58 @@
+'''
+API resources related to threshold alarms
+'''
+
+import json
+
+from flask import request, Response
+from flask_restful import Resource
+from sqlalchemy.orm import joinedload
+from werkzeug.exceptions import BadRequest
+
+from mokkiwahti.db_models import Alarm
+from mokkiwahti.metrics import record_rows
+from mokkiwahti.utils import parse_limit_arg
+
+ALARM_PAGE_SIZE = 100
+ALARM_PAGE_SIZE_MAX = 1000
+
+
+class AlarmCollection(Resource):
+    '''
+    AlarmCollection resource. Supports GET method
+    '''
+
+    def get(self, sensor=None):
+        '''
+        Returns alarms of a sensor, or of all sensors, latest first.
+        Open alarms are found with a single lookup from an index that only
+        holds open alarms.
+
+        Query parameters:
+        state - "open" or "closed", both by default
+        limit - number of alarms to return, defaults to 100
+
+        Responses:
+        200 - OK
+        400 - Bad request
+        '''
+
+        state = request.args.get("state")
+        if state not in (None, "open", "closed"):
+            raise BadRequest(description=f"Invalid state: {state}")
+        limit = parse_limit_arg(request.args, ALARM_PAGE_SIZE, ALARM_PAGE_SIZE_MAX)
+
+        query = Alarm.query
+        if sensor is not None:
+            query = query.filter(Alarm.sensor_id == sensor.id)
+        else:
+            query = query.options(joinedload(Alarm.sensor))
+        if state == "open":
+            query = query.filter(Alarm.closed.is_(None))
+        elif state == "closed":
+            query = query.filter(Alarm.closed.is_not(None))
+        alarms = query.order_by(Alarm.opened.desc(), Alarm.id.desc()).limit(limit).all()
+
+        record_rows(len(alarms))
+        body = [alarm.serialize(short_form=sensor is not None) for alarm in alarms]
+        return Response(json.dumps(body), 200, mimetype='application/json')
@@ -0,0 +1,51 @@
+'''
+API resources related to CSV export of measurements
+'''
+
+from flask import request, Response, stream_with_context
+from flask_restful import Resource
+
+from mokkiwahti.export import export_query, stream_csv
+from mokkiwahti.utils import add_validators, make_etag, not_modified, parse_timestamp_arg
+
+
+class MeasurementExport(Resource):
+    '''
+    MeasurementExport resource. Supports GET method
+    '''
+
+    def get(self, location=None, sensor=None):
+        '''
+        Returns all measurements by location or sensor as CSV in time order,
+        streamed without paging.
+
+        Query parameters:
+        from - only measurements at or after this ISO 8601 timestamp
+        to - only measurements before this ISO 8601 timestamp
+
+        Responses:
+        200 - OK
+        304 - Not modified
+        400 - Bad request
+        '''
+
+        start = parse_timestamp_arg(request.args, "from")
+        end = parse_timestamp_arg(request.args, "to")
+
+        owner = location if location is not None else sensor
+        etag = make_etag("measurements.csv", type(owner).__name__, owner.id,
+                         owner.measurements_version)
+        response = not_modified(etag, owner.measurements_modified)
+        if response is not None:
+            return response
+
+        if location is not None:
+            stmt = export_query("location_id", location.id, start, end)
+        else:
+            stmt = export_query("sensor_id", sensor.id, start, end)
+
+        response = Response(stream_with_context(stream_csv(stmt)), 200, mimetype="text/csv",
+                            headers={
+                                "Content-Disposition": f'attachment; filename="{owner.name}.csv"'
+                            })
+        return add_validators(response, etag, owner.measurements_modified)
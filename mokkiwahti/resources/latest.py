@@ -0,0 +1,77 @@
+'''
+API resources related to the latest measurements
+'''
+
+import json
+
+from flask import Response
+from flask_restful import Resource
+from sqlalchemy.orm import joinedload
+from werkzeug.exceptions import NotFound
+
+from mokkiwahti import db
+from mokkiwahti.db_models import LatestMeasurement, Sensor
+from mokkiwahti.utils import add_validators, make_etag, not_modified
+
+
+class SensorLatest(Resource):
+    '''
+    SensorLatest resource. Supports GET method
+    '''
+
+    def get(self, sensor):
+        '''
+        Returns the latest measurement of a sensor with a primary key lookup,
+        however long the history of the sensor is
+
+        Responses:
+        200 - OK
+        304 - Not modified
+        404 - Sensor not found or it has no measurements
+        '''
+
+        etag = make_etag("latest", "Sensor", sensor.id, sensor.measurements_version)
+        response = not_modified(etag, sensor.measurements_modified)
+        if response is not None:
+            return response
+
+        latest = db.session.get(LatestMeasurement, sensor.id,
+                                options=(joinedload(LatestMeasurement.location),))
+        if latest is None:
+            raise NotFound(description="Sensor has no measurements")
+        response = Response(json.dumps(latest.serialize()), 200, mimetype='application/json')
+        return add_validators(response, etag, sensor.measurements_modified)
+
+
+class LocationLatest(Resource):
+    '''
+    LocationLatest resource. Supports GET method
+    '''
+
+    def get(self, location):
+        '''
+        Returns the latest measurement of every sensor in a location, ordered
+        by sensor name. Sensors without measurements are left out.
+
+        Responses:
+        200 - OK
+        304 - Not modified
+        '''
+
+        etag = make_etag("latest", "Location", location.id, location.version,
+                         location.measurements_version)
+        last_modified = max(location.modified, location.measurements_modified)
+        response = not_modified(etag, last_modified)
+        if response is not None:
+            return response
+
+        latest = (LatestMeasurement.query
+                  .join(Sensor, Sensor.id == LatestMeasurement.sensor_id)
+                  .filter(Sensor.location_id == location.id)
+                  .options(joinedload(LatestMeasurement.sensor),
+                           joinedload(LatestMeasurement.location))
+                  .order_by(Sensor.name)
+                  .all())
+        body = [measurement.serialize() for measurement in latest]
+        response = Response(json.dumps(body), 200, mimetype='application/json')
+        return add_validators(response, etag, last_modified)
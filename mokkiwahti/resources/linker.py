@@ -2,10 +2,12 @@
 API resources related to LocationSensorLinker
 '''
 
-from flask import Response
+from flask import request, Response
 from flask_restful import Resource
 
 from mokkiwahti import db
+from mokkiwahti.relink import relink_measurements
+from mokkiwahti.utils import parse_timestamp_arg
 
 
 class LocationSensorLinker(Resource):
@@ -17,21 +19,41 @@ class LocationSensorLinker(Resource):
         '''
         Links Locations and Sensors.
 
+        Query parameters:
+        from - also move measurements of the sensor at or after this ISO 8601
+               timestamp to the location
+
         Returns Response object with status code 200
         '''
 
+        start = parse_timestamp_arg(request.args, "from")
+        if sensor.location is not None:
+            sensor.location.touch()
         location.sensors.append(sensor)
+        location.touch()
+        sensor.touch()
         db.session.commit()
+        if start is not None:
+            relink_measurements(sensor, location, start)
         return Response(status=200)
 
     def delete(self, sensor, location):
         '''
         Deletes the link between Location and Sensor.
 
+        Query parameters:
+        from - also remove the location from measurements of the sensor at
+               or after this ISO 8601 timestamp
+
         Returns Response object with satus code 200
         '''
 
+        start = parse_timestamp_arg(request.args, "from")
         location.sensors.remove(sensor)
+        location.touch()
+        sensor.touch()
         db.session.commit()
+        if start is not None:
+            relink_measurements(sensor, None, start)
 
         return Response(status=200)
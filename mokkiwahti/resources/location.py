@@ -3,16 +3,96 @@ API resources related to Locations
 '''
 
 import json
+from collections import defaultdict
 
-from flask import request, Response, url_for
+from flask import request, Response, stream_with_context, url_for
 from flask_restful import Resource
-from jsonschema import validate, ValidationError
+from jsonschema import ValidationError
+from sqlalchemy import func, select
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import aliased, selectinload
 from werkzeug.exceptions import Conflict, BadRequest, UnsupportedMediaType
 
-from mokkiwahti.db_models import Location
+from mokkiwahti.db_models import Location, Measurement, Sensor
+from mokkiwahti.partitions import measurement_source
+from mokkiwahti.utils import (STREAM_BATCH_SIZE, add_validators, make_etag,
+                              not_modified, parse_expand_arg, parse_fields_arg, select_fields,
+                              stream_json_array)
 from mokkiwahti import db
 
+def _parse_representation():
+    '''
+    Returns the requested fields and relations to embed. Relations left out
+    by fields are not expanded either.
+    '''
+
+    fields = parse_fields_arg(request.args)
+    expand = parse_expand_arg(request.args, ("sensors", "measurements"), ("sensors",))
+    if fields is not None:
+        expand = {name: count for name, count in expand.items() if name in fields}
+    return fields, expand
+
+def _location_measurements(source, location_ids, count=None):
+    '''
+    Loads the measurements of every given location in one query from
+    source, see measurement_source(). With count only the latest `count` of
+    each location are loaded. Returns a dict mapping location id to its
+    measurements in time order
+    '''
+
+    query = select(source).where(source.location_id.in_(location_ids))
+    if count is not None:
+        rank = (func.row_number()
+                .over(partition_by=source.location_id,
+                      order_by=(source.timestamp.desc(), source.id.desc()))
+                .label("rank"))
+        ranked = query.add_columns(rank).subquery()
+        source = aliased(Measurement, ranked)
+        query = select(source).where(ranked.c.rank <= count)
+    query = query.order_by(source.timestamp, source.id)
+
+    measurements = defaultdict(list)
+    for measurement in db.session.scalars(query):
+        measurements[measurement.location_id].append(measurement)
+    return measurements
+
+def _serialize_locations(fields, expand):
+    '''
+    Generator that serializes all locations batch by batch. Each relation is
+    loaded with one query per batch.
+    '''
+
+    stmt = select(Location).execution_options(yield_per=STREAM_BATCH_SIZE)
+    if "sensors" in expand:
+        stmt = stmt.options(selectinload(Location.sensors))
+    # Archived measurements are read from their partitions too
+    source = measurement_source() if "measurements" in expand else None
+
+    for locations in db.session.scalars(stmt).partitions():
+        measurements = {}
+        if source is not None:
+            measurements = _location_measurements(source,
+                                                  [location.id for location in locations],
+                                                  expand["measurements"])
+        for location in locations:
+            serial = location.serialize(expand=expand,
+                                        measurements=measurements.get(location.id, []))
+            yield select_fields(serial, fields)
+
+def _touch_name_references(location):
+    '''
+    Marks everything that shows the location name changed: its sensors and
+    all measurements made in the location
+    '''
+
+    for sensor in location.sensors:
+        sensor.touch()
+    Location.touch_measurements([location.id])
+    source = measurement_source()
+    Sensor.touch_measurements(db.session.scalars(
+        select(source.sensor_id).where(source.location_id == location.id).distinct()
+    ))
+
 class LocationCollection(Resource):
     '''
     LocationCollection resource. Supports GET and POST methods
@@ -20,17 +100,23 @@ class LocationCollection(Resource):
 
     def get(self):
         '''
-        Returns all locations as a HTTP Response that contains JSON object
+        Returns all locations as a HTTP Response that contains JSON object.
+
+        Query parameters:
+        fields - comma separated list of fields to include, e.g. fields=name
+        expand - comma separated list of relations to embed. Defaults to
+                 sensors. Measurements can be limited to the latest ones
+                 with e.g. expand=sensors,measurements:latest:10
 
         Responses:
         200 - OK
+        400 - Bad request
         '''
 
-        locations = []
-        for location in Location.query.all():
-            locations.append(location.serialize())
-
-        return Response(json.dumps(locations), 200, mimetype='application/json')
+        fields, expand = _parse_representation()
+        locations = _serialize_locations(fields, expand)
+        return Response(stream_with_context(stream_json_array(locations)), 200,
+                        mimetype='application/json')
 
     def post(self):
         '''
@@ -51,7 +137,7 @@ class LocationCollection(Resource):
             raise UnsupportedMediaType
 
         try:
-            validate(request.json, Location.get_schema())
+            Location.get_validator().validate(request.json)
         except ValidationError as e:
             raise BadRequest(description=str(e)) from e
 
@@ -78,11 +164,36 @@ class LocationItem(Resource):
         '''
         Returns a Response containing a specific location item
 
+        Takes the same fields and expand query parameters as LocationCollection
+
+        Supports conditional requests with If-None-Match and
+        If-Modified-Since.
+
         Responses:
         200 - OK
+        304 - Not modified
+        400 - Bad request
         '''
 
-        return Response(json.dumps(location.serialize()), 200, mimetype='application/json')
+        fields, expand = _parse_representation()
+        versions = ["location", location.id, location.version]
+        last_modified = location.modified
+        if "measurements" in expand:
+            versions.append(location.measurements_version)
+            last_modified = max(last_modified, location.measurements_modified)
+        etag = make_etag(*versions)
+        response = not_modified(etag, last_modified)
+        if response is not None:
+            return response
+
+        measurements = None
+        if "measurements" in expand:
+            measurements = _location_measurements(measurement_source(), [location.id],
+                                                  expand["measurements"]).get(location.id, [])
+        serial = location.serialize(expand=expand, measurements=measurements)
+        response = Response(json.dumps(select_fields(serial, fields)), 200,
+                            mimetype='application/json')
+        return add_validators(response, etag, last_modified)
 
     def put(self, location):
         '''
@@ -100,11 +211,15 @@ class LocationItem(Resource):
         if not request.json:
             raise UnsupportedMediaType
         try:
-            validate(request.json, Location.get_schema())
+            Location.get_validator().validate(request.json)
         except ValidationError as e:
             raise BadRequest(description=str(e)) from e
 
+        old_name = location.name
         location.deserialize(request.json)
+        location.touch()
+        if location.name != old_name:
+            _touch_name_references(location)
         db.session.commit()
 
         return Response(status=200, headers={
@@ -122,6 +237,7 @@ class LocationItem(Resource):
         200 - OK
         '''
 
+        _touch_name_references(location)
         db.session.delete(location)
         db.session.commit()
         return Response(
@@ -3,14 +3,163 @@ API resources related to measurements
 '''
 
 import json
-from flask import request, Response, url_for
+from flask import current_app, request, Response, stream_with_context, url_for
 from flask_restful import Resource
-from jsonschema import validate, ValidationError, Draft7Validator
+from sqlalchemy import desc, literal, select, tuple_, union_all
+from sqlalchemy.exc import IntegrityError
+from werkzeug.exceptions import BadRequest, Conflict, UnsupportedMediaType
+
+from mokkiwahti.db_models import Location, Measurement, Sensor
+from mokkiwahti.ingest import (archived_measurements, parse_ndjson, validate_measurements,
+                               measurement_row, ingest_measurements)
+from mokkiwahti.latest import refresh_latest
+from mokkiwahti.partitions import measurement_tables
+from mokkiwahti.rollups import rebuild_measurement_rollups
+from mokkiwahti.utils import (STREAM_BATCH_SIZE, add_validators, decode_cursor,
+                              encode_cursor, make_etag, measurement_row_encoder, not_modified,
+                              parse_limit_arg, parse_timestamp_arg, stream_json_array)
+from mokkiwahti import db
 
-from werkzeug.exceptions import BadRequest, UnsupportedMediaType
+DUPLICATE_TIMESTAMP = "Sensor already has a measurement at this timestamp"
 
-from mokkiwahti.db_models import Measurement, Location, Sensor
-from mokkiwahti import db
+def _ordered(tables, columns, where, descending=False):
+    '''
+    Returns a select of columns(table) from every table where where(table)
+    holds, in (timestamp, id) order. columns must include the timestamp and
+    id columns under those names.
+
+    Every table is filtered on its own and the compound is ordered as a
+    whole, so SQLite merges the ordered index scans of the measurement table
+    and the partitions instead of sorting them, see export_query().
+    '''
+
+    selects = [select(*columns(table)).where(*where(table)) for table in tables]
+    stmt = selects[0] if len(selects) == 1 else union_all(*selects)
+    if descending:
+        return stmt.order_by(desc("timestamp"), desc("id"))
+    return stmt.order_by("timestamp", "id")
+
+def _page_keys(tables, where, cursor, limit):
+    '''
+    Fetches the (timestamp, id) keys of the page cursor points to, the first
+    page without one. Returns a tuple (keys, more_next, more_prev) with the
+    keys in time order.
+    '''
+
+    direction = "next"
+    bound = None
+    if cursor is not None:
+        timestamp, row_id, direction = decode_cursor(cursor)
+        bound = tuple_(literal(timestamp), literal(row_id))
+
+    def keys_where(table):
+        clauses = where(table)
+        if bound is not None:
+            key = tuple_(table.c.timestamp, table.c.id)
+            clauses.append(key > bound if direction == "next" else key < bound)
+        return clauses
+
+    # Fetch one extra key to find out if there is another page
+    keys = db.session.execute(
+        _ordered(tables, lambda table: (table.c.timestamp, table.c.id), keys_where,
+                 descending=direction == "prev")
+        .limit(limit + 1)
+    ).all()
+    has_more = len(keys) > limit
+    keys = keys[:limit]
+
+    # A cursor always points next to an existing row, so the page we came
+    # from exists
+    if direction == "prev":
+        keys.reverse()
+        return keys, True, has_more
+    return keys, has_more, cursor is not None
+
+def _paginate(tables, where, columns, cursor, limit):
+    '''
+    Applies keyset pagination on (timestamp, id) to the measurements of
+    tables, see measurement_tables(), where where(table) holds.
+
+    Only the (timestamp, id) keys of the page are fetched here. Returns a
+    tuple (page, links) where page is a select of columns(table) narrowed
+    down to the rows of the requested page in time order, or None if the
+    page is empty, and links maps "next" and "prev" to page URLs when there
+    are more measurements in that direction.
+    '''
+
+    keys, more_next, more_prev = _page_keys(tables, where, cursor, limit)
+    if not keys:
+        return None, {}
+
+    first, last = keys[0], keys[-1]
+    links = {}
+    if more_next:
+        links["next"] = _page_url(encode_cursor(*last, "next"))
+    if more_prev:
+        links["prev"] = _page_url(encode_cursor(*first, "prev"))
+
+    def page_where(table):
+        key = tuple_(table.c.timestamp, table.c.id)
+        return where(table) + [key >= tuple_(literal(first[0]), literal(first[1])),
+                               key <= tuple_(literal(last[0]), literal(last[1]))]
+
+    return _ordered(tables, columns, page_where), links
+
+def _owner_filter(column, owner_id, start, end):
+    '''
+    Returns a function that gives the where clauses of the measurements of
+    a sensor or location in [start, end) for a measurement table. column is
+    either "sensor_id" or "location_id", start and end may be None.
+    '''
+
+    def where(table):
+        clauses = [table.c[column] == owner_id]
+        if start is not None:
+            clauses.append(table.c.timestamp >= start)
+        if end is not None:
+            clauses.append(table.c.timestamp < end)
+        return clauses
+    return where
+
+def _row_columns(table):
+    '''
+    Columns of a measurement row for measurement_row_encoder(). The names
+    are looked up by primary key for every row instead of joined, so the
+    rows stay in index order.
+    '''
+
+    return (table.c.temperature, table.c.humidity, table.c.timestamp,
+            select(Sensor.name).where(Sensor.id == table.c.sensor_id)
+            .scalar_subquery().label("sensor"),
+            select(Location.name).where(Location.id == table.c.location_id)
+            .scalar_subquery().label("location"),
+            table.c.id)
+
+def _page_url(cursor):
+    args = request.args.to_dict()
+    args["cursor"] = cursor
+    return url_for(request.endpoint, **request.view_args, **args)
+
+def _rollup_keys(measurement):
+    return {
+        "sensor_id": measurement.sensor_id,
+        "location_id": measurement.location_id,
+        "timestamp": measurement.timestamp,
+    }
+
+def _check_not_archived(measurement):
+    '''
+    Raises Conflict if the measurement has been moved to a partition,
+    archived measurements can only be read
+    '''
+
+    stored = db.session.scalar(select(Measurement.id).where(Measurement.id == measurement.id))
+    if stored is None:
+        raise Conflict(description="Archived measurements can't be changed")
+
+def _touch_measurements(*keys):
+    Sensor.touch_measurements(key["sensor_id"] for key in keys)
+    Location.touch_measurements(key["location_id"] for key in keys)
 
 class MeasurementCollection(Resource):
     '''
@@ -19,75 +168,137 @@ class MeasurementCollection(Resource):
 
     def get(self, location=None, sensor=None):
         '''
-        Returns specific measurement by location or sensor.
+        Returns measurements by location or sensor in time order.
+
+        Query parameters:
+        from - only measurements at or after this ISO 8601 timestamp
+        to - only measurements before this ISO 8601 timestamp
+        limit - page size, defaults to MEASUREMENT_PAGE_SIZE
+        cursor - opaque page cursor taken from the Link header
+
+        Links to the next and previous pages are given in the Link header.
+
+        Supports conditional requests with If-None-Match and
+        If-Modified-Since, answered without querying measurements.
 
         Responses:
         200 - OK
+        304 - Not modified
+        400 - Bad request
         '''
 
-        measurements = []
+        limit = parse_limit_arg(request.args,
+                                current_app.config["MEASUREMENT_PAGE_SIZE"],
+                                current_app.config["MEASUREMENT_PAGE_SIZE_MAX"])
+        start = parse_timestamp_arg(request.args, "from")
+        end = parse_timestamp_arg(request.args, "to")
+
+        owner = location if location is not None else sensor
+        etag = make_etag("measurements", type(owner).__name__, owner.id,
+                         owner.measurements_version)
+        response = not_modified(etag, owner.measurements_modified)
+        if response is not None:
+            return response
+
+        # Only partitions overlapping the requested range are read
+        tables = measurement_tables(start, end)
+
         # Check if measurements are querried by location or by sensor
         if location is not None:
-            measurements_db = (Measurement
-                               .query
-                               .join(Location)
-                               .filter(Location.name == location.name)
-                               .all())
-        elif sensor is not None:
-            measurements_db = (Measurement
-                               .query
-                               .join(Sensor)
-                               .filter(Sensor.name == sensor.name)
-                               .all())
-        for measurement in measurements_db:
-            measurements.append(measurement.serialize())
-
-        return Response(json.dumps(measurements), 200, mimetype='application/json')
-
+            where = _owner_filter("location_id", location.id, start, end)
+        else:
+            where = _owner_filter("sensor_id", sensor.id, start, end)
+
+        page, links = _paginate(tables, where, _row_columns, request.args.get("cursor"), limit)
+        rows = ()
+        if page is not None:
+            # Plain tuples with the names looked up, encoded straight to JSON
+            rows = db.session.execute(page.execution_options(yield_per=STREAM_BATCH_SIZE))
+
+        headers = {}
+        if links:
+            headers["Link"] = ", ".join(f'<{url}>; rel="{rel}"' for rel, url in links.items())
+        response = Response(stream_with_context(
+                                stream_json_array(rows, encode=measurement_row_encoder())
+                            ), 200,
+                            headers=headers, mimetype='application/json')
+        return add_validators(response, etag, owner.measurements_modified)
 
     def post(self, sensor):
         '''
-        Add new measurement to the database
+        Add new measurement(s) to the database
+
+        Accepts a single JSON object, a JSON array of objects or newline
+        delimited JSON (application/x-ndjson). All items are validated in one
+        pass and the valid ones are inserted in a single transaction.
 
-        Checks that the input is JSON and validates it agains the schema
-        Deserializes the Measurement object from JSON
-        Add measuerement to the database
-        Sends response containing location to the newly added measurements
+        A single object gets a response containing location to the newly
+        added measurement. Bulk uploads get a report of the form
+        {"created": n, "deduplicated": n, "failed": n,
+         "errors": [{"index": i, "error": "..."}]}
+
+        With MEASUREMENT_DEDUPLICATE set, a measurement the sensor already
+        has at the same timestamp is not added again. A single one is
+        answered with 200 and the location of the stored measurement, bulk
+        uploads count them in "deduplicated", which is null when the write
+        buffer acknowledges on enqueue.
+
+        When the write buffer acknowledges on enqueue, valid uploads are
+        answered with 202 instead of 201 and without a Location header.
 
         Possible responses:
+        200 - OK, the measurement was already stored
         201 - Created
+        202 - Accepted, queued in the write buffer
+        207 - Multi-Status, some of the items in a bulk upload were invalid
         400 - Bad request
         415 - Unsupported media type
         '''
 
-        if not request.json:
+        if request.mimetype == "application/x-ndjson":
+            payload = parse_ndjson(request.get_data(as_text=True))
+        elif not request.is_json:
             raise UnsupportedMediaType
-
-        try:
-            validate(request.json,
-                     Measurement.get_schema(),
-                     format_checker=Draft7Validator.FORMAT_CHECKER)
-        except ValidationError as e:
-            raise BadRequest(description=str(e)) from e
-
-        # @TODO Is error handling needed here?
-        measurement = Measurement()
-        measurement.deserialize(request.json)
-        measurement.sensor = sensor
-
-        db.session.add(measurement)
-        db.session.commit()
-
-        # Tests put out a warning if this is ran
-        # before adding measurement object to session
-        measurement.location = sensor.location
-
-        db.session.add(measurement)
-        db.session.commit()
-
-        return Response(status=201, headers={
-            "Location": url_for("api.measurementitem", measurement=measurement)
-        })
+        else:
+            payload = request.json
+
+        if isinstance(payload, dict):
+            valid, errors = validate_measurements([payload])
+            if errors:
+                raise BadRequest(description=errors[0]["error"])
+
+            ids, duplicates, durable = ingest_measurements(
+                [measurement_row(payload, sensor)], return_ids=True
+            )
+            if not durable:
+                return Response(status=202)
+            return Response(status=200 if duplicates else 201, headers={
+                "Location": url_for("api.measurementitem", measurement=ids[0])
+            })
+
+        if not isinstance(payload, list) or not payload:
+            raise BadRequest(description="Expected a measurement object or a list of them")
+
+        valid, errors = validate_measurements(payload)
+        duplicates = []
+        durable = True
+        if valid:
+            _, duplicates, durable = ingest_measurements([measurement_row(item, sensor)
+                                                          for _, item in valid])
+
+        if not errors:
+            status = 201 if durable else 202
+        elif valid:
+            status = 207
+        else:
+            status = 400
+        report = {
+            "created": len(valid) - len(duplicates or ()),
+            "deduplicated": len(duplicates) if durable else None,
+            "failed": len(errors),
+            "errors": errors
+        }
+        return Response(json.dumps(report), status, mimetype='application/json')
 
 class MeasurementItem(Resource):
     '''
@@ -102,9 +313,9 @@ class MeasurementItem(Resource):
         200 - OK
         '''
 
-        return Response(json.dumps(measurement.serialize(),
-                                   status=200,
-                                   mimetype='application/json'))
+        return Response(json.dumps(measurement.serialize()),
+                        status=200,
+                        mimetype='application/json')
 
     def put(self, measurement):
         '''
@@ -116,20 +327,37 @@ class MeasurementItem(Resource):
         Responses:
         200 - OK
         400 - Bad Request
+        409 - Conflict, the measurement is archived or its sensor already has
+              a measurement at the new timestamp
         415 - Unsupported media type
         '''
 
         if not request.json:
             raise UnsupportedMediaType
 
-        try:
-            validate(request.json,
-                     Measurement.get_schema(),
-                     format_checker=Draft7Validator.FORMAT_CHECKER)
-        except ValidationError as e:
-            raise BadRequest(description=str(e)) from e
+        _, errors = validate_measurements([request.json])
+        if errors:
+            raise BadRequest(description=errors[0]["error"])
 
+        _check_not_archived(measurement)
+        before = _rollup_keys(measurement)
         measurement.deserialize(request.json)
+        # With MEASUREMENT_DEDUPLICATE the unique index rejects a timestamp
+        # the sensor already has, archived ones are checked here
+        try:
+            db.session.flush()
+        except IntegrityError as e:
+            db.session.rollback()
+            raise Conflict(description=DUPLICATE_TIMESTAMP) from e
+        if (current_app.config["MEASUREMENT_DEDUPLICATE"] is not None
+                and measurement.timestamp != before["timestamp"]
+                and archived_measurements([(measurement.sensor_id, measurement.timestamp)])):
+            db.session.rollback()
+            raise Conflict(description=DUPLICATE_TIMESTAMP)
+        after = _rollup_keys(measurement)
+        rebuild_measurement_rollups(before, after)
+        refresh_latest([before["sensor_id"]])
+        _touch_measurements(before, after)
         db.session.commit()
 
         return Response(status=200, headers={
@@ -144,9 +372,16 @@ class MeasurementItem(Resource):
 
         Responses:
         200 - OK
+        409 - Conflict, the measurement is archived
         '''
 
+        _check_not_archived(measurement)
+        before = _rollup_keys(measurement)
         db.session.delete(measurement)
+        db.session.flush()
+        rebuild_measurement_rollups(before)
+        refresh_latest([before["sensor_id"]])
+        _touch_measurements(before)
         db.session.commit()
         return Response(
             status=200
@@ -3,16 +3,52 @@ API resources related to Sensors
 '''
 
 import json
-from flask import request, Response, url_for
+from flask import request, Response, stream_with_context, url_for
 from flask_restful import Resource
-from jsonschema import validate, ValidationError
+from jsonschema import ValidationError
 
+from sqlalchemy import select
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload
 from werkzeug.exceptions import Conflict, BadRequest, UnsupportedMediaType
 
-from mokkiwahti.db_models import Sensor, SensorConfiguration
+from mokkiwahti.db_models import Location, Sensor, SensorConfiguration
+from mokkiwahti.partitions import measurement_source
+from mokkiwahti.utils import (STREAM_BATCH_SIZE, add_validators, make_etag,
+                              not_modified, parse_expand_arg, parse_fields_arg, select_fields,
+                              stream_json_array)
 from mokkiwahti import db
 
+SENSOR_RELATIONS = ("location", "sensor_configuration")
+
+def _parse_representation():
+    '''
+    Returns the requested fields and relations to embed. Relations left out
+    by fields are not expanded either.
+    '''
+
+    fields = parse_fields_arg(request.args)
+    expand = parse_expand_arg(request.args, SENSOR_RELATIONS, SENSOR_RELATIONS)
+    if any(count is not None for count in expand.values()):
+        raise BadRequest(description="Sensor relations can't be limited")
+    if fields is not None:
+        expand = {name: count for name, count in expand.items() if name in fields}
+    return fields, expand
+
+def _touch_name_references(sensor):
+    '''
+    Marks everything that shows the sensor name changed: its location and
+    all measurements of the sensor
+    '''
+
+    if sensor.location is not None:
+        sensor.location.touch()
+    Sensor.touch_measurements([sensor.id])
+    source = measurement_source()
+    Location.touch_measurements(db.session.scalars(
+        select(source.location_id).where(source.sensor_id == sensor.id).distinct()
+    ))
+
 class SensorCollection(Resource):
     '''
     SensorCollection resource. Supports GET and POST methods.
@@ -23,15 +59,22 @@ class SensorCollection(Resource):
         Returns all locations as a HTTP Response object that contains sensor
         information as a JSON object
 
+        Query parameters:
+        fields - comma separated list of fields to include, e.g. fields=name
+        expand - comma separated list of relations to embed. Defaults to
+                 location,sensor_configuration
+
         Responses:
         200 - OK
+        400 - Bad request
         '''
 
-        sensors = []
-        for sensor in Sensor.query.all():
-            sensors.append(sensor.serialize())
-
-        return Response(json.dumps(sensors), 200, mimetype='application/json')
+        fields, expand = _parse_representation()
+        query = Sensor.query.options(*(joinedload(getattr(Sensor, name)) for name in expand))
+        sensors = (select_fields(sensor.serialize(expand=expand), fields)
+                   for sensor in query.yield_per(STREAM_BATCH_SIZE))
+        return Response(stream_with_context(stream_json_array(sensors)), 200,
+                        mimetype='application/json')
 
     def post(self):
         '''
@@ -52,8 +95,8 @@ class SensorCollection(Resource):
             raise UnsupportedMediaType
 
         try:
-            validate(request.json, Sensor.get_schema())
-            validate(request.json["sensor_configuration"], SensorConfiguration.get_schema())
+            Sensor.get_validator().validate(request.json)
+            SensorConfiguration.get_validator().validate(request.json["sensor_configuration"])
         except ValidationError as e:
             raise BadRequest(description=str(e)) from e
 
@@ -86,11 +129,27 @@ class SensorItem(Resource):
         '''
         Returns a Response containing a specific sensor item
 
+        Takes the same fields and expand query parameters as SensorCollection
+
+        Supports conditional requests with If-None-Match and
+        If-Modified-Since.
+
         Responses:
         200 - OK
+        304 - Not modified
+        400 - Bad request
         '''
 
-        return Response(json.dumps(sensor.serialize()), 200, mimetype='application/json')
+        fields, expand = _parse_representation()
+        etag = make_etag("sensor", sensor.id, sensor.version)
+        response = not_modified(etag, sensor.modified)
+        if response is not None:
+            return response
+
+        serial = sensor.serialize(expand=expand)
+        response = Response(json.dumps(select_fields(serial, fields)), 200,
+                            mimetype='application/json')
+        return add_validators(response, etag, sensor.modified)
 
     def put(self, sensor):
         '''
@@ -109,13 +168,17 @@ class SensorItem(Resource):
             raise UnsupportedMediaType
 
         try:
-            validate(request.json, Sensor.get_schema())
-            validate(request.json["sensor_configuration"], SensorConfiguration.get_schema())
+            Sensor.get_validator().validate(request.json)
+            SensorConfiguration.get_validator().validate(request.json["sensor_configuration"])
         except ValidationError as e:
             raise BadRequest(description=str(e)) from e
 
+        old_name = sensor.name
         sensor.deserialize(request.json)
         sensor.sensor_configuration.deserialize(request.json["sensor_configuration"])
+        sensor.touch()
+        if sensor.name != old_name:
+            _touch_name_references(sensor)
         db.session.commit()
 
         return Response(status=200, headers={
@@ -132,6 +195,7 @@ class SensorItem(Resource):
         200 - OK
         '''
 
+        _touch_name_references(sensor)
         db.session.delete(sensor)
         db.session.commit()
         return Response(
@@ -0,0 +1,66 @@
+'''
+API resources related to aligned series of several sensors
+'''
+
+import json
+
+from flask import current_app, request, Response
+from flask_restful import Resource
+from werkzeug.exceptions import BadRequest, NotFound
+
+from mokkiwahti.db_models import Sensor
+from mokkiwahti.metrics import record_rows
+from mokkiwahti.series import aligned_series
+from mokkiwahti.utils import parse_bucket_arg, parse_timestamp_arg, resolve_name
+
+
+class MeasurementSeries(Resource):
+    '''
+    MeasurementSeries resource. Supports GET method
+    '''
+
+    def get(self):
+        '''
+        Returns min/avg/max of temperature and humidity of several sensors
+        in time buckets, aligned so that the nth bucket of every series
+        starts at the same time.
+
+        Query parameters:
+        sensors - comma separated names of the sensors, at most SERIES_MAX_SENSORS
+        bucket - bucket size, e.g. 5m, 1h or 1d. Defaults to 1h
+        from - only measurements at or after this ISO 8601 timestamp
+        to - only measurements before this ISO 8601 timestamp
+
+        Responses:
+        200 - OK
+        400 - Bad request
+        404 - Sensor not found
+        '''
+
+        names = list(dict.fromkeys(
+            name for name in request.args.get("sensors", "").split(",") if name
+        ))
+        if not names:
+            raise BadRequest(description="Give the sensors as sensors=a,b,c")
+        maximum = current_app.config["SERIES_MAX_SENSORS"]
+        if len(names) > maximum:
+            raise BadRequest(description=f"At most {maximum} sensors at a time")
+        bucket = parse_bucket_arg(request.args)
+        start = parse_timestamp_arg(request.args, "from")
+        end = parse_timestamp_arg(request.args, "to")
+
+        sensors = []
+        for name in names:
+            try:
+                sensors.append(resolve_name(Sensor, "sensor", name))
+            except NotFound as e:
+                raise NotFound(description=f"Sensor not found: {name}") from e
+
+        starts, series = aligned_series(sensors, bucket, start, end)
+        record_rows(len(starts) * len(sensors))
+        body = {
+            "bucket": bucket,
+            "start": starts,
+            "series": [{"sensor": sensor.name, "buckets": series[sensor]} for sensor in sensors],
+        }
+        return Response(json.dumps(body), 200, mimetype='application/json')
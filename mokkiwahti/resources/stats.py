@@ -0,0 +1,54 @@
+'''
+API resources related to runtime statistics of the API
+'''
+
+import json
+
+from flask import current_app, Response
+from flask_restful import Resource
+from werkzeug.exceptions import NotFound
+
+from mokkiwahti.utils import name_cache
+
+
+class NameCacheStats(Resource):
+    '''
+    NameCacheStats resource. Supports GET method
+    '''
+
+    def get(self):
+        '''
+        Returns size and hit rate of the sensor and location name caches of
+        this worker process
+
+        Responses:
+        200 - OK
+        '''
+
+        stats = {
+            "sensor": name_cache("sensor").stats(),
+            "location": name_cache("location").stats(),
+        }
+        return Response(json.dumps(stats), 200, mimetype='application/json')
+
+
+class MetricsExport(Resource):
+    '''
+    MetricsExport resource. Supports GET method
+    '''
+
+    def get(self):
+        '''
+        Returns request metrics of all worker processes in Prometheus text
+        format
+
+        Responses:
+        200 - OK
+        404 - Metrics are disabled
+        '''
+
+        metrics = current_app.extensions.get("metrics")
+        if metrics is None:
+            raise NotFound
+        return Response(metrics.render(), 200,
+                        mimetype="text/plain", content_type="text/plain; version=0.0.4")
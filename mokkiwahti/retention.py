@@ -0,0 +1,250 @@
+'''
+Retention policies for raw measurements and rollups.
+
+Policies are given in RETENTION_POLICIES as the number of days to keep
+each kind of data, None meaning forever:
+
+    RETENTION_POLICIES = {
+        "default": {"raw": 90, "hourly": 5 * 365, "daily": None},
+        "locations": {"mokki": {"raw": 365}},
+        "sensors": {"testsensor-1": {"raw": 30}},
+    }
+
+A sensor's policy is the default policy updated with the policy of its
+location and then its own. Rollups of a location follow the location
+policy. Measurements whose sensor has been deleted follow the default.
+'''
+
+import time
+from datetime import timedelta
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import delete, literal_column, select
+
+from mokkiwahti import db
+from mokkiwahti.db_models import (Location, LocationRollup, Measurement, Sensor,
+                                  SensorRollup, utcnow)
+from mokkiwahti.partitions import drop_partition, overlapping_partitions, partition_table
+
+POLICY_KEYS = ("raw", "hourly", "daily")
+ROLLUP_KEYS = {"hourly": 3600, "daily": 86400}
+
+
+def _check_policy(policy, where):
+    unknown = set(policy) - set(POLICY_KEYS)
+    if unknown:
+        raise ValueError(f"Unknown retention keys in {where}: {', '.join(sorted(unknown))}")
+    return policy
+
+
+def resolve_policies(config):
+    '''
+    Returns a tuple (default, sensors, locations) of the effective policy for
+    data without a sensor, and dicts mapping sensor and location ids to
+    their effective policies. Raises ValueError for malformed policies.
+    '''
+
+    unknown = set(config) - {"default", "sensors", "locations"}
+    if unknown:
+        raise ValueError(f"Unknown retention sections: {', '.join(sorted(unknown))}")
+    default = _check_policy(config.get("default", {}), "default")
+    by_location = {name: _check_policy(policy, f"location {name}")
+                   for name, policy in config.get("locations", {}).items()}
+    by_sensor = {name: _check_policy(policy, f"sensor {name}")
+                 for name, policy in config.get("sensors", {}).items()}
+
+    locations = {
+        location_id: {**default, **by_location.get(name, {})}
+        for location_id, name in db.session.execute(select(Location.id, Location.name))
+    }
+    sensors = {
+        sensor_id: {**locations.get(location_id, default), **by_sensor.get(name, {})}
+        for sensor_id, name, location_id in db.session.execute(
+            select(Sensor.id, Sensor.name, Sensor.location_id)
+        )
+    }
+    return default, sensors, locations
+
+
+def _cutoff(policy, key, now):
+    days = policy.get(key)
+    if days is None:
+        return None
+    return now - timedelta(days=days)
+
+
+def raw_cutoffs(config, now=None):
+    '''
+    Returns a tuple (sensors, newest) of a dict mapping sensor ids to the
+    time before which their raw measurements are deleted, and the newest of
+    those times including the default policy. Sensors that keep raw
+    measurements forever are left out, and newest is None if nothing is
+    deleted.
+    '''
+
+    now = now or utcnow()
+    default, sensors, _ = resolve_policies(config)
+    cutoffs = {sensor_id: _cutoff(policy, "raw", now) for sensor_id, policy in sensors.items()}
+    cutoffs = {sensor_id: cutoff for sensor_id, cutoff in cutoffs.items() if cutoff is not None}
+    newest = [cutoff for cutoff in (_cutoff(default, "raw", now), *cutoffs.values())
+              if cutoff is not None]
+    return cutoffs, max(newest, default=None)
+
+
+def delete_batched(table, condition, batch_size, pause=0):
+    '''
+    Deletes rows of table matching condition at most batch_size rows per
+    transaction, so the write lock is only held briefly. Sleeps pause
+    seconds between batches to let other writers in. Returns the number of
+    deleted rows.
+    '''
+
+    rowid = literal_column("rowid")
+    total = 0
+    while True:
+        batch = select(rowid).select_from(table).where(condition).limit(batch_size)
+        deleted = db.session.execute(delete(table).where(rowid.in_(batch))).rowcount
+        db.session.commit()
+        total += deleted
+        if deleted < batch_size:
+            return total
+        if pause:
+            time.sleep(pause)
+
+
+def _drop_expired_partitions(default, sensors, now):
+    '''
+    Drops partitions that are older than the raw cutoff of every sensor
+    with one DROP TABLE each instead of deleting their rows
+    '''
+
+    cutoffs = [_cutoff(policy, "raw", now) for policy in (default, *sensors.values())]
+    if not cutoffs or None in cutoffs:
+        return []
+    oldest = min(cutoffs)
+    dropped = []
+    for partition in overlapping_partitions(end=oldest, include_detached=True):
+        if partition.end <= oldest:
+            drop_partition(partition.name)
+            dropped.append(partition.name)
+    return dropped
+
+
+def apply_retention(config, batch_size=1000, pause=0, now=None):
+    '''
+    Deletes raw measurements and rollups that are older than their policy
+    allows. Returns a report dict with the number of deleted rows of each
+    kind and the names of dropped partitions.
+    '''
+
+    now = now or utcnow()
+    default, sensors, locations = resolve_policies(config)
+    report = {"raw": 0, "hourly": 0, "daily": 0}
+    report["dropped_partitions"] = _drop_expired_partitions(default, sensors, now)
+
+    # None stands for measurements whose sensor has been deleted
+    owners = [(sensor_id, _cutoff(policy, "raw", now)) for sensor_id, policy in sensors.items()]
+    owners.append((None, _cutoff(default, "raw", now)))
+    owners = [(sensor_id, cutoff) for sensor_id, cutoff in owners if cutoff is not None]
+    if owners:
+        newest = max(cutoff for _, cutoff in owners)
+        tables = [Measurement.__table__] + [
+            partition_table(partition.name)
+            for partition in overlapping_partitions(end=newest, include_detached=True)
+        ]
+        for table in tables:
+            for sensor_id, cutoff in owners:
+                if sensor_id is None:
+                    condition = table.c.sensor_id.is_(None)
+                else:
+                    condition = table.c.sensor_id == sensor_id
+                report["raw"] += delete_batched(
+                    table, condition & (table.c.timestamp < cutoff), batch_size, pause
+                )
+
+    for key, period in ROLLUP_KEYS.items():
+        for model, owner_col, policies in ((SensorRollup, SensorRollup.sensor_id, sensors),
+                                           (LocationRollup, LocationRollup.location_id,
+                                            locations)):
+            for owner_id, policy in policies.items():
+                cutoff = _cutoff(policy, key, now)
+                if cutoff is None:
+                    continue
+                report[key] += delete_batched(
+                    model.__table__,
+                    (owner_col == owner_id) & (model.period == period) & (model.start < cutoff),
+                    batch_size, pause
+                )
+
+    if report["raw"]:
+        Sensor.touch_measurements(sensors)
+        Location.touch_measurements(locations)
+        db.session.commit()
+    return report
+
+
+def incremental_vacuum(pages=1000, pause=0):
+    '''
+    Returns free pages to the file system a few pages at a time. Only does
+    something when auto_vacuum is INCREMENTAL. Returns the number of pages
+    freed.
+    '''
+
+    connection = db.session.connection()
+    if connection.exec_driver_sql("PRAGMA auto_vacuum").scalar() != 2:
+        return 0
+    freed = 0
+    free = connection.exec_driver_sql("PRAGMA freelist_count").scalar()
+    while free:
+        connection.exec_driver_sql(f"PRAGMA incremental_vacuum({int(pages)})").fetchall()
+        db.session.commit()
+        connection = db.session.connection()
+        left = connection.exec_driver_sql("PRAGMA freelist_count").scalar()
+        if left >= free:
+            break
+        freed += free - left
+        free = left
+        if free and pause:
+            time.sleep(pause)
+    db.session.commit()
+    return freed
+
+
+@click.command("apply-retention")
+@click.option("--enable-incremental-vacuum", is_flag=True,
+              help="Switch the database to incremental auto vacuum. Runs a full "
+                   "VACUUM once, which locks the database until it is done.")
+@with_appcontext
+def apply_retention_command(enable_incremental_vacuum):
+    '''
+    Callback function for 'apply-retention' CLI command. Deletes data older
+    than the RETENTION_POLICIES allow and reclaims the space.
+    '''
+
+    config = current_app.config
+    if enable_incremental_vacuum:
+        with db.engine.connect() as connection:
+            connection.exec_driver_sql("PRAGMA auto_vacuum=INCREMENTAL")
+            connection.exec_driver_sql("VACUUM")
+        click.echo("Incremental vacuum enabled")
+
+    try:
+        report = apply_retention(config["RETENTION_POLICIES"],
+                                 batch_size=config["RETENTION_BATCH_SIZE"],
+                                 pause=config["RETENTION_BATCH_PAUSE"] / 1000)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    for name in report["dropped_partitions"]:
+        click.echo(f"Dropped partition {name}")
+    click.echo(f"Deleted {report['raw']} measurements, {report['hourly']} hourly "
+               f"and {report['daily']} daily rollups")
+
+    freed = incremental_vacuum(config["RETENTION_VACUUM_PAGES"],
+                               pause=config["RETENTION_BATCH_PAUSE"] / 1000)
+    if db.session.connection().exec_driver_sql("PRAGMA auto_vacuum").scalar() != 2:
+        click.echo("Space is not reclaimed, auto_vacuum is not INCREMENTAL. "
+                   "Run once with --enable-incremental-vacuum.")
+    else:
+        click.echo(f"Freed {freed} pages")
@@ -0,0 +1,275 @@
+'''
+Maintenance of the hourly and daily measurement rollup tables
+'''
+
+from collections import defaultdict
+from datetime import datetime, timezone
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import Integer, cast, delete, func, insert, literal, select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from mokkiwahti import db
+from mokkiwahti.constants import ROLLUP_PERIODS
+from mokkiwahti.db_models import LocationRollup, SensorRollup
+from mokkiwahti.latest import refresh_latest
+from mokkiwahti.partitions import measurement_source
+from mokkiwahti.retention import raw_cutoffs
+
+STAT_COLUMNS = ("count", "temperature_sum", "temperature_min", "temperature_max",
+                "humidity_sum", "humidity_min", "humidity_max")
+
+
+def to_epoch(timestamp):
+    '''
+    Converts a stored timestamp to epoch seconds. Timestamps are stored
+    without timezone so they are treated as UTC, the same way SQLite does.
+    '''
+
+    return int(timestamp.replace(tzinfo=timezone.utc).timestamp())
+
+
+def from_epoch(epoch):
+    '''
+    Converts epoch seconds to a naive UTC datetime, same as the timestamps
+    stored in the database
+    '''
+
+    return datetime.fromtimestamp(epoch, timezone.utc).replace(tzinfo=None)
+
+
+def floor_timestamp(timestamp, period):
+    '''
+    Returns the start of the `period` seconds long bucket the timestamp is in
+    '''
+
+    return from_epoch(to_epoch(timestamp) // period * period)
+
+
+def ceil_timestamp(timestamp, period):
+    '''
+    Returns the first bucket boundary at or after the timestamp
+    '''
+
+    return from_epoch(-(-to_epoch(timestamp) // period) * period)
+
+
+def _collect(rows, key):
+    '''
+    Reduces measurement rows into rollup rows in memory, keyed by the
+    `key` column and bucket of every rollup period
+    '''
+
+    buckets = {}
+    for row in rows:
+        owner = row[key]
+        if owner is None:
+            continue
+        temperature, humidity = row["temperature"], row["humidity"]
+        for period in ROLLUP_PERIODS:
+            start = floor_timestamp(row["timestamp"], period)
+            stats = buckets.get((owner, period, start))
+            if stats is None:
+                buckets[(owner, period, start)] = {
+                    key: owner,
+                    "period": period,
+                    "start": start,
+                    "count": 1,
+                    "temperature_sum": temperature,
+                    "temperature_min": temperature,
+                    "temperature_max": temperature,
+                    "humidity_sum": humidity,
+                    "humidity_min": humidity,
+                    "humidity_max": humidity,
+                }
+            else:
+                stats["count"] += 1
+                stats["temperature_sum"] += temperature
+                stats["temperature_min"] = min(stats["temperature_min"], temperature)
+                stats["temperature_max"] = max(stats["temperature_max"], temperature)
+                stats["humidity_sum"] += humidity
+                stats["humidity_min"] = min(stats["humidity_min"], humidity)
+                stats["humidity_max"] = max(stats["humidity_max"], humidity)
+    return list(buckets.values())
+
+
+def _upsert(model, key, rollup_rows):
+    table = model.__table__
+    stmt = sqlite_insert(table)
+    excluded = stmt.excluded
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[key, "period", "start"],
+        set_={
+            "count": table.c.count + excluded.count,
+            "temperature_sum": table.c.temperature_sum + excluded.temperature_sum,
+            "temperature_min": func.min(table.c.temperature_min, excluded.temperature_min),
+            "temperature_max": func.max(table.c.temperature_max, excluded.temperature_max),
+            "humidity_sum": table.c.humidity_sum + excluded.humidity_sum,
+            "humidity_min": func.min(table.c.humidity_min, excluded.humidity_min),
+            "humidity_max": func.max(table.c.humidity_max, excluded.humidity_max),
+        }
+    )
+    db.session.execute(stmt, rollup_rows)
+
+
+def update_rollups(rows):
+    '''
+    Adds new measurement rows to the rollup tables. Buckets are upserted so
+    late and out of order measurements end up in the right bucket.
+    Does not commit, call this in the same transaction as the insert.
+    '''
+
+    sensor_rollups = _collect(rows, "sensor_id")
+    if sensor_rollups:
+        _upsert(SensorRollup, "sensor_id", sensor_rollups)
+    location_rollups = _collect(rows, "location_id")
+    if location_rollups:
+        _upsert(LocationRollup, "location_id", location_rollups)
+
+
+def _rebuild(model, key, owners, start, end, exclude=()):
+    # Detached partitions still count, their rows exist
+    source = measurement_source(start, end, include_detached=True)
+    owner_col = getattr(source, key)
+    rollup_owner = getattr(model, key)
+
+    stmt = delete(model)
+    if owners is not None:
+        stmt = stmt.where(rollup_owner.in_(owners))
+    elif exclude:
+        stmt = stmt.where(rollup_owner.not_in(exclude))
+    if start is not None:
+        stmt = stmt.where(model.start >= start)
+    if end is not None:
+        stmt = stmt.where(model.start < end)
+    db.session.execute(stmt)
+
+    epoch = cast(func.strftime("%s", source.timestamp), Integer)
+    for period in ROLLUP_PERIODS:
+        # Same text format SQLAlchemy uses for DateTime columns on SQLite
+        bucket = func.strftime("%Y-%m-%d %H:%M:%S.000000",
+                               (epoch // period) * period,
+                               "unixepoch")
+        query = (
+            select(owner_col,
+                   literal(period),
+                   bucket,
+                   func.count(),
+                   func.sum(source.temperature),
+                   func.min(source.temperature),
+                   func.max(source.temperature),
+                   func.sum(source.humidity),
+                   func.min(source.humidity),
+                   func.max(source.humidity))
+            .where(owner_col.is_not(None))
+            .group_by(owner_col, bucket)
+        )
+        if owners is not None:
+            query = query.where(owner_col.in_(owners))
+        elif exclude:
+            query = query.where(owner_col.not_in(exclude))
+        if start is not None:
+            query = query.where(source.timestamp >= start)
+        if end is not None:
+            query = query.where(source.timestamp < end)
+        db.session.execute(
+            insert(model).from_select([key, "period", "start", *STAT_COLUMNS], query)
+        )
+
+
+def _rebuild_retained(model, key, owners, start, end, floors):
+    '''
+    Rebuilds like _rebuild, but not the buckets of an owner before its
+    floor in floors. Owners missing from floors have none.
+    '''
+
+    groups = defaultdict(list)
+    for owner, floor in floors.items():
+        if owners is None or owner in owners:
+            groups[floor].append(owner)
+    for floor, group in groups.items():
+        group_start = floor if start is None else max(start, floor)
+        if end is None or group_start < end:
+            _rebuild(model, key, group, group_start, end)
+
+    if owners is None:
+        _rebuild(model, key, None, start, end, exclude=list(floors))
+    else:
+        rest = [owner for owner in owners if owner not in floors]
+        if rest:
+            _rebuild(model, key, rest, start, end)
+
+
+def rebuild_rollups(start=None, end=None, sensor_ids=None, location_ids=None):
+    '''
+    Recomputes rollups from raw measurements. start and end are widened to
+    whole days so that every affected bucket is rebuilt completely.
+    sensor_ids and location_ids limit the rebuild, None means all of them.
+    Does not commit.
+
+    Buckets older than the raw cutoff of RETENTION_POLICIES are left alone,
+    their raw measurements may already be deleted and the rollups are all
+    that is left of them. Location rollups use the newest cutoff of any
+    sensor, since their measurements can come from any of them.
+    '''
+
+    longest = ROLLUP_PERIODS[-1]
+    if start is not None:
+        start = floor_timestamp(start, longest)
+    if end is not None:
+        end = ceil_timestamp(end, longest)
+
+    sensor_floors, location_floor = {}, None
+    if current_app.config["RETENTION_POLICIES"]:
+        cutoffs, newest = raw_cutoffs(current_app.config["RETENTION_POLICIES"])
+        sensor_floors = {sensor_id: ceil_timestamp(cutoff, longest)
+                         for sensor_id, cutoff in cutoffs.items()}
+        if newest is not None:
+            location_floor = ceil_timestamp(newest, longest)
+
+    if sensor_ids is None or sensor_ids:
+        _rebuild_retained(SensorRollup, "sensor_id", sensor_ids, start, end, sensor_floors)
+    if location_ids is None or location_ids:
+        if location_floor is not None:
+            start = location_floor if start is None else max(start, location_floor)
+        if end is None or start is None or start < end:
+            _rebuild(LocationRollup, "location_id", location_ids, start, end)
+
+
+def rebuild_measurement_rollups(*measurements):
+    '''
+    Rebuilds the buckets the given measurements fall into. Used when single
+    measurements are modified or deleted, since minimum and maximum can't be
+    updated incrementally.
+    '''
+
+    longest = ROLLUP_PERIODS[-1]
+    for measurement in measurements:
+        start = floor_timestamp(measurement["timestamp"], longest)
+        rebuild_rollups(
+            start=start,
+            end=from_epoch(to_epoch(start) + longest),
+            sensor_ids=[measurement["sensor_id"]] if measurement["sensor_id"] else [],
+            location_ids=[measurement["location_id"]] if measurement["location_id"] else [],
+        )
+
+
+@click.command("rebuild-rollups")
+@click.option("--start", type=click.DateTime(), default=None,
+              help="Only rebuild buckets from this day on")
+@click.option("--end", type=click.DateTime(), default=None,
+              help="Only rebuild buckets before this day")
+@with_appcontext
+def rebuild_rollups_command(start, end):
+    '''
+    Callback function for 'rebuild-rollups' CLI command. Backfills or
+    rebuilds the measurement rollup tables and the latest measurements
+    from raw measurements.
+    '''
+    rebuild_rollups(start=start, end=end)
+    # The latest measurement table is derived from raw measurements too
+    refresh_latest()
+    db.session.commit()
+    click.echo("Rollups rebuilt")
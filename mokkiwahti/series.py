@@ -0,0 +1,69 @@
+'''
+Aligned time series of several sensors, read in parallel.
+
+The aggregated series of every sensor is read in a worker thread of its
+own with an app context of its own, so each one gets its own session and
+pooled connection and the slowest sensor sets the response time.
+'''
+
+import atexit
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app
+from sqlalchemy.pool import SingletonThreadPool, StaticPool
+
+from mokkiwahti import db
+from mokkiwahti.aggregation import aggregate
+
+
+def _aggregate_sensor(app, sensor_id, bucket, start, end):
+    with app.app_context():
+        return aggregate("sensor_id", sensor_id, bucket, start, end)
+
+
+def _parallel_reads():
+    # In-memory databases are private to one connection, and these pools
+    # give every thread a connection of its own
+    return (current_app.extensions.get("series_executor") is not None
+            and not isinstance(db.engine.pool, (SingletonThreadPool, StaticPool)))
+
+
+def aligned_series(sensors, bucket, start=None, end=None):
+    '''
+    Aggregates measurements of sensors into buckets of `bucket` seconds and
+    aligns the series on the union of their bucket start times. Buckets a
+    sensor has no measurements in are None in its series.
+
+    Returns a tuple (starts, series) where starts lists the bucket start
+    times and series maps every sensor to its list of serialized buckets.
+    '''
+
+    if len(sensors) > 1 and _parallel_reads():
+        app = current_app._get_current_object() # pylint: disable=protected-access
+        executor = current_app.extensions["series_executor"]
+        futures = [executor.submit(_aggregate_sensor, app, sensor.id, bucket, start, end)
+                   for sensor in sensors]
+        results = [future.result() for future in futures]
+    else:
+        results = [aggregate("sensor_id", sensor.id, bucket, start, end) for sensor in sensors]
+
+    starts = sorted({item["start"] for buckets in results for item in buckets})
+    series = {}
+    for sensor, buckets in zip(sensors, results):
+        by_start = {item["start"]: item for item in buckets}
+        series[sensor] = [by_start.get(bucket_start) for bucket_start in starts]
+    return starts, series
+
+
+def init_series(app):
+    '''
+    Starts the thread pool series are read with if SERIES_WORKERS is more
+    than one
+    '''
+
+    if app.config["SERIES_WORKERS"] <= 1:
+        return
+    executor = ThreadPoolExecutor(max_workers=app.config["SERIES_WORKERS"],
+                                  thread_name_prefix="series")
+    app.extensions["series_executor"] = executor
+    atexit.register(executor.shutdown)
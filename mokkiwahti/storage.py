@@ -0,0 +1,60 @@
+'''
+SQLite storage profiles. A profile is a set of pragmas applied to every new
+connection and matching engine options, see SQLITE_PROFILES in constants.py
+'''
+
+from sqlalchemy import event
+
+from mokkiwahti import db
+from mokkiwahti.constants import SQLITE_ENGINE_OPTIONS, SQLITE_PROFILES
+
+
+def configure_engine_options(app):
+    '''
+    Adds the engine options of the configured profile to
+    SQLALCHEMY_ENGINE_OPTIONS. Options set in app config win.
+    Has to be called before db.init_app.
+    '''
+
+    profile = app.config["SQLITE_PROFILE"]
+    if profile not in SQLITE_PROFILES:
+        raise ValueError(f"Unknown SQLite profile: {profile}")
+    options = dict(SQLITE_ENGINE_OPTIONS[profile])
+    options.update(app.config.get("SQLALCHEMY_ENGINE_OPTIONS", {}))
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = options
+
+
+def _pragma_listener(pragmas):
+    def set_pragmas(dbapi_connection, _connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+    return set_pragmas
+
+
+def init_storage(app):
+    '''
+    Registers the connect event that applies the pragmas of the configured
+    profile and logs the effective values
+    '''
+
+    pragmas = SQLITE_PROFILES[app.config["SQLITE_PROFILE"]]
+    with app.app_context():
+        event.listen(db.engine, "connect", _pragma_listener(pragmas))
+        report = effective_pragmas(pragmas)
+    app.logger.info("SQLite profile %s: %s", app.config["SQLITE_PROFILE"],
+                    ", ".join(f"{name}={value}" for name, value in report.items()))
+
+
+def effective_pragmas(names):
+    '''
+    Reads the current values of the given pragmas from a pooled connection.
+    Needs an app context
+    '''
+
+    values = {}
+    with db.engine.connect() as connection:
+        for name in names:
+            values[name] = connection.exec_driver_sql(f"PRAGMA {name}").scalar()
+    return values
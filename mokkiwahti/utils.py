@@ -2,21 +2,216 @@
 File for utility functions and classes, ex. Converter classes
 '''
 
-from werkzeug.exceptions import NotFound
+import base64
+import binascii
+import json
+import math
+import re
+import threading
+import zlib
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+from flask import current_app, request, Response
+from sqlalchemy import event, inspect, select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import joinedload, make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value
+from werkzeug.exceptions import BadRequest, NotFound
 from werkzeug.routing import BaseConverter
-from mokkiwahti.db_models import Sensor, Measurement, Location
+from mokkiwahti import db
+from mokkiwahti.db_models import (CacheGeneration, Location, Sensor, SensorConfiguration,
+                                  parse_timestamp)
+from mokkiwahti.metrics import record_rows
+from mokkiwahti.partitions import measurement_source
+
+# Columns changed by bulk UPDATEs that don't go through the session. They are
+# left out of cached rows and loaded when first used.
+UNCACHED_COLUMNS = ("measurements_version", "measurements_modified", "alarm_version")
+
+# The CacheGeneration row of the name caches
+NAME_GENERATION = "names"
+
+
+def generation_query():
+    '''
+    Returns a query for the current name cache generation
+    '''
+
+    return select(CacheGeneration.value).where(CacheGeneration.name == NAME_GENERATION)
+
+
+def _detached_copy(row, related=()):
+    '''
+    Returns a detached copy of a loaded row that can be put in any session
+    with Session.merge(load=False) without a query. related names the
+    relationships that are copied along.
+    '''
+
+    mapper = inspect(row).mapper
+    copy = mapper.class_manager.new_instance()
+    for attr in mapper.column_attrs:
+        if attr.key not in UNCACHED_COLUMNS:
+            set_committed_value(copy, attr.key, getattr(row, attr.key))
+    for key in related:
+        value = getattr(row, key)
+        set_committed_value(copy, key, value if value is None else _detached_copy(value))
+    make_transient_to_detached(copy)
+    return copy
+
+
+class NameCache:
+    '''
+    Bounded LRU cache that maps names of sensors or locations to detached
+    copies of their rows, so that a hit only reads the CacheGeneration row.
+
+    Changes made by other worker processes increase the generation. Every
+    lookup compares it with the generation the copies were loaded in, and
+    when it has changed the whole cache is dropped.
+    '''
+
+    def __init__(self, size=1024):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._rows = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = None
+
+    def get(self, name):
+        '''
+        Returns the cached row for name or None
+        '''
+
+        with self._lock:
+            if not self._rows:
+                return None
+        generation = db.session.scalar(generation_query())
+        with self._lock:
+            if generation != self._generation:
+                self._rows.clear()
+                self._generation = generation
+            row = self._rows.get(name)
+            if row is not None:
+                self._rows.move_to_end(name)
+            return row
+
+    def put(self, name, row, generation, related=()):
+        '''
+        Caches a copy of row loaded in the given generation, evicting the
+        least recently used entry when full
+        '''
+
+        copy = _detached_copy(row, related)
+        with self._lock:
+            if generation != self._generation:
+                self._rows.clear()
+                self._generation = generation
+            self._rows[name] = copy
+            self._rows.move_to_end(name)
+            if len(self._rows) > self.size:
+                self._rows.popitem(last=False)
+
+    def clear(self):
+        '''
+        Drops every entry
+        '''
+
+        with self._lock:
+            self._rows.clear()
+
+    def stats(self):
+        '''
+        Returns size and hit rate of the cache as a dict
+        '''
+
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._rows),
+            "max_size": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else None,
+        }
+
+
+def init_name_caches(app):
+    '''
+    Creates the sensor and location name caches used by the URL converters
+    '''
+
+    app.extensions["name_cache"] = {
+        kind: NameCache(app.config["NAME_CACHE_SIZE"])
+        for kind in ("sensor", "location")
+    }
+
+
+def name_cache(kind):
+    '''
+    Returns the name cache of the current app for "sensor" or "location"
+    '''
+
+    return current_app.extensions["name_cache"][kind]
+
+
+@event.listens_for(db.session, "before_flush")
+def _invalidate_name_caches(session, _flush_context, _instances):
+    '''
+    Increases the name cache generation in the same transaction when cached
+    rows are changed or deleted, and drops the caches of this process
+    '''
+
+    if not any(isinstance(obj, (Sensor, Location, SensorConfiguration))
+               for obj in (*session.dirty, *session.deleted)):
+        return
+    stmt = sqlite_insert(CacheGeneration).values(name=NAME_GENERATION, value=1)
+    session.execute(stmt.on_conflict_do_update(
+        index_elements=["name"], set_={"value": CacheGeneration.value + 1}
+    ))
+    for cache in current_app.extensions["name_cache"].values():
+        cache.clear()
+
+
+def resolve_name(model, kind, name, related=()):
+    '''
+    Loads a sensor or location by name, going through the name cache.
+    related names relationships that are loaded in the same query and
+    cached along. Raises NotFound if there is no such row
+    '''
+
+    cache = name_cache(kind)
+    row = cache.get(name)
+    if row is not None:
+        cache.hits += 1
+        return db.session.merge(row, load=False)
+
+    cache.misses += 1
+    # The generation is read in the same query, a change committed after
+    # it only drops the copy sooner than needed
+    options = [joinedload(getattr(model, key)) for key in related]
+    result = db.session.execute(
+        select(model, generation_query().scalar_subquery())
+        .options(*options).where(model.name == name)
+    ).first()
+    if result is None:
+        raise NotFound
+    row, generation = result
+    cache.put(name, row, generation, related)
+    return row
+
 
 class SensorConverter(BaseConverter):
     '''
     Converts sensor from URL to python object, and vice versa.
     Raises NotFound if the sensor is not found from the database
+
+    Location and configuration are loaded in the same query, every sensor
+    endpoint needs one or the other.
     '''
 
     def to_python(self, value):
-        db_sensor = Sensor.query.filter_by(name=value).first()
-        if db_sensor is None:
-            raise NotFound
-        return db_sensor
+        return resolve_name(Sensor, "sensor", value,
+                            related=("location", "sensor_configuration"))
 
     def to_url(self, value):
         return value.name
@@ -24,17 +219,26 @@ class SensorConverter(BaseConverter):
 class MeasurementConverter(BaseConverter):
     '''
     Converts measurement string from URL to python object, and vice versa.
+    Archived measurements are found from their partitions.
     Raises NotFound if the measurement is not found
     '''
 
     def to_python(self, value):
-        db_measurement = Measurement.query.filter_by(id=value).first()
+        try:
+            measurement_id = int(value)
+        except ValueError as e:
+            raise NotFound from e
+        source = measurement_source()
+        db_measurement = db.session.scalars(
+            select(source).where(source.id == measurement_id)
+        ).first()
         if db_measurement is None:
             raise NotFound
         return db_measurement
 
     def to_url(self, value):
-        return str(value.id)
+        # Accepts plain ids too, bulk inserts don't create ORM objects
+        return str(getattr(value, "id", value))
 
 class LocationConverter(BaseConverter):
     '''
@@ -43,10 +247,237 @@ class LocationConverter(BaseConverter):
     '''
 
     def to_python(self, value):
-        db_location = Location.query.filter_by(name=value).first()
-        if db_location is None:
-            raise NotFound
-        return db_location
+        return resolve_name(Location, "location", value)
 
     def to_url(self, value):
         return value.name
+
+
+def parse_timestamp_arg(args, name):
+    '''
+    Parses an optional ISO 8601 timestamp from request arguments into a
+    naive UTC datetime like the stored ones.
+    Raises BadRequest if the value is not a valid timestamp
+    '''
+
+    value = args.get(name)
+    if value is None:
+        return None
+    try:
+        return parse_timestamp(value)
+    except ValueError as e:
+        raise BadRequest(description=f"Invalid timestamp for '{name}': {value}") from e
+
+
+def parse_limit_arg(args, default, maximum):
+    '''
+    Parses the page size from request arguments.
+    Raises BadRequest if the value is not an integer between 1 and maximum
+    '''
+
+    value = args.get("limit", default)
+    try:
+        limit = int(value)
+    except ValueError as e:
+        raise BadRequest(description=f"Invalid limit: {value}") from e
+    if not 1 <= limit <= maximum:
+        raise BadRequest(description=f"Limit must be between 1 and {maximum}")
+    return limit
+
+
+def parse_fields_arg(args):
+    '''
+    Parses a comma separated list of top level fields from request
+    arguments. Returns None if all fields are wanted
+    '''
+
+    value = args.get("fields")
+    if value is None:
+        return None
+    return {field for field in value.split(",") if field}
+
+
+def parse_expand_arg(args, relations, default):
+    '''
+    Parses the relations to embed from request arguments, for example
+    expand=sensors,measurements:latest:10
+
+    Returns a dict mapping relation names to the number of latest items to
+    include, None meaning all of them. Raises BadRequest for relations that
+    are not in `relations` or malformed limits
+    '''
+
+    value = args.get("expand")
+    if value is None:
+        return dict.fromkeys(default)
+
+    expand = {}
+    for item in filter(None, value.split(",")):
+        name, _, limit = item.partition(":")
+        if name not in relations:
+            raise BadRequest(description=f"Can't expand '{name}'")
+        if not limit:
+            expand[name] = None
+            continue
+        mode, _, count = limit.partition(":")
+        if mode != "latest" or not count.isdigit() or int(count) == 0:
+            raise BadRequest(description=f"Invalid expand: {item}")
+        expand[name] = int(count)
+    return expand
+
+
+def select_fields(serial, fields):
+    '''
+    Leaves only the given top level fields in a serialized object.
+    fields None means all fields
+    '''
+
+    if fields is None:
+        return serial
+    return {key: value for key, value in serial.items() if key in fields}
+
+
+BUCKET_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+def parse_bucket_arg(args, default="1h"):
+    '''
+    Parses a bucket size such as 5m, 1h or 1d from request arguments into
+    seconds. Raises BadRequest if the value is not a valid bucket size
+    '''
+
+    value = args.get("bucket", default)
+    match = re.fullmatch(r"(\d+)([smhd])", value)
+    if match is None or int(match.group(1)) == 0:
+        raise BadRequest(description=f"Invalid bucket: {value}")
+    return int(match.group(1)) * BUCKET_UNITS[match.group(2)]
+
+
+def encode_cursor(timestamp, row_id, direction):
+    '''
+    Encodes a keyset position into an opaque cursor string
+    '''
+
+    raw = json.dumps([timestamp.isoformat(), row_id, direction])
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor):
+    '''
+    Decodes a cursor made by encode_cursor into (timestamp, id, direction).
+    Raises BadRequest if the cursor is malformed
+    '''
+
+    try:
+        timestamp, row_id, direction = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if direction not in ("next", "prev") or not isinstance(row_id, int):
+            raise ValueError
+        return datetime.fromisoformat(timestamp), row_id, direction
+    except (ValueError, TypeError, binascii.Error) as e:
+        raise BadRequest(description="Invalid cursor") from e
+
+
+# Rows fetched from the database at a time when streaming responses
+STREAM_BATCH_SIZE = 500
+
+def stream_json_array(items, chunk_size=16384, encode=json.dumps):
+    '''
+    Generator that encodes an iterable of JSON serializable objects as a JSON
+    array piece by piece, yielding chunks of roughly chunk_size characters.
+    encode turns one item into JSON text.
+    '''
+
+    parts = ["["]
+    size = 1
+    separator = ""
+    count = 0
+    for item in items:
+        part = separator + encode(item)
+        separator = ","
+        parts.append(part)
+        size += len(part)
+        count += 1
+        if size >= chunk_size:
+            yield "".join(parts)
+            parts = []
+            size = 0
+    parts.append("]")
+    record_rows(count)
+    yield "".join(parts)
+
+
+def _json_value(value):
+    # json.dumps writes finite floats with repr() too, but Infinity and NaN
+    # have JSON spellings of their own
+    if type(value) is float and math.isfinite(value):  # pylint: disable=unidiomatic-typecheck
+        return repr(value)
+    return json.dumps(value)
+
+
+def measurement_row_encoder():
+    '''
+    Returns a function that encodes a (temperature, humidity, timestamp,
+    sensor name, location name) row as JSON text, exactly like
+    json.dumps(measurement.serialize()) but without building any objects.
+    Columns after these are left out. Encoded names are cached, so use a
+    new encoder for every response.
+    '''
+
+    names = {None: "null"}
+
+    def name_json(name):
+        encoded = names.get(name)
+        if encoded is None:
+            encoded = names[name] = json.dumps({"name": name})
+        return encoded
+
+    def encode(row):
+        temperature, humidity, timestamp, sensor, location = row[:5]
+        return (f'{{"temperature": {_json_value(temperature)}, '
+                f'"humidity": {_json_value(humidity)}, '
+                f'"timestamp": "{datetime.isoformat(timestamp)}", '
+                f'"sensor": {name_json(sensor)}, '
+                f'"location": {name_json(location)}}}')
+
+    return encode
+
+
+def make_etag(*versions):
+    '''
+    Builds a strong ETag from version counters. The query string is part of
+    the tag so every representation of a resource gets its own ETag
+    '''
+
+    query = format(zlib.crc32(request.query_string), "x")
+    return "-".join(str(version) for version in versions) + "-" + query
+
+
+def add_validators(response, etag, last_modified):
+    '''
+    Sets ETag and Last-Modified headers of a response. last_modified is a
+    naive UTC datetime
+    '''
+
+    response.set_etag(etag)
+    response.last_modified = last_modified.replace(tzinfo=timezone.utc)
+    return response
+
+
+def not_modified(etag, last_modified):
+    '''
+    Checks the If-None-Match and If-Modified-Since headers of the request.
+    Returns a 304 Not Modified response if the client has a fresh copy,
+    otherwise None. If-None-Match takes precedence when both are given and
+    uses weak comparison, compressed responses have weak ETags.
+    '''
+
+    if request.if_none_match:
+        fresh = request.if_none_match.contains_weak(etag)
+    elif request.if_modified_since:
+        modified = last_modified.replace(microsecond=0, tzinfo=timezone.utc)
+        fresh = modified <= request.if_modified_since
+    else:
+        fresh = False
+
+    if not fresh:
+        return None
+    return add_validators(Response(status=304), etag, last_modified)
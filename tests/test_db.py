@@ -3,18 +3,28 @@ This module test functionality of DB
 Code from mokkiwahti/db_models.py targeted
 """
 
+import asyncio
 import os
+import socket
 import tempfile
 from time import time
-from datetime import datetime
+from datetime import datetime, timedelta
 
 import pytest
 from sqlalchemy.engine import Engine
-from sqlalchemy import event
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session
 from sqlalchemy.exc import IntegrityError, StatementError
 
 from mokkiwahti import create_app, db
-from mokkiwahti.db_models import Location, Sensor, Measurement, SensorConfiguration
+from mokkiwahti.db_models import (Location, Sensor, Measurement, SensorConfiguration,
+                                  SensorRollup, LocationRollup, utcnow)
+from mokkiwahti.constants import SQLITE_PROFILES
+from mokkiwahti.ingest import store_measurements
+from mokkiwahti.storage import effective_pragmas
+from mokkiwahti.rollups import rebuild_rollups
+from mokkiwahti.retention import apply_retention
+from mokkiwahti.listener import LineIngest, parse_line, start_listeners
 
 
 @event.listens_for(Engine, "connect")
@@ -289,6 +299,23 @@ def test_location(app):
             db.session.commit()
 
 
+def test_concurrent_touch(app):
+    """
+    Test that edits of the same row from two sessions, like two worker
+    processes, both increase its version
+    """
+    with app.app_context():
+        db.session.add(_get_location())
+        db.session.commit()
+        with Session(db.engine) as first, Session(db.engine) as second:
+            loc1 = first.scalars(select(Location)).one()
+            loc2 = second.scalars(select(Location)).one()
+            loc1.touch()
+            first.commit()
+            loc2.touch()
+            second.commit()
+        assert Location.query.one().version == 3
+
 def test_multiple_sensors_in_location(app):
     """
     Test that sensors can have same location
@@ -342,3 +369,259 @@ def test_too_long_name(app):
         db.session.add(location)
         with pytest.raises(IntegrityError):
             db.session.commit()
+
+def _rollup_rows(model):
+    """Return rollup table contents as comparable tuples"""
+    return sorted(
+        (row.period, row.start, row.count, row.temperature_sum, row.temperature_min,
+         row.temperature_max, row.humidity_sum, row.humidity_min, row.humidity_max)
+        for row in model.query.all()
+    )
+
+def test_rollups(app):
+    """
+    Test that rollups are updated incrementally on insert, also for late
+    measurements, and that a rebuild from raw data gives the same result
+    """
+    with app.app_context():
+        location = _get_location()
+        sensor = _get_sensor()
+        location.sensors.append(sensor)
+        db.session.add(location)
+        db.session.commit()
+
+        rows = [
+            {"sensor_id": sensor.id, "location_id": location.id, "temperature": temp,
+             "humidity": 50.0, "timestamp": datetime(2024, 1, 1, hour, 30)}
+            for temp, hour in ((10.0, 1), (12.0, 1), (8.0, 2))
+        ]
+        store_measurements(rows)
+        # late measurement to an already existing bucket
+        store_measurements([{"sensor_id": sensor.id, "location_id": location.id,
+                             "temperature": 20.0, "humidity": 40.0,
+                             "timestamp": datetime(2024, 1, 1, 1, 0)}])
+
+        hourly = SensorRollup.query.filter_by(period=3600,
+                                              start=datetime(2024, 1, 1, 1)).one()
+        assert hourly.count == 3
+        assert hourly.temperature_min == 10.0
+        assert hourly.temperature_max == 20.0
+        assert hourly.humidity_min == 40.0
+        daily = LocationRollup.query.filter_by(period=86400).one()
+        assert daily.count == 4
+        assert daily.temperature_sum == 50.0
+
+        incremental = (_rollup_rows(SensorRollup), _rollup_rows(LocationRollup))
+        rebuild_rollups()
+        db.session.commit()
+        assert (_rollup_rows(SensorRollup), _rollup_rows(LocationRollup)) == incremental
+
+def test_validators():
+    """
+    Test that validators are compiled once and that the measurement fast
+    path agrees with the full validator
+    """
+    assert Location.get_validator() is Location.get_validator()
+    assert Sensor.get_validator() is not Location.get_validator()
+
+    validator = Measurement.get_validator()
+    good = {"temperature": 1.5, "humidity": 40, "timestamp": "2024-01-01T12:00:00"}
+    assert Measurement.check(good)
+    assert validator.is_valid(good)
+    for bad in (None, [], {}, {**good, "temperature": "1.5"}, {**good, "humidity": True},
+                {**good, "timestamp": 1}, {"temperature": 1.5, "humidity": 40}):
+        assert not Measurement.check(bad)
+        assert not validator.is_valid(bad)
+    assert not Measurement.check({**good, "timestamp": "yesterday"})
+
+def test_storage_profile():
+    """
+    Test that pragmas of the production storage profile are applied to
+    new connections
+    """
+    db_fd, db_fname = tempfile.mkstemp()
+    app = create_app({
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
+        "TESTING": True,
+        "SQLITE_PROFILE": "production"
+    })
+    with app.app_context():
+        pragmas = effective_pragmas(SQLITE_PROFILES["production"])
+        assert pragmas["journal_mode"] == "wal"
+        assert pragmas["synchronous"] == 1
+        assert pragmas["foreign_keys"] == 1
+        assert pragmas["busy_timeout"] == 5000
+        assert db.engine.pool.size() == 8
+        db.engine.dispose()
+
+    os.close(db_fd)
+    os.unlink(db_fname)
+    for suffix in ("-wal", "-shm"):
+        if os.path.exists(db_fname + suffix):
+            os.unlink(db_fname + suffix)
+
+def test_unknown_storage_profile():
+    """Test that a typo in the profile name is not silently ignored"""
+    with pytest.raises(ValueError):
+        create_app({"SQLALCHEMY_DATABASE_URI": "sqlite://", "SQLITE_PROFILE": "fast"})
+
+def test_retention(app):
+    """
+    Test that retention policies delete old raw measurements and rollups in
+    batches, and that location and sensor policies override the default
+    """
+    with app.app_context():
+        location = _get_location()
+        sensor_1 = _get_sensor(1)
+        sensor_2 = _get_sensor(2)
+        location.sensors.append(sensor_1)
+        db.session.add_all([location, sensor_2])
+        db.session.commit()
+
+        rows = [
+            {"sensor_id": sensor.id, "location_id": sensor.location_id, "temperature": 20.0,
+             "humidity": 50.0, "timestamp": datetime(2024, 1, day, 12)}
+            for sensor in (sensor_1, sensor_2) for day in range(1, 31)
+        ]
+        store_measurements(rows)
+
+        policies = {
+            "default": {"raw": 20, "hourly": 10, "daily": None},
+            "locations": {"testipaikka": {"raw": 5}},
+            "sensors": {"testsensor-1": {"hourly": None}},
+        }
+        report = apply_retention(policies, batch_size=7, now=datetime(2024, 1, 31))
+        # sensor 1 keeps days 26-30, sensor 2 days 11-30
+        assert report["raw"] == 25 + 10
+        assert Measurement.query.filter_by(sensor_id=sensor_1.id).count() == 5
+        assert Measurement.query.filter_by(sensor_id=sensor_2.id).count() == 20
+        # sensor 1 keeps all hourly rollups, sensor 2 and the location days 21-30
+        assert SensorRollup.query.filter_by(sensor_id=sensor_1.id, period=3600).count() == 30
+        assert SensorRollup.query.filter_by(sensor_id=sensor_2.id, period=3600).count() == 10
+        assert LocationRollup.query.filter_by(period=3600).count() == 10
+        assert report["hourly"] == 20 + 20
+        assert report["daily"] == 0
+        assert LocationRollup.query.filter_by(period=86400).count() == 30
+
+        with pytest.raises(ValueError):
+            apply_retention({"default": {"rwa": 1}})
+
+def test_rebuild_after_retention(app):
+    """
+    Test that rebuilding rollups keeps the rollups of measurements that
+    retention has deleted
+    """
+    now = utcnow()
+    app.config["RETENTION_POLICIES"] = {"default": {"raw": 20}}
+    with app.app_context():
+        location = _get_location()
+        location.sensors.append(_get_sensor(1))
+        db.session.add(location)
+        db.session.commit()
+        sensor = Sensor.query.first()
+
+        store_measurements([
+            {"sensor_id": sensor.id, "location_id": location.id, "temperature": 20.0,
+             "humidity": 50.0, "timestamp": now - timedelta(days=days)}
+            for days in range(1, 41)
+        ])
+        report = apply_retention(app.config["RETENTION_POLICIES"], now=now)
+        assert report["raw"] == 20
+        before = {model: model.query.filter_by(period=86400).count()
+                  for model in (SensorRollup, LocationRollup)}
+        assert before[SensorRollup] == before[LocationRollup] == 40
+
+        # recent buckets are still rebuilt from the raw measurements
+        Measurement.query.filter(Measurement.timestamp > now - timedelta(days=2)).delete()
+        rebuild_rollups()
+        db.session.commit()
+        assert SensorRollup.query.filter_by(period=86400).count() == 39
+        assert LocationRollup.query.filter_by(period=86400).count() == 39
+        oldest = SensorRollup.query.filter_by(period=86400).order_by(SensorRollup.start).first()
+        assert oldest.start < now - timedelta(days=39)
+
+def test_parse_line():
+    """Test parsing of the listener line protocol"""
+    name, item = parse_line("sensor,1,2.5,2024-01-01T12:00:00")
+    assert name == "sensor"
+    assert item == {"temperature": 1.0, "humidity": 2.5, "timestamp": "2024-01-01T12:00:00"}
+    assert parse_line("a,b,1,2,")[0] == "a,b"
+    for line in ("sensor,1,2", "sensor,x,2,", ",1,2,", "sensor,nan,2,", "sensor,1,2,today"):
+        with pytest.raises(ValueError):
+            parse_line(line)
+
+def test_listener(app):
+    """
+    Test that lines sent over UDP and TCP are stored in batches and that
+    bad lines are counted and dropped
+    """
+    with app.app_context():
+        location = _get_location()
+        location.sensors.append(_get_sensor(1))
+        db.session.add(location)
+        db.session.commit()
+
+    async def run():
+        ingest = LineIngest(app, batch_size=2, interval=20)
+        listeners = await start_listeners(ingest, "127.0.0.1", udp_port=0, tcp_port=0)
+        stop = asyncio.Event()
+        runner = asyncio.create_task(ingest.run(stop))
+        udp_port = listeners[0].get_extra_info("socket").getsockname()[1]
+        tcp_port = listeners[1].sockets[0].getsockname()[1]
+
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.sendto(b"testsensor-1,20.5,40,2024-01-01T00:00:00\n"
+                        b"testsensor-1,21.5,41,2024-01-01T00:01:00\n"
+                        b"garbage\n", ("127.0.0.1", udp_port))
+            sock.sendto(b"\xff\xfe", ("127.0.0.1", udp_port))
+        _, writer = await asyncio.open_connection("127.0.0.1", tcp_port)
+        writer.write(b"testsensor-1,22.5,42,2024-01-01T00:02:00\n"
+                     + b"x" * 5000 + b"\n"
+                     + b"nosuchsensor,1,1,2024-01-01T00:03:00\n"
+                     + b"testsensor-1,23.5,43,")
+        await writer.drain()
+        writer.close()
+        await writer.wait_closed()
+
+        for _ in range(100):
+            await asyncio.sleep(0.02)
+            if ingest.stats["received"] == 8 and not ingest._pending:
+                break
+        stop.set()
+        await runner
+        for listener in listeners:
+            listener.close()
+        return ingest.stats
+
+    stats = asyncio.run(run())
+    assert stats == {"received": 8, "stored": 4, "duplicate": 0, "malformed": 3,
+                     "unknown_sensor": 1, "dropped": 0, "failed": 0}
+    with app.app_context():
+        temperatures = [meas.temperature for meas in
+                        Measurement.query.order_by(Measurement.timestamp)]
+        assert temperatures[:3] == [20.5, 21.5, 22.5]
+        assert len(temperatures) == 4
+        assert Measurement.query.first().location.name == "testipaikka"
+
+def test_listener_offsets(app):
+    """
+    Test that a batch mixing UTC offset and empty timestamps of one sensor
+    is stored in UTC
+    """
+    with app.app_context():
+        db.session.add(_get_sensor(1))
+        db.session.commit()
+
+    ingest = LineIngest(app)
+    ingest.store([parse_line(line) for line in (
+        "testsensor-1,20.5,40,2024-01-01T00:00:00Z",
+        "testsensor-1,21.5,41,",
+        "testsensor-1,22.5,42,2024-01-01T03:00:00+02:00",
+    )])
+    assert ingest.stats["stored"] == 3
+    assert ingest.stats["failed"] == 0
+    with app.app_context():
+        timestamps = [measurement.timestamp for measurement
+                      in Measurement.query.order_by(Measurement.timestamp)]
+        assert timestamps[:2] == [datetime(2024, 1, 1), datetime(2024, 1, 1, 1)]
+        assert timestamps[2].tzinfo is None
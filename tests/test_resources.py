@@ -5,7 +5,11 @@ Code from mokkiwahti/resources/*.py targeted
 
 import os
 import json
+import subprocess
+import sys
 import tempfile
+import time
+import zlib
 from datetime import datetime
 
 import pytest
@@ -14,7 +18,11 @@ from sqlalchemy.engine import Engine
 from sqlalchemy import event
 
 from mokkiwahti import create_app, db
-from mokkiwahti.db_models import Location, Sensor, Measurement, SensorConfiguration
+from mokkiwahti.db_models import (Location, Sensor, Measurement, SensorConfiguration,
+                                  create_measurement_unique_index)
+from mokkiwahti.export import export_query
+from mokkiwahti.latest import refresh_latest
+from mokkiwahti.metrics import Metrics, RequestStats
 
 
 # Enable foreigen key support
@@ -80,6 +88,8 @@ def _populate_db():
         db.session.add(sc)
         db.session.add(meas)
 
+    db.session.flush()
+    refresh_latest()
     db.session.commit()
 
 def _check_db():
@@ -92,6 +102,29 @@ def _check_db():
     print("sensor configuration count: ", SensorConfiguration.query.count())
     print("measurement count: ", Measurement.query.count())
 
+class _QueryCounter():
+    """Counts SQL statements executed while the context is active"""
+
+    def __init__(self, app):
+        self.app = app
+        self.count = 0
+        self.statements = []
+        self.parameters = []
+
+    def _count(self, _conn, _cursor, statement, parameters, *args):
+        self.count += 1
+        self.statements.append(statement)
+        self.parameters.append(parameters)
+
+    def __enter__(self):
+        with self.app.app_context():
+            event.listen(db.engine, "before_cursor_execute", self._count)
+        return self
+
+    def __exit__(self, *args):
+        with self.app.app_context():
+            event.remove(db.engine, "before_cursor_execute", self._count)
+
 @pytest.fixture
 def client():
     """test client setup"""
@@ -113,6 +146,54 @@ def client():
     os.close(db_fd)
     os.unlink(db_fname)
 
+@pytest.fixture(params=["flush", "enqueue"])
+def buffered_client(request):
+    """test client setup with the measurement write buffer enabled"""
+    db_fd, db_fname = tempfile.mkstemp()
+    config = {
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
+        "TESTING": True,
+        "MEASUREMENT_BUFFER": True,
+        "MEASUREMENT_BUFFER_SIZE": 10,
+        "MEASUREMENT_BUFFER_INTERVAL": 20,
+        "MEASUREMENT_BUFFER_ACK": request.param
+    }
+
+    app = create_app(config)
+
+    with app.app_context():
+        db.create_all()
+        _populate_db()
+
+    yield app.test_client()
+
+    app.extensions["measurement_buffer"].close()
+    os.close(db_fd)
+    os.unlink(db_fname)
+
+@pytest.fixture(params=["ignore", "update"])
+def dedup_client(request):
+    """test client setup with measurement deduplication enabled"""
+    db_fd, db_fname = tempfile.mkstemp()
+    config = {
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
+        "TESTING": True,
+        "MEASUREMENT_DEDUPLICATE": request.param
+    }
+
+    app = create_app(config)
+
+    with app.app_context():
+        db.create_all()
+        _populate_db()
+        create_measurement_unique_index()
+        db.session.commit()
+
+    yield app.test_client()
+
+    os.close(db_fd)
+    os.unlink(db_fname)
+
 class TestLocationResource():
     """Tests for Location resource"""
     RESOURCE_URL = "/api/locations/"
@@ -215,6 +296,74 @@ class TestLinkerResource():
         for i, sensor in enumerate(body["sensors"], start=1):
             assert "testsensor-" + str(i) == sensor["name"]
 
+    @staticmethod
+    def _locations(client, url):
+        resp = client.get(url + "?from=2024-01-01&to=2024-01-02")
+        return [meas["location"] and meas["location"]["name"] for meas in resp.json]
+
+    @staticmethod
+    def _count(client, location):
+        resp = client.get(f"/api/locations/{location}/measurements/aggregate/"
+                          "?bucket=1d&from=2024-01-01T00:00:00&to=2024-01-02T00:00:00")
+        return resp.json[0]["count"] if resp.json else 0
+
+    def test_put_from(self, client):
+        """test moving measurements from a given time on with the link"""
+        measurements_url = "/api/sensors/testsensor-1/measurements/"
+        client.post(measurements_url, json=[
+            {"temperature": i, "humidity": 50.0, "timestamp": f"2024-01-01T0{i}:00:00"}
+            for i in range(4)
+        ])
+        resp = client.put("/api/locations/testlocation-2/link/sensors/testsensor-1/"
+                          "?from=2024-01-01T02:00:00")
+        assert resp.status_code == 200
+        assert self._locations(client, measurements_url) == [
+            "testlocation-1", "testlocation-1", "testlocation-2", "testlocation-2"
+        ]
+        assert self._count(client, "testlocation-1") == 2
+        assert self._count(client, "testlocation-2") == 2
+
+        resp = client.delete("/api/locations/testlocation-2/link/sensors/testsensor-1/"
+                             "?from=2024-01-01T03:00:00")
+        assert resp.status_code == 200
+        assert self._locations(client, measurements_url)[2:] == ["testlocation-2", None]
+        assert self._count(client, "testlocation-2") == 1
+        resp = client.put(self.RESOURCE_URL + "?from=yesterday")
+        assert resp.status_code == 400
+
+    def test_relink_cli(self, client):
+        """test relink-sensor command"""
+        measurements_url = "/api/sensors/testsensor-1/measurements/"
+        client.post(measurements_url, json=[
+            {"temperature": i, "humidity": 50.0, "timestamp": f"2024-01-01T0{i}:00:00"}
+            for i in range(4)
+        ])
+        runner = client.application.test_cli_runner()
+        result = runner.invoke(args=["relink-sensor", "testsensor-1", "testlocation-3",
+                                     "--from", "2024-01-01", "--to", "2024-01-01T01:00:00",
+                                     "--batch-size", "1"])
+        assert result.exit_code == 0
+        assert "Relinked 1 measurements" in result.output
+        assert self._locations(client, measurements_url)[:2] == [
+            "testlocation-3", "testlocation-1"
+        ]
+        assert client.get("/api/sensors/testsensor-1/").json["location"]["name"] == (
+            "testlocation-1"
+        )
+
+        result = runner.invoke(args=["relink-sensor", "testsensor-1", "testlocation-2",
+                                     "--from", "2024-01-01", "--batch-size", "2"])
+        assert result.exit_code == 0
+        assert "Relinked 5 measurements" in result.output
+        assert set(self._locations(client, measurements_url)) == {"testlocation-2"}
+        assert client.get("/api/sensors/testsensor-1/").json["location"]["name"] == (
+            "testlocation-2"
+        )
+        latest = client.get("/api/locations/testlocation-2/latest/").json
+        assert "testsensor-1" in [meas["sensor"]["name"] for meas in latest]
+        result = runner.invoke(args=["relink-sensor", "nosensor", "--from", "2024-01-01"])
+        assert result.exit_code != 0
+
     def test_put_wo_sensor(self, client):
         """test put method with missing sensor"""
         resp = client.put("/api/locations/testlocation-1/link/sensors/testsensor-100/")
@@ -358,6 +507,25 @@ class TestMeasurementsResource():
         assert len(body) == 1
         validate(body[0], Measurement.get_schema())
 
+    def test_get_matches_serialize(self, client):
+        """test that the collection is encoded exactly like serialize() does"""
+        resp = client.post(self.SENSOR_RESOURCE_URL, json=[
+            {"temperature": 21, "humidity": 40.125, "timestamp": "2024-01-01T00:00:00.5"},
+            {"temperature": -1.5e-7, "humidity": 0, "timestamp": "2024-01-01T00:00:01"},
+        ])
+        assert resp.status_code == 201
+        with client.application.app_context():
+            sensor = Sensor.query.filter_by(name="testsensor-1").one()
+            sensor.name = 'sensori "ä"'
+            Measurement.query.filter_by(humidity=0).one().location = None
+            db.session.commit()
+            expected = "[" + ",".join(
+                json.dumps(meas.serialize())
+                for meas in sorted(sensor.measurements, key=lambda m: m.timestamp)
+            ) + "]"
+        resp = client.get('/api/sensors/sensori "ä"/measurements/')
+        assert resp.get_data(as_text=True) == expected
+
     def test_post(self, client):
         """test post method functionality"""
         meas_test_obj =  Measurement(
@@ -417,6 +585,1171 @@ class TestMeasurementsResource():
         for meas in body:
             validate(meas, Measurement.get_schema())
 
+    def test_post_bulk(self, client):
+        """test posting a list of measurements"""
+        data = [_get_measurement(temperature=i).serialize(short_form=True) for i in range(5)]
+        resp = client.post(self.SENSOR_RESOURCE_URL, json=data)
+        assert resp.status_code == 201
+        assert resp.json == {"created": 5, "deduplicated": 0, "failed": 0, "errors": []}
+        resp = client.get(self.SENSOR_RESOURCE_URL)
+        assert len(resp.json) == 6
+
+    def test_post_bulk_partial(self, client):
+        """test posting a list of measurements where some items are invalid"""
+        data = [_get_measurement().serialize(short_form=True) for _ in range(3)]
+        del data[1]["humidity"]
+        resp = client.post(self.SENSOR_RESOURCE_URL, json=data)
+        assert resp.status_code == 207
+        assert resp.json["created"] == 2
+        assert resp.json["failed"] == 1
+        assert resp.json["errors"][0]["index"] == 1
+        resp = client.get(self.SENSOR_RESOURCE_URL)
+        assert len(resp.json) == 3
+
+    def test_post_bulk_all_invalid(self, client):
+        """test posting a list of measurements where every item is invalid"""
+        resp = client.post(self.SENSOR_RESOURCE_URL, json=[{"temperature": 1}, "foo"])
+        assert resp.status_code == 400
+        assert resp.json["failed"] == 2
+        resp = client.get(self.SENSOR_RESOURCE_URL)
+        assert len(resp.json) == 1
+
+    def test_post_not_finite(self, client):
+        """test that NaN and Infinity are reported as invalid items"""
+        item = '{"temperature": %s, "humidity": 1.0, "timestamp": "2024-01-01T00:00:00"}'
+        for value in ("NaN", "Infinity", "-Infinity"):
+            resp = client.post(self.SENSOR_RESOURCE_URL, data=item % value,
+                               content_type="application/json")
+            assert resp.status_code == 400
+            assert "finite" in resp.json["message"]
+        data = "[%s, %s, %s]" % (item % 1.0, item % "NaN", item % "-Infinity")
+        resp = client.post(self.SENSOR_RESOURCE_URL, data=data, content_type="application/json")
+        assert resp.status_code == 207
+        assert resp.json["created"] == 1
+        assert [error["index"] for error in resp.json["errors"]] == [1, 2]
+        resp = client.post(self.SENSOR_RESOURCE_URL, data="[%s]" % (item % "Infinity"),
+                           content_type="application/json")
+        assert resp.status_code == 400
+        assert resp.json["failed"] == 1
+        resp = client.get(self.SENSOR_RESOURCE_URL)
+        assert len(resp.json) == 2
+
+    def test_get_infinity(self, client):
+        """test that stored infinite values are encoded like json.dumps does"""
+        with client.application.app_context():
+            meas = _get_measurement(temperature=float("inf"), humidity=float("-inf"))
+            meas.timestamp = datetime(2024, 1, 1)
+            meas.sensor = Sensor.query.filter_by(name="testsensor-1").one()
+            db.session.add(meas)
+            db.session.commit()
+            expected = json.dumps(meas.serialize())
+        resp = client.get(self.SENSOR_RESOURCE_URL + "?to=2024-01-02")
+        assert resp.get_data(as_text=True) == "[" + expected + "]"
+
+    def test_get_offset_bounds(self, client):
+        """test that from and to with an offset are compared in UTC"""
+        client.post(self.SENSOR_RESOURCE_URL, json={"temperature": 1.0, "humidity": 1.0,
+                                                    "timestamp": "2024-01-01T00:30:00Z"})
+        bound = "2024-01-01T01:00:00%2B02:00"
+        resp = client.get(self.SENSOR_RESOURCE_URL + "?from=" + bound)
+        assert "2024-01-01T00:30:00" in [meas["timestamp"] for meas in resp.json]
+        resp = client.get(self.SENSOR_RESOURCE_URL + "?to=" + bound)
+        assert "2024-01-01T00:30:00" not in [meas["timestamp"] for meas in resp.json]
+
+    def test_post_empty(self, client):
+        """test that an empty JSON list or object is a bad request"""
+        for data in ([], {}):
+            resp = client.post(self.SENSOR_RESOURCE_URL, json=data)
+            assert resp.status_code == 400
+        resp = client.post(self.SENSOR_RESOURCE_URL, data="[]", content_type="text/plain")
+        assert resp.status_code == 415
+
+    def test_post_ndjson(self, client):
+        """test posting newline delimited measurements"""
+        lines = [json.dumps(_get_measurement().serialize(short_form=True)) for _ in range(3)]
+        lines.append("{not json")
+        resp = client.post(self.SENSOR_RESOURCE_URL,
+                           data="\n".join(lines),
+                           content_type="application/x-ndjson")
+        assert resp.status_code == 207
+        assert resp.json["created"] == 3
+        assert resp.json["errors"][0]["index"] == 3
+        resp = client.get(self.SENSOR_RESOURCE_URL)
+        assert len(resp.json) == 4
+        for meas in resp.json:
+            assert meas["location"]["name"] == "testlocation-1"
+
+    def test_buffer_poison(self, buffered_client):
+        """test that a failing request doesn't fail the others of its batch"""
+        buffer = buffered_client.application.extensions["measurement_buffer"]
+        with buffered_client.application.app_context():
+            sensor = Sensor.query.filter_by(name="testsensor-1").one()
+            good = {"sensor_id": sensor.id, "location_id": sensor.location_id,
+                    "temperature": 1.0, "humidity": 1.0, "timestamp": datetime(2024, 1, 1)}
+        # In the same batch
+        with buffer._cond:
+            poison = buffer.submit([{**good, "temperature": None}])
+            fine = buffer.submit([good])
+        with pytest.raises(Exception):
+            poison.result(timeout=5)
+        ids, duplicates = fine.result(timeout=5)
+        assert len(ids) == 1
+        assert duplicates == []
+        resp = buffered_client.get(self.SENSOR_RESOURCE_URL + "?from=2024-01-01&to=2024-01-02")
+        assert len(resp.json) == 1
+
+    def test_post_buffered(self, buffered_client):
+        """test posting measurements through the write buffer"""
+        buffer = buffered_client.application.extensions["measurement_buffer"]
+        single = _get_measurement().serialize(short_form=True)
+        bulk = [_get_measurement(temperature=i).serialize(short_form=True) for i in range(3)]
+        resp = buffered_client.post(self.SENSOR_RESOURCE_URL, json=single)
+        resp_bulk = buffered_client.post(self.SENSOR_RESOURCE_URL, json=bulk)
+        if buffer.ack == "flush":
+            assert resp.status_code == 201
+            assert "Location" in resp.headers
+            assert resp_bulk.status_code == 201
+        else:
+            assert resp.status_code == 202
+            assert resp_bulk.status_code == 202
+            time.sleep(0.2)
+        resp = buffered_client.get(self.SENSOR_RESOURCE_URL)
+        assert len(resp.json) == 5
+
+    def test_get_paginated(self, client):
+        """test walking the measurement collection page by page"""
+        data = [
+            {"temperature": i, "humidity": 50.0, "timestamp": f"2024-01-01T00:{i:02d}:00"}
+            for i in range(10)
+        ]
+        client.post(self.SENSOR_RESOURCE_URL, json=data)
+
+        resp = client.get(self.SENSOR_RESOURCE_URL + "?to=2024-01-02&limit=4")
+        assert resp.status_code == 200
+        assert [meas["temperature"] for meas in resp.json] == [0, 1, 2, 3]
+        assert 'rel="prev"' not in resp.headers["Link"]
+
+        seen = []
+        url = self.SENSOR_RESOURCE_URL + "?to=2024-01-02&limit=4"
+        while url:
+            resp = client.get(url)
+            seen.extend(meas["temperature"] for meas in resp.json)
+            links = resp.headers.get("Link", "")
+            url = None
+            for link in links.split(", "):
+                if link.endswith('rel="next"'):
+                    url = link[1:link.index(">")]
+        assert seen == list(range(10))
+
+        # walk back from the last page
+        prev_url = [link[1:link.index(">")] for link in links.split(", ")
+                    if link.endswith('rel="prev"')][0]
+        resp = client.get(prev_url)
+        assert [meas["temperature"] for meas in resp.json] == [4, 5, 6, 7]
+
+    def test_get_streamed(self, client):
+        """test that a large page is streamed and still valid JSON"""
+        data = [_get_measurement(temperature=i).serialize(short_form=True) for i in range(1500)]
+        client.post(self.SENSOR_RESOURCE_URL, json=data)
+        resp = client.get(self.SENSOR_RESOURCE_URL + "?limit=2000")
+        assert resp.is_streamed
+        body = json.loads(resp.data)
+        assert len(body) == 1501
+        validate(body[-1], Measurement.get_schema())
+
+    def test_get_time_range(self, client):
+        """test from and to filters"""
+        data = [
+            {"temperature": i, "humidity": 50.0, "timestamp": f"2024-01-0{i + 1}T12:00:00"}
+            for i in range(5)
+        ]
+        client.post(self.SENSOR_RESOURCE_URL, json=data)
+        resp = client.get(self.SENSOR_RESOURCE_URL + "?from=2024-01-02&to=2024-01-04")
+        assert resp.status_code == 200
+        assert [meas["temperature"] for meas in resp.json] == [1, 2]
+        assert "Link" not in resp.headers
+
+    def test_get_bad_args(self, client):
+        """test invalid pagination arguments"""
+        assert client.get(self.SENSOR_RESOURCE_URL + "?from=yesterday").status_code == 400
+        assert client.get(self.SENSOR_RESOURCE_URL + "?limit=0").status_code == 400
+        assert client.get(self.SENSOR_RESOURCE_URL + "?cursor=foo").status_code == 400
+
+class TestMeasurementSeries():
+    """Tests for aligned series of several sensors"""
+
+    RESOURCE_URL = ("/api/measurements/?from=2024-01-01T00:00:00&to=2024-01-02T00:00:00"
+                    "&bucket=1h&sensors=")
+
+    @staticmethod
+    def _post_measurements(client):
+        for sensor, hours in (("testsensor-1", (0, 1, 3)), ("testsensor-2", (1, 2))):
+            client.post(f"/api/sensors/{sensor}/measurements/", json=[
+                {"temperature": float(hour), "humidity": 50.0,
+                 "timestamp": f"2024-01-01T0{hour}:30:00"}
+                for hour in hours
+            ])
+
+    def test_get(self, client):
+        """test that series are aligned on the union of their buckets"""
+        self._post_measurements(client)
+        resp = client.get(self.RESOURCE_URL + "testsensor-2,testsensor-1,testsensor-3")
+        assert resp.status_code == 200
+        body = resp.json
+        assert body["bucket"] == 3600
+        assert body["start"] == [f"2024-01-01T0{hour}:00:00" for hour in range(4)]
+        assert [series["sensor"] for series in body["series"]] == [
+            "testsensor-2", "testsensor-1", "testsensor-3"
+        ]
+        second, first, third = [series["buckets"] for series in body["series"]]
+        assert [bucket and bucket["temperature"]["avg"] for bucket in first] == [
+            0.0, 1.0, None, 3.0
+        ]
+        assert [bucket and bucket["count"] for bucket in second] == [None, 1, 1, None]
+        assert third == [None] * 4
+        single = client.get("/api/sensors/testsensor-1/measurements/aggregate/?"
+                            + self.RESOURCE_URL.split("?")[1].replace("&sensors=", ""))
+        assert [bucket for bucket in first if bucket] == single.json
+
+    def test_sequential(self, client):
+        """test that reading the series one by one gives the same result"""
+        self._post_measurements(client)
+        url = self.RESOURCE_URL + "testsensor-1,testsensor-2"
+        parallel = client.get(url).json
+        client.application.extensions.pop("series_executor").shutdown()
+        assert client.get(url).json == parallel
+
+    def test_bad_requests(self, client):
+        """test missing, unknown and too many sensors"""
+        assert client.get("/api/measurements/").status_code == 400
+        assert client.get(self.RESOURCE_URL + "testsensor-1,nope").status_code == 404
+        client.application.config["SERIES_MAX_SENSORS"] = 1
+        assert client.get(self.RESOURCE_URL + "testsensor-1,testsensor-2").status_code == 400
+        # duplicates count once
+        assert client.get(self.RESOURCE_URL + "testsensor-1,testsensor-1").status_code == 200
+        assert client.get("/api/measurements/?sensors=testsensor-1&bucket=1x").status_code == 400
+
+class TestDeduplication():
+    """Tests for idempotent measurement uploads"""
+
+    SENSOR_RESOURCE_URL = "/api/sensors/testsensor-1/measurements/"
+    AGGREGATE_URL = ("/api/sensors/testsensor-1/measurements/aggregate/"
+                     "?bucket=1h&from=2024-01-01T00:00:00&to=2024-01-02T00:00:00")
+
+    @staticmethod
+    def _measurements(client):
+        resp = client.get(TestDeduplication.SENSOR_RESOURCE_URL
+                          + "?from=2024-01-01&to=2024-01-02")
+        return [(meas["timestamp"], meas["temperature"]) for meas in resp.json]
+
+    def test_single(self, dedup_client):
+        """test that a retried single upload points to the stored measurement"""
+        data = {"temperature": 20.0, "humidity": 40.0, "timestamp": "2024-01-01T00:00:00"}
+        resp = dedup_client.post(self.SENSOR_RESOURCE_URL, json=data)
+        assert resp.status_code == 201
+        location = resp.headers["Location"]
+        resp = dedup_client.post(self.SENSOR_RESOURCE_URL, json={**data, "temperature": 21.0})
+        assert resp.status_code == 200
+        assert resp.headers["Location"] == location
+        mode = dedup_client.application.config["MEASUREMENT_DEDUPLICATE"]
+        expected = 20.0 if mode == "ignore" else 21.0
+        assert self._measurements(dedup_client) == [("2024-01-01T00:00:00", expected)]
+        assert dedup_client.get(location).json["temperature"] == expected
+
+    def test_bulk(self, dedup_client):
+        """test that duplicates are counted and rollups and latest stay right"""
+        data = [
+            {"temperature": float(i), "humidity": 40.0, "timestamp": f"2024-01-01T00:0{i}:00"}
+            for i in range(3)
+        ]
+        resp = dedup_client.post(self.SENSOR_RESOURCE_URL, json=data)
+        assert resp.json["created"] == 3
+        assert resp.json["deduplicated"] == 0
+
+        # a retry of the last two, one of them twice, and one new
+        retry = [{**item, "temperature": item["temperature"] + 10} for item in data[1:]]
+        retry += [{**data[2], "temperature": 30.0},
+                  {"temperature": 5.0, "humidity": 40.0, "timestamp": "2024-01-01T00:05:00"}]
+        resp = dedup_client.post(self.SENSOR_RESOURCE_URL, json=retry)
+        assert resp.status_code == 201
+        assert resp.json["created"] == 1
+        assert resp.json["deduplicated"] == 3
+
+        if dedup_client.application.config["MEASUREMENT_DEDUPLICATE"] == "ignore":
+            temperatures = [0.0, 1.0, 2.0, 5.0]
+        else:
+            temperatures = [0.0, 11.0, 30.0, 5.0]
+        stored = self._measurements(dedup_client)
+        assert [temperature for _, temperature in stored] == temperatures
+
+        bucket = dedup_client.get(self.AGGREGATE_URL).json[0]
+        assert bucket["count"] == 4
+        assert bucket["temperature"]["max"] == max(temperatures)
+        assert bucket["temperature"]["avg"] == sum(temperatures) / 4
+        raw = dedup_client.get(self.AGGREGATE_URL.replace("bucket=1h", "bucket=30m")).json[0]
+        assert raw["temperature"] == bucket["temperature"]
+
+    def test_put_conflict(self, dedup_client):
+        """test that moving a measurement onto a taken timestamp is a conflict"""
+        data = {"temperature": 20.0, "humidity": 40.0, "timestamp": "2024-01-01T00:00:00"}
+        dedup_client.post(self.SENSOR_RESOURCE_URL, json=data)
+        resp = dedup_client.post(self.SENSOR_RESOURCE_URL,
+                                 json={**data, "timestamp": "2024-01-01T00:01:00"})
+        resp = dedup_client.put(resp.headers["Location"], json={**data, "temperature": 21.0})
+        assert resp.status_code == 409
+        assert self._measurements(dedup_client) == [("2024-01-01T00:00:00", 20.0),
+                                                    ("2024-01-01T00:01:00", 20.0)]
+
+    def test_archived(self, dedup_client):
+        """test that retries of archived measurements are not stored again"""
+        data = {"temperature": 20.0, "humidity": 40.0, "timestamp": "2024-01-01T00:00:00"}
+        location = dedup_client.post(self.SENSOR_RESOURCE_URL, json=data).headers["Location"]
+        runner = dedup_client.application.test_cli_runner()
+        runner.invoke(args=["partitions", "archive", "--before", "2024-02-01"])
+
+        resp = dedup_client.post(self.SENSOR_RESOURCE_URL, json={**data, "temperature": 21.0})
+        assert resp.status_code == 200
+        assert resp.headers["Location"] == location
+        new = {**data, "timestamp": "2024-01-01T00:01:00"}
+        resp = dedup_client.post(self.SENSOR_RESOURCE_URL, json=[data, new])
+        assert resp.json["created"] == 1
+        assert resp.json["deduplicated"] == 1
+        # archived measurements are kept as they are in both modes
+        assert self._measurements(dedup_client) == [("2024-01-01T00:00:00", 20.0),
+                                                    ("2024-01-01T00:01:00", 20.0)]
+
+        # a retry answers with the location of the stored one
+        new_location = dedup_client.post(self.SENSOR_RESOURCE_URL, json=new).headers["Location"]
+        resp = dedup_client.put(new_location, json=data)
+        assert resp.status_code == 409
+
+    def test_cli(self, client):
+        """test that deduplicate-measurements removes duplicates and adds the index"""
+        data = {"temperature": 20.0, "humidity": 40.0, "timestamp": "2024-01-01T00:00:00"}
+        for temperature in (20.0, 21.0, 22.0):
+            client.post(self.SENSOR_RESOURCE_URL, json={**data, "temperature": temperature})
+        assert len(self._measurements(client)) == 3
+
+        # raw measurements removed by retention, only the rollups are left
+        client.post(self.SENSOR_RESOURCE_URL,
+                    json={**data, "timestamp": "2023-06-01T12:00:00"})
+        with client.application.app_context():
+            db.session.execute(db.delete(Measurement)
+                               .where(Measurement.timestamp < datetime(2024, 1, 1)))
+            db.session.commit()
+        old_url = ("/api/sensors/testsensor-1/measurements/aggregate/"
+                   "?bucket=1d&from=2023-06-01T00:00:00&to=2023-06-02T00:00:00")
+        assert client.get(old_url).json[0]["count"] == 1
+
+        runner = client.application.test_cli_runner()
+        result = runner.invoke(args=["deduplicate-measurements", "--keep", "last"])
+        assert result.exit_code == 0
+        assert "Deleted 2 duplicate" in result.output
+        assert self._measurements(client) == [("2024-01-01T00:00:00", 22.0)]
+        bucket = client.get(self.AGGREGATE_URL).json[0]
+        assert bucket["count"] == 1
+        assert client.get(old_url).json[0]["count"] == 1
+
+        client.application.config["MEASUREMENT_DEDUPLICATE"] = "ignore"
+        resp = client.post(self.SENSOR_RESOURCE_URL, json=data)
+        assert resp.status_code == 200
+
+    def test_unknown_mode(self):
+        """test that a typo in the mode is not silently ignored"""
+        with pytest.raises(ValueError):
+            create_app({"SQLALCHEMY_DATABASE_URI": "sqlite://",
+                        "MEASUREMENT_DEDUPLICATE": "skip"})
+
+class TestMeasurementAggregateResource():
+    """Tests for measurement aggregate resource"""
+
+    SENSOR_RESOURCE_URL = "/api/sensors/testsensor-1/measurements/aggregate/"
+    LOCATION_RESOURCE_URL = "/api/locations/testlocation-1/measurements/aggregate/"
+
+    @staticmethod
+    def _post_measurements(client):
+        data = [
+            {"temperature": 10 + i, "humidity": 40 + i,
+             "timestamp": f"2024-01-01T{i // 4:02d}:{i % 4 * 15:02d}:00"}
+            for i in range(8)
+        ]
+        client.post("/api/sensors/testsensor-1/measurements/", json=data)
+
+    def test_get_by_sensor(self, client):
+        """test hourly buckets by sensor"""
+        self._post_measurements(client)
+        resp = client.get(self.SENSOR_RESOURCE_URL + "?bucket=1h&to=2024-01-02")
+        assert resp.status_code == 200
+        assert resp.json == [
+            {"start": "2024-01-01T00:00:00", "count": 4,
+             "temperature": {"min": 10, "avg": 11.5, "max": 13},
+             "humidity": {"min": 40, "avg": 41.5, "max": 43}},
+            {"start": "2024-01-01T01:00:00", "count": 4,
+             "temperature": {"min": 14, "avg": 15.5, "max": 17},
+             "humidity": {"min": 44, "avg": 45.5, "max": 47}},
+        ]
+
+    def test_get_by_location(self, client):
+        """test buckets by location with time range"""
+        self._post_measurements(client)
+        resp = client.get(self.LOCATION_RESOURCE_URL
+                          + "?bucket=30m&from=2024-01-01T00:30:00&to=2024-01-01T01:00:00")
+        assert resp.status_code == 200
+        assert len(resp.json) == 1
+        assert resp.json[0]["start"] == "2024-01-01T00:30:00"
+        assert resp.json[0]["count"] == 2
+
+    def test_rollups_match_raw(self, client):
+        """test that rollup backed buckets match buckets computed from raw data"""
+        self._post_measurements(client)
+        rollup = client.get(self.SENSOR_RESOURCE_URL + "?bucket=1h&to=2024-01-02").json
+        raw = client.get(self.SENSOR_RESOURCE_URL + "?bucket=60m&to=2024-01-01T23:59:00").json
+        assert rollup == raw
+
+    def test_rollups_after_delete(self, client):
+        """test that deleting a measurement is reflected in rollups"""
+        resp = client.post("/api/sensors/testsensor-1/measurements/",
+                           json={"temperature": 30.0, "humidity": 30.0,
+                                 "timestamp": "2024-01-01T00:10:00"})
+        self._post_measurements(client)
+        client.delete(resp.headers["Location"])
+        resp = client.get(self.SENSOR_RESOURCE_URL + "?bucket=1d&to=2024-01-02")
+        assert resp.json[0]["count"] == 8
+        assert resp.json[0]["temperature"]["max"] == 17
+
+    def test_get_bad_bucket(self, client):
+        """test invalid bucket sizes"""
+        for bucket in ("0h", "1w", "hour"):
+            resp = client.get(self.SENSOR_RESOURCE_URL + "?bucket=" + bucket)
+            assert resp.status_code == 400
+
+class TestAlarms():
+    """Tests for threshold alarms"""
+
+    SENSOR_URL = "/api/sensors/testsensor-1/"
+    ALARMS_URL = "/api/sensors/testsensor-1/alarms/"
+
+    @staticmethod
+    def _configure(client, threshold_min, threshold_max):
+        configuration = {"interval": 60}
+        if threshold_min is not None:
+            configuration["threshold_min"] = threshold_min
+        if threshold_max is not None:
+            configuration["threshold_max"] = threshold_max
+        resp = client.put(TestAlarms.SENSOR_URL, json={
+            "name": "testsensor-1",
+            "sensor_configuration": configuration
+        })
+        assert resp.status_code == 200
+
+    @staticmethod
+    def _post(client, *temperatures, hour=0):
+        data = [{"temperature": temperature, "humidity": 40,
+                 "timestamp": f"2024-01-01T{hour:02d}:{minute:02d}:00"}
+                for minute, temperature in enumerate(temperatures)]
+        resp = client.post("/api/sensors/testsensor-1/measurements/", json=data)
+        assert resp.status_code == 201
+
+    def test_hysteresis(self, client):
+        """test that alarms open above the limit and close inside the margin"""
+        self._configure(client, 15, 22)
+        self._post(client, 20, 23, 24, 22, 21.5, 14)
+
+        alarms = client.get(self.ALARMS_URL).json
+        assert len(alarms) == 2
+        low, high = alarms
+        assert high == {"kind": "high", "threshold": 22, "opened": "2024-01-01T00:01:00",
+                        "opened_value": 23, "closed": "2024-01-01T00:04:00",
+                        "closed_value": 21.5}
+        assert low["kind"] == "low"
+        assert low["closed"] is None
+
+        open_alarms = client.get("/api/alarms/?state=open").json
+        assert [(alarm["sensor"]["name"], alarm["kind"]) for alarm in open_alarms] == [
+            ("testsensor-1", "low")
+        ]
+
+        # closed by a later batch from the cached state
+        self._post(client, 15.2, 15.5, hour=1)
+        resp = client.get(self.ALARMS_URL + "?state=open")
+        assert resp.json == []
+        closed = client.get(self.ALARMS_URL + "?state=closed").json
+        assert closed[0]["closed"] == "2024-01-01T01:01:00"
+
+    def test_offset_timestamps(self, client):
+        """test that alarms opened by naive timestamps are closed by UTC ones"""
+        self._configure(client, None, 22)
+        self._post(client, 25)
+        resp = client.post("/api/sensors/testsensor-1/measurements/", json=[
+            {"temperature": 21, "humidity": 40, "timestamp": "2024-01-02T01:00:00Z"},
+            {"temperature": 26, "humidity": 40, "timestamp": "2024-01-02T03:30:00+03:00"},
+            {"temperature": 25, "humidity": 40, "timestamp": "2024-01-02T00:30:00"},
+        ])
+        assert resp.status_code == 201
+        alarms = client.get(self.ALARMS_URL).json
+        assert [(alarm["opened"], alarm["closed"]) for alarm in alarms] == [
+            ("2024-01-01T00:00:00", "2024-01-02T01:00:00")
+        ]
+
+    def test_configuration_change(self, client):
+        """test that a new configuration is used right away"""
+        self._configure(client, None, 22)
+        self._post(client, 25)
+        self._configure(client, None, 30)
+        self._post(client, 25, hour=1)
+        assert client.get(self.ALARMS_URL + "?state=open").json == []
+        self._post(client, 31, hour=2)
+        assert len(client.get(self.ALARMS_URL + "?state=open").json) == 1
+
+    def test_bad_state(self, client):
+        """test invalid state filter"""
+        assert client.get(self.ALARMS_URL + "?state=maybe").status_code == 400
+
+class TestLatest():
+    """Tests for latest measurement resources"""
+
+    SENSOR_RESOURCE_URL = "/api/sensors/testsensor-1/measurements/latest/"
+    LOCATION_RESOURCE_URL = "/api/locations/testlocation-1/latest/"
+
+    @staticmethod
+    def _post(client, sensor, *timestamps):
+        resp = client.post(f"/api/sensors/{sensor}/measurements/", json=[
+            {"temperature": float(i), "humidity": 40.0, "timestamp": timestamp}
+            for i, timestamp in enumerate(timestamps)
+        ])
+        assert resp.status_code == 201
+
+    def test_get_by_sensor(self, client):
+        """test that the newest measurement wins, also over late ones"""
+        self._post(client, "testsensor-1", "2030-01-01T12:00:00", "2030-01-01T11:00:00")
+        resp = client.get(self.SENSOR_RESOURCE_URL)
+        assert resp.status_code == 200
+        assert resp.json == {"temperature": 0.0, "humidity": 40.0,
+                             "timestamp": "2030-01-01T12:00:00",
+                             "sensor": {"name": "testsensor-1"},
+                             "location": {"name": "testlocation-1"}}
+        self._post(client, "testsensor-1", "2030-01-01T10:00:00")
+        assert client.get(self.SENSOR_RESOURCE_URL).json["timestamp"] == "2030-01-01T12:00:00"
+
+    def test_delete_latest(self, client):
+        """test that deleting the latest measurement brings back the previous one"""
+        self._post(client, "testsensor-1", "2030-01-01T11:00:00")
+        resp = client.post("/api/sensors/testsensor-1/measurements/",
+                           json={"temperature": 1.0, "humidity": 1.0,
+                                 "timestamp": "2030-01-01T12:00:00"})
+        client.delete(resp.headers["Location"])
+        assert client.get(self.SENSOR_RESOURCE_URL).json["timestamp"] == "2030-01-01T11:00:00"
+
+    def test_get_by_location(self, client):
+        """test latest measurements of every sensor in a location"""
+        client.put("/api/locations/testlocation-1/link/sensors/testsensor-2/")
+        self._post(client, "testsensor-2", "2030-01-01T12:00:00")
+        resp = client.get(self.LOCATION_RESOURCE_URL)
+        assert resp.status_code == 200
+        assert [meas["sensor"]["name"] for meas in resp.json] == ["testsensor-1", "testsensor-2"]
+        assert resp.json[1]["timestamp"] == "2030-01-01T12:00:00"
+
+    def test_mixed_offsets(self, client):
+        """test that timestamps with an offset are compared in UTC"""
+        self._post(client, "testsensor-1", "2030-01-01T12:00:00", "2030-01-01T13:00:00Z",
+                   "2030-01-01T15:30:00+03:00")
+        resp = client.get(self.SENSOR_RESOURCE_URL)
+        assert resp.json["timestamp"] == "2030-01-01T13:00:00"
+        assert resp.json["temperature"] == 1.0
+
+    def test_no_measurements(self, client):
+        """test sensor without measurements"""
+        client.post("/api/sensors/", json={"name": "empty",
+                                           "sensor_configuration": {"interval": 60}})
+        resp = client.get("/api/sensors/empty/measurements/latest/")
+        assert resp.status_code == 404
+
+class TestMeasurementExport():
+    """Tests for CSV export of measurements"""
+
+    SENSOR_RESOURCE_URL = "/api/sensors/testsensor-1/measurements.csv"
+    LOCATION_RESOURCE_URL = "/api/locations/testlocation-1/measurements.csv"
+
+    @staticmethod
+    def _post_measurements(client):
+        data = [
+            {"temperature": 20 + i, "humidity": 40.5, "timestamp": f"2024-01-01T0{i}:00:00"}
+            for i in range(5)
+        ]
+        client.post("/api/sensors/testsensor-1/measurements/", json=data)
+
+    def test_get_by_sensor(self, client):
+        """test csv export by sensor with a time range"""
+        self._post_measurements(client)
+        resp = client.get(self.SENSOR_RESOURCE_URL
+                          + "?from=2024-01-01T01:00:00&to=2024-01-01T03:00:00")
+        assert resp.status_code == 200
+        assert resp.mimetype == "text/csv"
+        assert resp.is_streamed
+        assert resp.get_data(as_text=True) == (
+            "timestamp,sensor,location,temperature,humidity\n"
+            "2024-01-01T01:00:00,testsensor-1,testlocation-1,21.0,40.5\n"
+            "2024-01-01T02:00:00,testsensor-1,testlocation-1,22.0,40.5\n"
+        )
+
+    def test_get_by_location(self, client):
+        """test csv export by location matches the JSON collection"""
+        self._post_measurements(client)
+        lines = client.get(self.LOCATION_RESOURCE_URL).get_data(as_text=True).splitlines()
+        body = client.get("/api/locations/testlocation-1/measurements/").json
+        assert len(lines) == len(body) + 1
+        assert [line.split(",")[0] for line in lines[1:]] == [
+            meas["timestamp"] for meas in body
+        ]
+        resp = client.get(self.LOCATION_RESOURCE_URL + "?from=yesterday")
+        assert resp.status_code == 400
+
+    def test_cli(self, client, tmp_path):
+        """test export-measurements command"""
+        self._post_measurements(client)
+        runner = client.application.test_cli_runner()
+        output = tmp_path / "export.csv"
+        result = runner.invoke(args=["export-measurements", "--sensor", "testsensor-1",
+                                     "--end", "2024-01-02", "--output", str(output)])
+        assert result.exit_code == 0
+        assert output.read_text() == client.get(
+            self.SENSOR_RESOURCE_URL + "?to=2024-01-02").get_data(as_text=True)
+        result = runner.invoke(args=["export-measurements", "--location", "nowhere"])
+        assert result.exit_code != 0
+        result = runner.invoke(args=["export-measurements"])
+        assert result.exit_code != 0
+
+class TestPartitions():
+    """Tests for reading measurements from monthly partitions"""
+
+    SENSOR_RESOURCE_URL = "/api/sensors/testsensor-1/measurements/"
+
+    @staticmethod
+    def _post_measurements(client):
+        data = [
+            {"temperature": 10 + i, "humidity": 40 + i,
+             "timestamp": f"2024-{i % 3 + 1:02d}-{i + 1:02d}T12:00:00"}
+            for i in range(9)
+        ]
+        client.post(TestPartitions.SENSOR_RESOURCE_URL, json=data)
+
+    @staticmethod
+    def _get_all(client, url):
+        items = []
+        while url:
+            resp = client.get(url)
+            items.extend(resp.json)
+            url = None
+            for link in resp.headers.get("Link", "").split(", "):
+                if link.endswith('rel="next"'):
+                    url = link[1:link.index(">")]
+        return items
+
+    def test_archive(self, client):
+        """test that archiving doesn't change what is returned"""
+        self._post_measurements(client)
+        url = self.SENSOR_RESOURCE_URL + "?to=2024-04-01&limit=2"
+        aggregate_url = self.SENSOR_RESOURCE_URL + "aggregate/?bucket=7d&to=2024-04-01"
+        before = self._get_all(client, url)
+        aggregate = client.get(aggregate_url).json
+        assert len(before) == 9
+
+        runner = client.application.test_cli_runner()
+        result = runner.invoke(args=["partitions", "archive", "--before", "2024-03-15"])
+        assert result.exit_code == 0
+        assert "measurement_202401\t3" in result.output
+        assert "measurement_202402\t3" in result.output
+        with client.application.app_context():
+            assert Measurement.query.filter(
+                Measurement.timestamp < datetime(2024, 3, 1)).count() == 0
+
+        assert self._get_all(client, url) == before
+        assert client.get(aggregate_url).json == aggregate
+        resp = client.get(self.SENSOR_RESOURCE_URL + "?from=2024-02-01&to=2024-03-01")
+        assert [meas["timestamp"][:7] for meas in resp.json] == ["2024-02"] * 3
+
+    def test_archived_readers(self, client):
+        """test that archived measurements are found by id and location expands"""
+        self._post_measurements(client)
+        resp = client.post(self.SENSOR_RESOURCE_URL, json={
+            "temperature": 1.0, "humidity": 1.0, "timestamp": "2024-01-20T00:00:00"})
+        item_url = resp.headers["Location"]
+        runner = client.application.test_cli_runner()
+        runner.invoke(args=["partitions", "archive", "--before", "2024-03-01"])
+
+        resp = client.get(item_url)
+        assert resp.status_code == 200
+        assert resp.json["timestamp"] == "2024-01-20T00:00:00"
+        resp = client.put(item_url, json={"temperature": 2.0, "humidity": 1.0,
+                                          "timestamp": "2024-01-20T00:00:00"})
+        assert resp.status_code == 409
+        assert client.delete(item_url).status_code == 409
+        assert client.get(item_url).json["temperature"] == 1.0
+
+        for url in ("/api/locations/testlocation-1/?expand=measurements",
+                    "/api/locations/testlocation-1/?expand=measurements:latest:20"):
+            timestamps = [meas["timestamp"] for meas in client.get(url).json["measurements"]]
+            assert "2024-01-20T00:00:00" in timestamps
+            assert timestamps == sorted(timestamps)
+        locations = client.get("/api/locations/?expand=measurements").json
+        location = next(loc for loc in locations if loc["name"] == "testlocation-1")
+        assert len(location["measurements"]) == 11
+
+    def test_export(self, client):
+        """test that CSV export merges partitions in order without sorting"""
+        self._post_measurements(client)
+        csv_url = "/api/sensors/testsensor-1/measurements.csv?to=2024-04-01"
+        before = client.get(csv_url).get_data(as_text=True)
+        runner = client.application.test_cli_runner()
+        runner.invoke(args=["partitions", "archive", "--before", "2024-03-01"])
+        assert client.get(csv_url).get_data(as_text=True) == before
+
+        with client.application.app_context():
+            sensor = Sensor.query.filter_by(name="testsensor-1").first()
+            stmt = export_query("sensor_id", sensor.id)
+            compiled = stmt.compile(db.engine, compile_kwargs={"literal_binds": True})
+            plan = db.session.execute(db.text(f"EXPLAIN QUERY PLAN {compiled}")).all()
+        details = [row[-1] for row in plan]
+        assert "MERGE (UNION ALL)" in details
+        assert not [detail for detail in details if "TEMP B-TREE" in detail]
+
+    @staticmethod
+    def _link(client, url, rel):
+        resp = client.get(url)
+        resp.close()
+        return [link[1:link.index(">")] for link in resp.headers["Link"].split(", ")
+                if link.endswith(f'rel="{rel}"')][0]
+
+    def test_page_plan(self, client):
+        """test that pages are merged from partitions in index order without sorting"""
+        self._post_measurements(client)
+        runner = client.application.test_cli_runner()
+        runner.invoke(args=["partitions", "archive", "--before", "2024-03-01"])
+
+        for url in (self.SENSOR_RESOURCE_URL + "?limit=2",
+                    "/api/locations/testlocation-1/measurements/?limit=2"):
+            next_url = self._link(client, url, "next")
+            prev_url = self._link(client, next_url, "prev")
+            for page_url in (url, next_url, prev_url):
+                with _QueryCounter(client.application) as counter:
+                    client.get(page_url).close()
+                # keys and the page
+                queries = [(statement, parameters) for statement, parameters
+                           in zip(counter.statements, counter.parameters)
+                           if "UNION ALL" in statement]
+                assert len(queries) == 2
+                with client.application.app_context():
+                    for statement, parameters in queries:
+                        plan = db.session.connection().exec_driver_sql(
+                            "EXPLAIN QUERY PLAN " + statement, parameters).all()
+                        details = [row[-1] for row in plan]
+                        assert "MERGE (UNION ALL)" in details
+                        assert not [detail for detail in details if "TEMP B-TREE" in detail]
+
+    def test_detach_and_drop(self, client):
+        """test that detached and dropped partitions are left out"""
+        self._post_measurements(client)
+        runner = client.application.test_cli_runner()
+        runner.invoke(args=["partitions", "archive", "--before", "2024-03-01"])
+        etag = client.get(self.SENSOR_RESOURCE_URL).headers["ETag"]
+
+        result = runner.invoke(args=["partitions", "detach", "measurement_202401"])
+        assert result.exit_code == 0
+        resp = client.get(self.SENSOR_RESOURCE_URL, headers={"If-None-Match": etag})
+        assert resp.status_code == 200
+        assert len(resp.json) == 7
+
+        runner.invoke(args=["partitions", "attach", "measurement_202401"])
+        assert len(client.get(self.SENSOR_RESOURCE_URL).json) == 10
+
+        result = runner.invoke(args=["partitions", "drop", "measurement_202402"])
+        assert result.exit_code == 0
+        assert len(client.get(self.SENSOR_RESOURCE_URL).json) == 7
+        result = runner.invoke(args=["partitions", "list"])
+        assert "measurement_202401" in result.output
+        assert "measurement_202402" not in result.output
+        # rollups of dropped months are kept
+        resp = client.get(self.SENSOR_RESOURCE_URL + "aggregate/?bucket=1d&to=2024-04-01")
+        assert sum(bucket["count"] for bucket in resp.json) == 9
+
+        result = runner.invoke(args=["partitions", "drop", "measurement_202402"])
+        assert result.exit_code != 0
+
+class TestRepresentation():
+    """Tests for fields and expand query parameters"""
+
+    def test_location_default(self, client):
+        """test that measurements are not embedded by default"""
+        resp = client.get("/api/locations/testlocation-1/")
+        assert resp.json == {"name": "testlocation-1", "sensors": [{"name": "testsensor-1"}]}
+        for loc in client.get("/api/locations/").json:
+            assert "measurements" not in loc
+
+    def test_location_expand(self, client):
+        """test embedding the latest measurements of locations"""
+        data = [
+            {"temperature": i, "humidity": 50.0, "timestamp": f"2030-01-01T00:0{i}:00"}
+            for i in range(5)
+        ]
+        client.post("/api/sensors/testsensor-1/measurements/", json=data)
+        resp = client.get("/api/locations/testlocation-1/?expand=measurements:latest:2")
+        assert resp.status_code == 200
+        assert "sensors" not in resp.json
+        assert [meas["temperature"] for meas in resp.json["measurements"]] == [3, 4]
+
+        resp = client.get("/api/locations/?expand=sensors,measurements:latest:2")
+        assert resp.status_code == 200
+        for loc in resp.json:
+            if loc["name"] == "testlocation-1":
+                assert [meas["temperature"] for meas in loc["measurements"]] == [3, 4]
+            else:
+                assert len(loc["measurements"]) == 1
+            assert len(loc["sensors"]) == 1
+
+        resp = client.get("/api/locations/?expand=measurements")
+        assert sum(len(loc["measurements"]) for loc in resp.json) == 8
+
+    def test_fields(self, client):
+        """test sparse fieldsets"""
+        resp = client.get("/api/sensors/?fields=name")
+        assert resp.json == [{"name": f"testsensor-{i}"} for i in range(1, 4)]
+        resp = client.get("/api/sensors/testsensor-1/?fields=name,location")
+        assert resp.json == {"name": "testsensor-1", "location": {"name": "testlocation-1"}}
+        resp = client.get("/api/locations/testlocation-1/?fields=sensors")
+        assert resp.json == {"sensors": [{"name": "testsensor-1"}]}
+
+    def test_bad_expand(self, client):
+        """test invalid expand parameters"""
+        for url in ("/api/locations/?expand=foo",
+                    "/api/locations/?expand=measurements:first:2",
+                    "/api/locations/testlocation-1/?expand=measurements:latest:x",
+                    "/api/sensors/?expand=location:latest:1"):
+            assert client.get(url).status_code == 400
+
+class TestNameCache():
+    """Tests for the name cache of URL converters"""
+
+    def test_hits(self, client):
+        """test that repeated lookups hit the cache"""
+        for _ in range(3):
+            assert client.get("/api/sensors/testsensor-1/").status_code == 200
+        stats = client.get("/api/stats/name-cache/").json
+        assert stats["sensor"]["misses"] == 1
+        assert stats["sensor"]["hits"] == 2
+        assert stats["sensor"]["size"] == 1
+
+    def test_hit_queries(self, client):
+        """test that a hit only reads the cache generation"""
+        url = "/api/sensors/testsensor-1/"
+        with _QueryCounter(client.application) as counter:
+            miss = client.get(url)
+        assert counter.count == 1
+        with _QueryCounter(client.application) as counter:
+            hit = client.get(url)
+        assert counter.count == 1
+        assert "cache_generation" in counter.statements[0]
+        assert "sensor" not in counter.statements[0]
+        assert hit.json == miss.json
+        assert hit.headers["ETag"] == miss.headers["ETag"]
+
+        # versions changed by bulk updates are loaded, not cached
+        client.post("/api/sensors/testsensor-1/measurements/",
+                    json={"temperature": 1.0, "humidity": 1.0,
+                          "timestamp": "2024-01-01T00:00:00"})
+        etag = client.get(url + "measurements/").headers["ETag"]
+        client.post("/api/sensors/testsensor-1/measurements/",
+                    json={"temperature": 1.0, "humidity": 1.0,
+                          "timestamp": "2024-01-01T00:01:00"})
+        assert client.get(url + "measurements/").headers["ETag"] != etag
+        stats = client.get("/api/stats/name-cache/").json
+        assert stats["sensor"]["misses"] == 1
+
+    def test_rename(self, client):
+        """test that renamed and deleted locations are not served from cache"""
+        assert client.get("/api/locations/testlocation-1/").status_code == 200
+        resp = client.put("/api/locations/testlocation-1/", json={"name": "renamed"})
+        assert resp.status_code == 200
+        assert client.get("/api/locations/testlocation-1/").status_code == 404
+        assert client.get("/api/locations/renamed/").status_code == 200
+        assert client.delete("/api/locations/renamed/").status_code == 200
+        assert client.get("/api/locations/renamed/").status_code == 404
+
+    def test_other_process(self, client):
+        """test that a rename made by another process is noticed on the next lookup"""
+        assert client.get("/api/sensors/testsensor-1/").status_code == 200
+        with client.application.app_context():
+            # what another process commits, its own caches are not these
+            caches = client.application.extensions.pop("name_cache")
+            client.application.extensions["name_cache"] = {
+                kind: type(cache)() for kind, cache in caches.items()
+            }
+            Sensor.query.filter_by(name="testsensor-1").one().name = "moved"
+            db.session.commit()
+            client.application.extensions["name_cache"] = caches
+        assert client.get("/api/sensors/testsensor-1/").status_code == 404
+        assert client.get("/api/sensors/moved/").status_code == 200
+
+class TestMetrics():
+    """Tests for the request metrics endpoint"""
+
+    @staticmethod
+    def _get(client, url):
+        # A WSGI server closes the response after sending it, the test
+        # client leaves that to the caller
+        resp = client.get(url)
+        resp.get_data()
+        resp.close()
+        return resp
+
+    @staticmethod
+    def _samples(client):
+        text = client.get("/api/metrics").get_data(as_text=True)
+        samples = {}
+        for line in text.splitlines():
+            if not line.startswith("#"):
+                name, value = line.rsplit(" ", 1)
+                samples[name] = float(value)
+        return samples
+
+    def test_metrics(self, client):
+        """test that requests are counted per endpoint, method and status"""
+        for _ in range(2):
+            self._get(client, "/api/sensors/testsensor-1/measurements/")
+        self._get(client, "/api/sensors/nope/")
+        resp = client.get("/api/metrics")
+        assert resp.status_code == 200
+        assert resp.content_type.startswith("text/plain")
+
+        samples = self._samples(client)
+        labels = 'endpoint="api.measurementcollection",method="GET"'
+        assert samples['mokkiwahti_http_responses_total{' + labels + ',status="200"}'] == 2
+        assert samples['mokkiwahti_http_responses_total'
+                       '{endpoint="unmatched",method="GET",status="404"}'] == 1
+        assert samples['mokkiwahti_http_request_duration_seconds_count{' + labels + '}'] == 2
+        assert samples['mokkiwahti_http_request_duration_seconds_bucket{'
+                       + labels + ',le="+Inf"}'] == 2
+        # converter, partition catalog, keys, the page and the cache
+        # generation, which a hit reads instead of the sensor
+        assert samples['mokkiwahti_sql_queries_per_request_sum{' + labels + '}'] == 11
+        assert samples['mokkiwahti_rows_serialized_total{' + labels + '}'] == 2
+        body = client.get("/api/sensors/testsensor-1/measurements/").get_data()
+        assert samples['mokkiwahti_response_bytes_total{' + labels + '}'] == 2 * len(body)
+
+    def test_multiple_processes(self, tmp_path):
+        """test that registries of worker processes are summed up"""
+        workers = [Metrics((0.1, 1), directory=str(tmp_path)) for _ in range(2)]
+        for worker, duration in zip(workers, (0.05, 0.5)):
+            stats = RequestStats()
+            stats.start -= duration
+            stats.queries = 3
+            worker.record("api.sensorcollection", "GET", 200, stats)
+            worker.flush()
+        text = workers[0].render()
+        labels = 'endpoint="api.sensorcollection",method="GET"'
+        assert ('mokkiwahti_http_responses_total{' + labels + ',status="200"} 2') in text
+        assert ('mokkiwahti_http_request_duration_seconds_bucket{'
+                + labels + ',le="0.1"} 1') in text
+        assert ('mokkiwahti_http_request_duration_seconds_bucket{'
+                + labels + ',le="1"} 2') in text
+        assert 'mokkiwahti_sql_queries_per_request_sum{' + labels + '} 6' in text
+
+    def test_exited_processes(self, tmp_path):
+        """test that files of worker processes that have exited are removed"""
+        worker = Metrics((0.1, 1), directory=str(tmp_path))
+        worker.record("api.sensorcollection", "GET", 200, RequestStats())
+        child = subprocess.Popen([sys.executable, "-c", ""])
+        child.wait()
+        # what the exited worker left behind
+        (tmp_path / f"metrics-{child.pid}-0123abcd.json").write_text(
+            json.dumps(worker.snapshot()), encoding="utf-8")
+        text = worker.render()
+        labels = 'endpoint="api.sensorcollection",method="GET"'
+        assert ('mokkiwahti_http_responses_total{' + labels + ',status="200"} 1') in text
+        assert os.listdir(tmp_path) == [os.path.basename(worker._path)]
+
+class TestCompression():
+    """Tests for gzip and deflate compression of responses"""
+
+    MEASUREMENTS_URL = "/api/sensors/testsensor-1/measurements/"
+
+    @staticmethod
+    def _post_measurements(client, count=200):
+        data = [
+            {"temperature": 20.5, "humidity": 40.5,
+             "timestamp": f"2024-01-01T{i // 60:02}:{i % 60:02}:00"}
+            for i in range(count)
+        ]
+        client.post(TestCompression.MEASUREMENTS_URL, json=data)
+
+    def test_streamed(self, client):
+        """test that streamed collections are compressed with the accepted encoding"""
+        self._post_measurements(client)
+        plain = client.get(self.MEASUREMENTS_URL)
+        assert "Content-Encoding" not in plain.headers
+        assert "Accept-Encoding" in plain.headers["Vary"]
+
+        resp = client.get(self.MEASUREMENTS_URL, headers={"Accept-Encoding": "gzip"})
+        assert resp.status_code == 200
+        assert resp.headers["Content-Encoding"] == "gzip"
+        assert resp.is_streamed
+        assert zlib.decompress(resp.get_data(), 16 + zlib.MAX_WBITS) == plain.get_data()
+        assert len(resp.get_data()) * 5 < len(plain.get_data())
+
+        resp = client.get(self.MEASUREMENTS_URL,
+                          headers={"Accept-Encoding": "gzip;q=0.5, deflate"})
+        assert resp.headers["Content-Encoding"] == "deflate"
+        assert zlib.decompress(resp.get_data()) == plain.get_data()
+
+        resp = client.get(self.MEASUREMENTS_URL, headers={"Accept-Encoding": "br"})
+        assert "Content-Encoding" not in resp.headers
+
+    def test_threshold(self, client):
+        """test that small bodies are sent as they are and big ones compressed"""
+        resp = client.get("/api/sensors/testsensor-1/", headers={"Accept-Encoding": "gzip"})
+        assert resp.status_code == 200
+        assert "Content-Encoding" not in resp.headers
+
+        client.application.config["COMPRESSION_MIN_SIZE"] = 10
+        resp = client.get("/api/sensors/testsensor-1/", headers={"Accept-Encoding": "gzip"})
+        assert resp.headers["Content-Encoding"] == "gzip"
+        assert int(resp.headers["Content-Length"]) == len(resp.get_data())
+        body = json.loads(zlib.decompress(resp.get_data(), 16 + zlib.MAX_WBITS))
+        assert body["name"] == "testsensor-1"
+
+        client.application.config["COMPRESSION"] = False
+        resp = client.get("/api/sensors/testsensor-1/", headers={"Accept-Encoding": "gzip"})
+        assert "Content-Encoding" not in resp.headers
+
+    def test_etag(self, client):
+        """test that compressed responses get weak ETags that still validate"""
+        self._post_measurements(client)
+        headers = {"Accept-Encoding": "gzip"}
+        resp = client.get(self.MEASUREMENTS_URL, headers=headers)
+        etag, weak = resp.get_etag()
+        assert weak
+        resp = client.get(self.MEASUREMENTS_URL,
+                          headers={**headers, "If-None-Match": resp.headers["ETag"]})
+        assert resp.status_code == 304
+        assert resp.get_etag()[0] == etag
+
+    def test_metrics(self, client):
+        """test that metrics count the compressed bytes"""
+        self._post_measurements(client)
+        resp = client.get(self.MEASUREMENTS_URL, headers={"Accept-Encoding": "gzip"})
+        size = len(resp.get_data())
+        resp.close()
+        text = client.get("/api/metrics").get_data(as_text=True)
+        labels = 'endpoint="api.measurementcollection",method="GET"'
+        assert f"mokkiwahti_response_bytes_total{{{labels}}} {size}" in text
+
+class TestConditionalGet():
+    """Tests for ETag and Last-Modified handling"""
+
+    SENSOR_URL = "/api/sensors/testsensor-1/"
+    LOCATION_URL = "/api/locations/testlocation-1/"
+    MEASUREMENTS_URL = "/api/sensors/testsensor-1/measurements/"
+
+    def test_if_none_match(self, client):
+        """test that unchanged resources are answered with 304"""
+        for url in (self.SENSOR_URL, self.LOCATION_URL, self.MEASUREMENTS_URL):
+            resp = client.get(url)
+            assert resp.status_code == 200
+            etag = resp.headers["ETag"]
+            assert "Last-Modified" in resp.headers
+            resp = client.get(url, headers={"If-None-Match": etag})
+            assert resp.status_code == 304
+            assert resp.headers["ETag"] == etag
+            # other representations have their own tag
+            resp = client.get(url + "?fields=name", headers={"If-None-Match": etag})
+            assert resp.status_code == 200
+
+    def test_if_modified_since(self, client):
+        """test If-Modified-Since"""
+        resp = client.get(self.SENSOR_URL)
+        resp = client.get(self.SENSOR_URL,
+                          headers={"If-Modified-Since": resp.headers["Last-Modified"]})
+        assert resp.status_code == 304
+        resp = client.get(self.SENSOR_URL,
+                          headers={"If-Modified-Since": "Mon, 01 Jan 2001 00:00:00 GMT"})
+        assert resp.status_code == 200
+
+    def test_changes(self, client):
+        """test that changes to a resource or what it shows change the ETag"""
+        etags = {url: client.get(url).headers["ETag"]
+                 for url in (self.SENSOR_URL, self.LOCATION_URL, self.MEASUREMENTS_URL)}
+        client.post(self.MEASUREMENTS_URL, json=_get_measurement().serialize(short_form=True))
+        resp = client.get(self.MEASUREMENTS_URL,
+                          headers={"If-None-Match": etags[self.MEASUREMENTS_URL]})
+        assert resp.status_code == 200
+        assert len(resp.json) == 2
+        resp = client.get(self.SENSOR_URL, headers={"If-None-Match": etags[self.SENSOR_URL]})
+        assert resp.status_code == 304
+
+        # renaming the location shows in the sensor and its measurements
+        etags[self.MEASUREMENTS_URL] = client.get(self.MEASUREMENTS_URL).headers["ETag"]
+        client.put(self.LOCATION_URL, json={"name": "renamed"})
+        for url in (self.SENSOR_URL, self.MEASUREMENTS_URL):
+            resp = client.get(url, headers={"If-None-Match": etags[url]})
+            assert resp.status_code == 200
+
+    def test_not_modified_query_count(self, client):
+        """test that a 304 is answered without querying measurements"""
+        etag = client.get(self.MEASUREMENTS_URL).headers["ETag"]
+        with _QueryCounter(client.application) as counter:
+            resp = client.get(self.MEASUREMENTS_URL, headers={"If-None-Match": etag})
+            assert resp.status_code == 304
+        # cache generation and the measurements version of the sensor
+        assert counter.count == 2
+
+class TestQueryCount():
+    """Tests that endpoints use a fixed number of queries"""
+
+    @staticmethod
+    def _add_more(client):
+        with client.application.app_context():
+            for i in range(10, 20):
+                location = Location(name=f"testlocation-{i}")
+                sensor = Sensor(name=f"testsensor-{i}",
+                                sensor_configuration=_get_sensor_configuration())
+                location.sensors.append(sensor)
+                meas = _get_measurement()
+                meas.sensor = sensor
+                meas.location = location
+                db.session.add(location)
+            db.session.commit()
+
+    @pytest.mark.parametrize("url, queries", [
+        ("/api/locations/", 2),
+        # measurements read the partition catalog first
+        ("/api/locations/?expand=sensors,measurements", 4),
+        ("/api/locations/?expand=measurements:latest:2", 3),
+        ("/api/locations/?fields=name", 1),
+        ("/api/sensors/", 1),
+        ("/api/sensors/?expand=", 1),
+        ("/api/sensors/testsensor-1/", 1),
+        ("/api/locations/testlocation-1/", 2),
+        ("/api/locations/testlocation-1/?expand=measurements:latest:2", 3),
+        # partition catalog, keys, the page and the cache generation when
+        # the streamed response pushes the request context again
+        ("/api/sensors/testsensor-1/measurements/", 5),
+        ("/api/locations/testlocation-1/measurements/", 5),
+        ("/api/sensors/testsensor-1/measurements/latest/", 2),
+        ("/api/locations/testlocation-1/latest/", 2),
+    ])
+    def test_query_count(self, client, url, queries):
+        """test query count of GET endpoints, independent of collection size"""
+        for add_more in (True, False):
+            # Cold name caches, hits are tested in TestNameCache
+            for cache in client.application.extensions["name_cache"].values():
+                cache.clear()
+            with _QueryCounter(client.application) as counter:
+                resp = client.get(url)
+                assert resp.status_code == 200
+                assert resp.json is not None
+            assert counter.count == queries
+            if add_more:
+                self._add_more(client)
+
 class TestSensorItem():
     """Tests for sensor object"""
     RESOURCE_URL = "/api/sensors/testsensor-1/"